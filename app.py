@@ -1,28 +1,174 @@
 """Flask app for Movement Breaks (productivity timer with guided exercise breaks)"""
 
+import functools
+import hmac
 import os
-from flask import Flask, render_template, jsonify, redirect, session, request
-from models import db, connect_db, User, Equipment, Target, Exercise, BlockedExercise
+import random
+import time
+from datetime import datetime
+from flask import Flask, Blueprint, abort, current_app, render_template, jsonify, redirect, session, request, make_response, g
+from models import db, connect_db, User, BlockedExercise
 from forms import RegisterForm, LoginForm, SettingsForm
+from catalog import get_catalog, get_searchable_catalog, catalog_cache, sample_page
+from eligible import eligible_cache
+from metrics import init_metrics, render_metrics
+from media import media_store, send_media
+from assets import asset_manifest, asset_url, send_asset
+from formats import MSGPACK, response_format, exercises_body, shared_body, compress_response
+from events import event_writer, parse_events
+from search import search, search_index
 from sqlalchemy.exc import IntegrityError
-import config
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 
-app = Flask(__name__)
+views = Blueprint('views', __name__)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///movement_breaks')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['SECRET_KEY'] = os.environ.get('DATABASE_URL')
+def create_app(config=None):
+    """
+    Return the Movement Breaks app, configured from the environment, then from dict config if given.
+
+    Nothing is loaded here: the database engine is created on the first query, and the catalog and the
+    indexes built from it on first use (see warm_caches to load them ahead of requests).
+    """
+    app = Flask(__name__)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///movement_breaks')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 10)),
+        # Seconds before a pooled connection is replaced, below any server or proxy idle timeout
+        'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1',
+        # Milliseconds before Postgres cancels a statement, 0 to disable (batch scripts such as the loader)
+        'connect_args': {
+            'options': f"-c statement_timeout={int(os.environ.get('DATABASE_STATEMENT_TIMEOUT', 5000))}"},
+    }
+    if os.environ.get('DATABASE_REPLICA_URL'):
+        app.config['SQLALCHEMY_BINDS'] = {'replica': os.environ['DATABASE_REPLICA_URL']}
+    # Seconds a user's reads stay on the primary after they write, to cover replication lag
+    app.config['REPLICA_LAG'] = int(os.environ.get('REPLICA_LAG', 5))
+    app.config['MEDIA_ROOT'] = os.environ.get('MEDIA_ROOT', os.path.join(app.root_path, 'media'))
+    # Internal nginx location serving MEDIA_ROOT, media is then sent by nginx with X-Accel-Redirect
+    app.config['MEDIA_ACCEL_REDIRECT'] = os.environ.get('MEDIA_ACCEL_REDIRECT')
+    # Send media with X-Sendfile, for servers other than nginx
+    app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+    # Built script and style bundles, see assets.py
+    app.config['ASSETS_ROOT'] = os.environ.get('ASSETS_ROOT', os.path.join(app.root_path, 'assets'))
+    # Seconds a prefetched page of exercises, and its token, stay valid
+    app.config['PREFETCH_TOKEN_MAX_AGE'] = int(os.environ.get('PREFETCH_TOKEN_MAX_AGE', 300))
+    # Break history events waiting to be written at most, per batch, and seconds between writes
+    app.config['EVENT_QUEUE_SIZE'] = int(os.environ.get('EVENT_QUEUE_SIZE', 10000))
+    app.config['EVENT_BATCH_SIZE'] = int(os.environ.get('EVENT_BATCH_SIZE', 500))
+    app.config['EVENT_FLUSH_INTERVAL'] = float(os.environ.get('EVENT_FLUSH_INTERVAL', 1))
+    app.config['SECRET_KEY'] = os.environ.get('DATABASE_URL')
+    app.config['CATALOG_CHECK_INTERVAL'] = int(os.environ.get('CATALOG_CHECK_INTERVAL', 5))
+    # Catalog snapshot file shared by the workers of a host, written by the seeding step, unset to disable
+    app.config['CATALOG_SNAPSHOT'] = os.environ.get('CATALOG_SNAPSHOT')
+    app.config['ELIGIBLE_CACHE_SIZE'] = int(os.environ.get('ELIGIBLE_CACHE_SIZE', 10000))
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    app.config['BCRYPT_POOL_SIZE'] = int(os.environ.get('BCRYPT_POOL_SIZE', 2))
+    # JSON and MessagePack responses of at least this many bytes are compressed, empty to disable
+    compress_min_size = os.environ.get('COMPRESS_MIN_SIZE', '1024')
+    app.config['COMPRESS_MIN_SIZE'] = int(compress_min_size) if compress_min_size else None
+    # Requests taking longer than this many seconds are logged with their SQL, unset to disable
+    app.config['SLOW_REQUEST_THRESHOLD'] = (float(os.environ['SLOW_REQUEST_THRESHOLD'])
+                                            if os.environ.get('SLOW_REQUEST_THRESHOLD') else None)
+    # Bearer token scrapers send to /metrics, unset to disable it
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    if config:
+        app.config.update(config)
+
+    connect_db(app)
+    init_metrics(app)
+    app.add_template_global(asset_url)
+    app.register_blueprint(views)
+    return app
+
+_default_app = None
+
+def __getattr__(name):
+    """Return app configured from the environment as app.app, created on first use, for servers, scripts and tests"""
+
+    global _default_app
+    if name == 'app':
+        if _default_app is None:
+            _default_app = create_app()
+        return _default_app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def warm_caches(app):
+    """
+    Load the catalog, the search and recommendation indexes built from it and the asset manifest, then close
+    database connections.
+
+    Run before forking workers (see gunicorn.conf.py), so that workers share what was loaded copy-on-write
+    instead of each loading it on its first requests, and do not inherit open connections.
+    """
+    from recommender import catalog_arrays
+
+    with app.app_context():
+        catalog = get_catalog()
+        search_index(catalog)
+        catalog_arrays(catalog)
+        asset_manifest()
+        db.session.remove()
+        db.engine.dispose()
+
+MAX_SAMPLE = 50
+MAX_BLOCKS_PAGE = 100
+MAX_BLOCK_IDS = 100
+MAX_EVENTS = 100
+MAX_EXCLUDE = 200
+MAX_SEARCH = 50
+
+def read_only(view):
+    """Send the GET requests of view to the read replica, unless the user wrote recently"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'GET' and time.time() >= session.get('primary_until', 0):
+            g.use_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+@views.after_request
+def compress(response):
+    """Compress JSON and MessagePack responses as the client accepts, see formats.compress_response"""
 
-connect_db(app)
+    return compress_response(response, request.accept_encodings, current_app.config['COMPRESS_MIN_SIZE'])
 
-@app.route('/')
+def stick_to_primary():
+    """
+    Keep reads of the current user on the primary until the replica catches up with what they just saved.
+
+    Called by views committing rows the user reads back (registration, settings and blocks), not by those
+    that only log in or queue break history, which would otherwise keep active users off the replica.
+    """
+
+    if current_app.config.get('SQLALCHEMY_BINDS'):
+        session['primary_until'] = time.time() + current_app.config['REPLICA_LAG']
+
+def current_user_context():
+    """
+    Return UserContext of logged in user, None if not logged in
+
+    The user and their preference ids are loaded in one query, once per request.
+    """
+
+    if 'user_context' not in g:
+        g.user_context = User.load_context(session['user_id']) if 'user_id' in session else None
+    return g.user_context
+
+@views.route('/')
+@read_only
 def show_timer():
     """Display timer/home page"""
-    user = User.query.get(session['user_id']) if 'user_id' in session else None
-    return render_template('timer.html', user=user) 
+    context = current_user_context()
+    return render_template('timer.html', user=context.user if context else None) 
 
-@app.route('/exercises')
+@views.route('/exercises')
+@read_only
 def get_exercises():
     """
     Return query status and exercises, filtering for user's preferences if logged in.
@@ -31,40 +177,269 @@ def get_exercises():
 
     exercises_found indicates whether exercises were found that fulfill all user preferences.
     If exercises_found is False, all body weight exercises will be returned as a default instead.
+
+    If sample=N is given, only N exercises are returned, in a random order determined by seed
+    (generated if not given). The returned seed and next_cursor fetch the following page as
+    ?sample=N&seed=...&cursor=..., next_cursor is null once all exercises have been returned.
+    ?sample=N&token=... continues after a page returned by prefetch_exercises instead.
     """
-    bodyweight_id = Equipment.query.filter(Equipment.name == 'body weight').one().id
-    exercises_found = True
+    catalog = get_catalog()
+    context = current_user_context()
+    user = context.user if context else None
 
-    if 'user_id' in session:
-        user = User.query.get(session['user_id'])
-        if user:
-            # Filter exercises for user equipment preferences, default to bodyweight only
-            equip_ids = [equip.id for equip in user.equipment] if user.equipment else [bodyweight_id]
-            exercise_query = Exercise.query.filter(Exercise.equipment_id.in_(equip_ids))
-
-            # Filter out blocked exercises
-            blocked_ids = [equip.id for equip in user.blocked_exercises]
-            exercise_query = exercise_query.filter(Exercise.id.not_in(blocked_ids))
-
-            # Filter for user target preferences if present
-            target_ids = [target.id for target in user.targets]
-            if target_ids:
-                exercise_query = exercise_query.filter(Exercise.target_id.in_(target_ids))
-            
-            exercises = [exercise.serialize() for exercise in exercise_query.all()]
-            
-            if exercises:
-                return jsonify({'exercises_found': exercises_found,
-                                'exercises': exercises})
-            else:
-                exercises_found = False
-
-    # Return body weight exercises if not logged in or if filtering failed to retrieve exercises
-    exercises = [exercise.serialize() for exercise in Equipment.query.get(bodyweight_id).exercises]
-    return jsonify({'exercises_found': exercises_found,
-                    'exercises': exercises})
-
-@app.route('/register', methods=['GET', 'POST'])
+    seed = request.args.get('seed', type=int)
+    cursor = request.args.get('cursor', type=int)
+    if 'token' in request.args:
+        position = load_prefetch_token(request.args['token'], user)
+        if position is None:
+            return (jsonify(message="Invalid or expired token"), 400)
+        seed, cursor = position
+
+    # Response only changes with the catalog and the user's preferences, unless a random sample is requested
+    etag = exercises_etag(catalog, user)
+    conditional = 'sample' not in request.args or seed is not None
+    if conditional and request.if_none_match.contains_weak(etag):
+        return cache_headers(make_response('', 304), etag)
+
+    exercise_ids, exercises_found = eligible_exercise_ids(catalog, context)
+
+    sample = request.args.get('sample', type=int)
+    if sample is None and exercise_ids is catalog.bodyweight_ids:
+        # Every body weight exercise, the same for all users shown them
+        response = shared_exercises_response(catalog, 'bodyweight', exercise_ids, exercises_found=exercises_found)
+    elif sample is None:
+        response = exercises_response(catalog, exercise_ids, exercises_found=exercises_found)
+    else:
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+        page, next_cursor = sample_exercises(exercise_ids, sample, seed, cursor)
+        response = exercises_response(catalog, page, exercises_found=exercises_found, seed=seed,
+                                      next_cursor=next_cursor)
+
+    return cache_headers(response, etag if conditional else None)
+
+@views.route('/exercises/prefetch')
+@read_only
+def prefetch_exercises():
+    """
+    Return the next page of exercises for an upcoming break, along with a short-lived token.
+
+    Takes sample, seed and cursor like get_exercises. Clients call it during the last minute of the work
+    phase, at a random moment, so that breaks starting on the hour do not all load the catalog at once.
+    The page can be shown without another request for expires_in seconds, during which the token
+    continues paging after it with /exercises?sample=N&token=...
+    """
+    catalog = get_catalog()
+    context = current_user_context()
+    user = context.user if context else None
+
+    seed = request.args.get('seed', type=int)
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+    exercise_ids, exercises_found = eligible_exercise_ids(catalog, context)
+    page, next_cursor = sample_exercises(exercise_ids, request.args.get('sample', 5, type=int), seed,
+                                         request.args.get('cursor', type=int))
+
+    token = prefetch_serializer().dumps([user.id if user else 0, seed, next_cursor])
+    response = exercises_response(catalog, page, exercises_found=exercises_found, seed=seed,
+                                  next_cursor=next_cursor, token=token,
+                                  expires_in=current_app.config['PREFETCH_TOKEN_MAX_AGE'])
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+@views.route('/exercises/recommended')
+@read_only
+def recommend_exercises():
+    """
+    Return up to count exercises recommended for the user, see recommender.recommend.
+
+    exclude is a comma separated list of ids of exercises not to recommend, such as those already shown
+    during this break. Exercises logged in users were recently shown or skipped are recommended less.
+    """
+    catalog = get_catalog()
+    if 'user_context' not in g and 'user_id' in session:
+        # Loaded with break history, in the same single query
+        g.user_context = User.load_context(session['user_id'], history=True)
+    context = current_user_context()
+
+    try:
+        exclude = [int(exercise_id) for exercise_id in request.args.get('exclude', '').split(',') if exercise_id]
+    except ValueError:
+        return (jsonify(message="exclude must be a list of exercise ids"), 400)
+    if len(exclude) > MAX_EXCLUDE:
+        return (jsonify(message=f"Cannot exclude more than {MAX_EXCLUDE} exercises"), 400)
+
+    mask, exercises_found = eligible_exercise_mask(catalog, context)
+    count = min(max(request.args.get('count', 5, type=int), 1), MAX_SAMPLE)
+    # NumPy is only imported by workers asked for recommendations
+    from recommender import recommend
+    exercise_ids = recommend(catalog, mask, count, context, exclude)
+
+    response = exercises_response(catalog, exercise_ids, exercises_found=exercises_found)
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+@views.route('/exercises/search')
+@read_only
+def search_exercises():
+    """
+    Return exercises whose name or instructions contain words starting with each word of q, see search.search.
+
+    Only exercises with the user's equipment (body weight if not logged in or not set) are searched, less
+    blocked exercises, whatever their target. Results are paged by offset and limit, next_offset is null
+    on the last page. Right after the catalog changes, the previous catalog is searched until the new one's
+    search index is built.
+    """
+    catalog = get_searchable_catalog()
+    context = current_user_context()
+    user = context.user if context else None
+
+    query = request.args.get('q', '').strip()
+    if not query:
+        return (jsonify(message="q is required"), 400)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_SEARCH)
+
+    etag = exercises_etag(catalog, user)
+    if request.if_none_match.contains_weak(etag):
+        return cache_headers(make_response('', 304), etag)
+
+    if context:
+        mask = (catalog.preference_mask(context.equipment_ids or [catalog.bodyweight_id], [])
+                & ~catalog.exercise_mask(context.blocked_ids))
+    else:
+        mask = catalog.equipment_index.get(catalog.bodyweight_id, 0)
+    exercise_ids, total = search(catalog, query, mask, offset, limit)
+    next_offset = offset + len(exercise_ids) if offset + len(exercise_ids) < total else None
+
+    response = exercises_response(catalog, exercise_ids, total=total, next_offset=next_offset)
+    return cache_headers(response, etag)
+
+def exercises_etag(catalog, user):
+    """
+    Return ETag of exercise responses, which only change with the catalog, the user's preferences and the
+    response format
+    """
+
+    etag = f'{catalog.version}-{user.id}-{user.preferences_version}' if user else f'{catalog.version}-0'
+    return etag + '-msgpack' if response_format(request.accept_mimetypes) == MSGPACK else etag
+
+def eligible_exercise_mask(catalog, context):
+    """
+    Return (catalog bitset mask of exercises, exercises_found) for user context, see get_exercises
+
+    Users that are not logged in, or whose preferences match no exercises, get body weight exercises.
+    """
+
+    if context:
+        # Exercises matching user equipment (default bodyweight only) and target preferences, minus blocked exercises
+        mask = eligible_cache.get(context, catalog)
+        if mask:
+            return mask, True
+        return catalog.equipment_index.get(catalog.bodyweight_id, 0), False
+    return catalog.equipment_index.get(catalog.bodyweight_id, 0), True
+
+def eligible_exercise_ids(catalog, context):
+    """Return (exercise ids, exercises_found) for user context, see eligible_exercise_mask"""
+
+    mask, exercises_found = eligible_exercise_mask(catalog, context)
+    if context and exercises_found:
+        return catalog.ids_from_mask(mask), True
+    return catalog.bodyweight_ids, exercises_found
+
+def sample_exercises(exercise_ids, sample, seed, cursor):
+    """Return (page of up to sample exercise ids, next cursor) of exercise_ids shuffled by seed"""
+
+    page, next_cursor = sample_page(exercise_ids, min(max(sample, 1), MAX_SAMPLE), seed, cursor)
+    # Cursor is sent as a string, it does not fit in a JavaScript number
+    return page, str(next_cursor) if next_cursor is not None else None
+
+def prefetch_serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='prefetch')
+
+def load_prefetch_token(token, user):
+    """Return (seed, cursor) of prefetch token, None if it is invalid, expired or for another user"""
+
+    try:
+        user_id, seed, cursor = prefetch_serializer().loads(token, max_age=current_app.config['PREFETCH_TOKEN_MAX_AGE'])
+    except (BadSignature, ValueError):
+        return None
+    if user_id != (user.id if user else 0):
+        return None
+    return seed, int(cursor) if cursor is not None else None
+
+def exercises_response(catalog, exercise_ids, **fields):
+    """
+    Return JSON response with given fields and exercises, joined from the catalog's pre-encoded exercises,
+    or MessagePack if the client prefers it (see formats.response_format)
+    """
+
+    mimetype = response_format(request.accept_mimetypes)
+    response = current_app.response_class(exercises_body(catalog, exercise_ids, mimetype, fields), mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+def shared_exercises_response(catalog, name, exercise_ids, **fields):
+    """
+    Return exercises_response for a body the same for many users, identified by name and fields, which is
+    encoded and compressed once per catalog
+    """
+
+    mimetype = response_format(request.accept_mimetypes)
+    body = shared_body(catalog, (name, mimetype, tuple(fields.items())),
+                       lambda: exercises_body(catalog, exercise_ids, mimetype, fields))
+    response = current_app.response_class(body.data, mimetype=mimetype)
+    response.shared_body = body
+    response.vary.add('Accept')
+    return response
+
+def cache_headers(response, etag):
+    """
+    Set ETag on response, requiring clients to revalidate their cached copy on each use.
+
+    The ETag is weak, on 304s too, as the body may be compressed (see formats.compress_response).
+    """
+
+    if etag:
+        response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+@views.route('/assets/<name>')
+def show_asset(name):
+    """Serve built script or style bundle, or a file one refers to, compressed as the client accepts"""
+
+    return send_asset(current_app.config['ASSETS_ROOT'], name, request.accept_encodings)
+
+@views.route('/media/<name>')
+def show_media(name):
+    """Serve cached exercise GIF or one of its renditions"""
+
+    return send_media(media_store(), name, current_app.config['MEDIA_ACCEL_REDIRECT'])
+
+@views.route('/metrics')
+def show_metrics():
+    """
+    Return request, cache and auth metrics in Prometheus text format
+
+    Requests must carry the METRICS_TOKEN as a bearer token, the endpoint does not exist without one.
+    """
+
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return (jsonify(message="Unauthorized"), 401, {'WWW-Authenticate': 'Bearer'})
+
+    gauges = [(f'catalog_cache_{key}_total', '', value)
+              for key, value in catalog_cache.stats().items() if key != 'version']
+    gauges.append(('catalog_version', '', catalog_cache.stats()['version'] or 0))
+    gauges += [(f'eligible_cache_{key}', '', value) for key, value in eligible_cache.stats().items()]
+    gauges += [(f'break_events_{key}', '', value) for key, value in event_writer.stats().items()]
+    return current_app.response_class(render_metrics(gauges), mimetype='text/plain; version=0.0.4')
+
+@views.route('/register', methods=['GET', 'POST'])
 def register_user():
     """Register new user, redirecting to home page on success"""
     form = RegisterForm()
@@ -81,11 +456,12 @@ def register_user():
             form.username.errors.append('Username already exists. Please try another.')
             return render_template('register.html', form=form)
         session['user_id'] = new_user.id 
+        stick_to_primary()
         return redirect('/')
     
     return render_template('register.html', form=form)
 
-@app.route('/login', methods=['GET', 'POST'])
+@views.route('/login', methods=['GET', 'POST'])
 def login_user():
     """Authenticate user details and handle login"""
 
@@ -101,14 +477,15 @@ def login_user():
         form.password.errors.append('Incorrect username/password combination. Please try again.')
     return render_template('login.html', form=form)
 
-@app.route('/logout')
+@views.route('/logout')
 def logout_user():
     """Handle logout"""
 
     session.pop('user_id')
     return redirect('/')
 
-@app.route('/settings', methods=['GET', 'POST'])
+@views.route('/settings', methods=['GET', 'POST'])
+@read_only
 def change_settings():
     """
     Change user settings for timer length and exercise preferences.
@@ -117,15 +494,17 @@ def change_settings():
     """
 
     if 'user_id' in session:
-        user = User.query.get(session['user_id'])
+        context = current_user_context()
+        user = context.user
+        catalog = get_catalog()
         form = SettingsForm()
-        form.equipment.choices = [(equipment.id, equipment.name) for equipment in Equipment.query.all()]
-        form.targets.choices = [(target.id, target.name) for target in Target.query.all()]
+        form.equipment.choices = catalog.equipment
+        form.targets.choices = catalog.targets
 
         # Prepopulate form with current settings. This is done manually because passing user to obj does not work for multiselect fields
         if request.method == 'GET':
-            form.equipment.default = [equipment.id for equipment in user.equipment]
-            form.targets.default = [target.id for target in user.targets]
+            form.equipment.default = context.equipment_ids
+            form.targets.default = context.target_ids
             form.process()
 
             # form.process() clears out other prepopulated fields, so we populate these after
@@ -133,36 +512,135 @@ def change_settings():
             form.break_length.data = user.break_length
 
         if form.validate_on_submit():
+            # Taken before the commit, which expires user's attributes
+            user_id, preferences_version = user.id, user.preferences_version + 1
             user.work_length = form.work_length.data
             user.break_length = form.break_length.data
-
-            user.equipment = []
-            for selection in form.equipment.data:
-                equipment = Equipment.query.get(selection)
-                user.equipment.append(equipment)
-            
-            user.targets = []
-            for selection in form.targets.data:
-                target = Target.query.get(selection)
-                user.targets.append(target)
+            changed = user.update_preferences(form.equipment.data, form.targets.data,
+                                              current=(context.equipment_ids, context.target_ids))
 
             db.session.add(user)
             db.session.commit()
+            stick_to_primary()
+            if changed:
+                eligible_cache.update_preferences(user_id, catalog, form.equipment.data, form.targets.data,
+                                                  preferences_version)
         
         return render_template('settings.html', form=form)
     else:
         return redirect('/')
     
-@app.route('/users/<int:user_id>/block', methods=['POST'])
+@views.route('/users/<int:user_id>/block', methods=['POST'])
 def block_exercise(user_id):
     """
     Add an exercise to user's blocked exercises list
+
+    Blocking an exercise that is already blocked succeeds, so that the request can be retried.
     """
 
     # Verify that user is logged in and adding a block to their own account
     if 'user_id' in session and user_id == session['user_id']:
-        block = BlockedExercise(user_id=user_id, exercise_id=request.json.get('exercise_id'))
-        db.session.add(block)
-        db.session.commit()
+        block_exercises(user_id, [request.json.get('exercise_id')])
         return (jsonify(message="Blocked exercise"), 201)
     return (jsonify(message="Unauthorized"), 401)
+
+@views.route('/users/<int:user_id>/blocks', methods=['GET'])
+@read_only
+def list_blocked_exercises(user_id):
+    """
+    Return page of user's blocked exercises in id order
+
+    Up to limit (default and maximum 100) exercises are returned, starting after the exercise id given
+    as after. next_after is the value of after for the next page, null on the last page.
+    """
+
+    if 'user_id' in session and user_id == session['user_id']:
+        limit = min(max(request.args.get('limit', MAX_BLOCKS_PAGE, type=int), 1), MAX_BLOCKS_PAGE)
+        exercise_ids = BlockedExercise.page(user_id, request.args.get('after', type=int), limit + 1)
+
+        catalog = get_catalog()
+        exercises = [{'id': exercise_id,
+                      'name': catalog.exercises[exercise_id]['name'] if exercise_id in catalog.exercises else None}
+                     for exercise_id in exercise_ids[:limit]]
+        return jsonify(exercises=exercises,
+                       next_after=exercise_ids[limit - 1] if len(exercise_ids) > limit else None)
+    return (jsonify(message="Unauthorized"), 401)
+
+@views.route('/users/<int:user_id>/blocks', methods=['POST', 'DELETE'])
+def update_blocked_exercises(user_id):
+    """
+    Block (POST) or unblock (DELETE) the exercises in exercise_ids (up to 100), in one statement
+
+    Both are idempotent, exercises that were already blocked (or not blocked) are left alone.
+    Returns ids of exercises whose block status changed.
+    """
+
+    if 'user_id' in session and user_id == session['user_id']:
+        exercise_ids = (request.json or {}).get('exercise_ids')
+        # bool is a subclass of int, but true is not an exercise id
+        if (not isinstance(exercise_ids, list)
+                or not all(type(exercise_id) is int for exercise_id in exercise_ids)):
+            return (jsonify(message="exercise_ids must be a list of exercise ids"), 400)
+        if len(exercise_ids) > MAX_BLOCK_IDS:
+            return (jsonify(message=f"Cannot change more than {MAX_BLOCK_IDS} blocks at once"), 400)
+
+        if request.method == 'POST':
+            blocked = block_exercises(user_id, exercise_ids)
+            return (jsonify(message="Blocked exercises", exercise_ids=blocked), 201)
+
+        unblocked = BlockedExercise.unblock(user_id, exercise_ids) if exercise_ids else []
+        if unblocked:
+            User.increment_preferences_version(user_id)
+            eligible_cache.discard(user_id)
+        db.session.commit()
+        if unblocked:
+            stick_to_primary()
+        return jsonify(message="Unblocked exercises", exercise_ids=unblocked)
+    return (jsonify(message="Unauthorized"), 401)
+
+def block_exercises(user_id, exercise_ids):
+    """
+    Block exercises for user, updating cached eligible exercises and recording them in the break history.
+
+    Returns ids of newly blocked exercises.
+    """
+
+    blocked = BlockedExercise.block(user_id, exercise_ids) if exercise_ids else []
+    if blocked:
+        preferences_version = User.increment_preferences_version(user_id)
+        db.session.commit()
+        stick_to_primary()
+        eligible_cache.block(user_id, get_catalog(), blocked, preferences_version)
+        now = datetime.utcnow()
+        event_writer.put([{'user_id': user_id, 'kind': 'blocked', 'exercise_id': exercise_id, 'created_at': now}
+                          for exercise_id in blocked])
+    else:
+        db.session.commit()
+    return blocked
+
+@views.route('/events', methods=['POST'])
+def record_events():
+    """
+    Record break history events of the logged in user, written in batches in the background (see events.py)
+
+    Takes events, a list of up to 100 {kind, exercise_id} (exercise_id for shown and skipped exercises only).
+    Returns 202 once queued, or 503 when too many events are waiting to be written.
+    """
+
+    if 'user_id' not in session:
+        return (jsonify(message="Unauthorized"), 401)
+
+    events = (request.json or {}).get('events')
+    if isinstance(events, list) and len(events) > MAX_EVENTS:
+        return (jsonify(message=f"At most {MAX_EVENTS} events can be sent at once"), 400)
+    try:
+        parsed = parse_events(events, get_catalog().exercises)
+    except ValueError as e:
+        return (jsonify(message=str(e)), 400)
+
+    now = datetime.utcnow()
+    rows = [{'user_id': session['user_id'], 'kind': kind, 'exercise_id': exercise_id, 'created_at': now}
+            for kind, exercise_id in parsed]
+    if not event_writer.put(rows):
+        return (jsonify(message="Too many events, try again later"), 503, {'Retry-After': '10'})
+    return (jsonify(message="Events queued", count=len(rows)), 202)
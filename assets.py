@@ -0,0 +1,205 @@
+"""
+Static asset bundles for Movement Breaks.
+
+Pages load their scripts and styles as a few bundles, built from static/ and from the vendored libraries
+(jQuery, Bootstrap and Font Awesome, installed from PyPI as XStatic packages) rather than fetched from public
+CDNs. Bundles, and the files their styles refer to such as fonts, are written to ASSETS_ROOT named by a hash
+of their content, along with gzip and brotli compressed copies of text files. They are served under
+ASSETS_URL with year-long immutable cache headers, compressed as the client accepts. manifest.json maps
+each bundle name to its file name, which templates look up with asset_url. Our own scripts and styles are
+minified when rjsmin and rcssmin are installed.
+
+Run with python assets.py to build the bundles after changing static/, which is otherwise done on the first
+page render if they were never built, and on any page render after a change in debug mode.
+"""
+
+import argparse
+import gzip
+import hashlib
+import importlib
+import json
+import mimetypes
+import os
+import re
+import threading
+
+import brotli
+from flask import abort, current_app, send_file
+
+from formats import accepted_encoding
+from media import write_file
+
+try:
+    import rcssmin
+    import rjsmin
+except ImportError:
+    rjsmin = rcssmin = None
+
+ASSETS_URL = '/assets/'
+
+MANIFEST = 'manifest.json'
+
+# Bundle name: [(XStatic package, or None for static/, path of source file)], concatenated in order
+BUNDLES = {
+    'base.css': [('bootstrap', 'css/bootstrap.min.css'),
+                 ('font_awesome', 'css/font-awesome.min.css'),
+                 (None, 'style.css')],
+    'base.js': [('bootstrap', 'js/bootstrap.bundle.min.js')],
+    'timer.js': [('jquery', 'jquery.min.js'),
+                 (None, 'timer.js')],
+}
+
+# Extensions of files worth compressing, fonts such as woff and woff2 are compressed already
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ttf', '.eot', '.otf'}
+
+# Content-Encoding: file suffix, in order of preference
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+# Files are named by their content, so they never change once served
+CACHE_SECONDS = 365 * 24 * 60 * 60
+
+NAME_PATTERN = re.compile(r'^[\w-]+\.[0-9a-f]{16}\.\w+$')
+
+# Relative URLs in styles, with any query string or fragment, which are left off the copied file's name
+URL_PATTERN = re.compile(r'''url\(\s*(['"]?)(?!data:|[a-z]+://|/)([^'"?#)]+)([^'")]*)\1\s*\)''')
+
+SOURCE_MAP_PATTERN = re.compile(r'^\s*(/\*# sourceMappingURL=.*\*/|//# sourceMappingURL=.*)$', re.MULTILINE)
+
+def source_path(package, path, static_folder):
+    """Return path of source file path in XStatic package, or in static_folder if package is None"""
+
+    if package is None:
+        return os.path.join(static_folder, path)
+    return os.path.join(importlib.import_module(f'xstatic.pkg.{package}').BASE_DIR, path)
+
+def asset_name(name, data):
+    """Return file name of asset name with content data"""
+
+    stem, extension = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:16]}{extension}'
+
+def write_asset(root, name, data):
+    """Write asset name with content data, and its compressed copies, to root, returning its file name"""
+
+    file_name = asset_name(name, data)
+    path = os.path.join(root, file_name)
+    if not os.path.exists(path):
+        if os.path.splitext(name)[1] in COMPRESSIBLE:
+            write_file(path + '.gz', gzip.compress(data, 9, mtime=0))
+            write_file(path + '.br', brotli.compress(data))
+        # Written last, so that a stored asset means its compressed copies are complete
+        write_file(path, data)
+    return file_name
+
+def read_source(package, path, static_folder, root):
+    """
+    Return text of source file, without source map comments (maps are not served), minified if it is ours.
+
+    Relative URLs in styles are replaced by those of copies of the files they refer to, written to root.
+    """
+
+    source = source_path(package, path, static_folder)
+    with open(source, encoding='utf-8') as fp:
+        text = SOURCE_MAP_PATTERN.sub('', fp.read())
+
+    if package is None and rjsmin is not None:
+        text = rjsmin.jsmin(text) if path.endswith('.js') else rcssmin.cssmin(text)
+
+    if path.endswith('.css'):
+        def copy(match):
+            with open(os.path.join(os.path.dirname(source), match[2]), 'rb') as fp:
+                file_name = write_asset(root, os.path.basename(match[2]), fp.read())
+            return f'url({match[1]}{file_name}{match[3]}{match[1]})'
+        text = URL_PATTERN.sub(copy, text)
+    return text
+
+def build_assets(root, static_folder):
+    """Write bundles and the files they refer to into root, returning the manifest {bundle name: file name}"""
+
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        texts = [read_source(package, path, static_folder, root) for package, path in sources]
+        # Semicolons keep a script without a final one from running into the next
+        data = (';\n' if name.endswith('.js') else '\n').join(texts).encode()
+        manifest[name] = write_asset(root, name, data)
+    write_file(os.path.join(root, MANIFEST), json.dumps(manifest, indent=2).encode())
+    return manifest
+
+_build_lock = threading.Lock()
+
+def is_stale(root, static_folder):
+    """Return whether our sources in static_folder changed since the assets in root were built"""
+
+    try:
+        built = os.path.getmtime(os.path.join(root, MANIFEST))
+    except FileNotFoundError:
+        return True
+    return any(os.path.getmtime(source_path(package, path, static_folder)) > built
+               for sources in BUNDLES.values() for package, path in sources if package is None)
+
+def asset_manifest():
+    """
+    Return manifest of the current app's assets, building them if they were not built yet, or in debug
+    mode if our sources changed since
+    """
+
+    app = current_app._get_current_object()
+    root = app.config['ASSETS_ROOT']
+    loaded = app.extensions.get('assets')
+    if loaded is None or loaded[0] != root or (app.debug and is_stale(root, app.static_folder)):
+        with _build_lock:
+            if app.debug and is_stale(root, app.static_folder):
+                manifest = build_assets(root, app.static_folder)
+            else:
+                try:
+                    with open(os.path.join(root, MANIFEST)) as fp:
+                        manifest = json.load(fp)
+                except FileNotFoundError:
+                    manifest = build_assets(root, app.static_folder)
+            loaded = app.extensions['assets'] = (root, manifest)
+    return loaded[1]
+
+def asset_url(name):
+    """Return URL of bundle name, such as 'timer.js'"""
+
+    return ASSETS_URL + asset_manifest()[name]
+
+def send_asset(root, name, accept_encodings):
+    """
+    Return response serving asset file name from root, 404 if there is none.
+
+    The brotli or gzip compressed copy is sent instead when there is one and accept_encodings, the
+    request's Accept-Encoding header, accepts its encoding.
+    """
+
+    path = os.path.join(root, name)
+    if not NAME_PATTERN.match(name) or not os.path.exists(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    encoding = accepted_encoding(accept_encodings, [encoding for encoding, suffix in ENCODINGS.items()
+                                                    if os.path.exists(path + suffix)])
+    if encoding:
+        path += ENCODINGS[encoding]
+
+    # Uses X-Sendfile when USE_X_SENDFILE is set
+    response = send_file(path, mimetype=mimetype, conditional=True, cache_timeout=CACHE_SECONDS)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = f'public, max-age={CACHE_SECONDS}, immutable'
+    return response
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build static asset bundles')
+    parser.add_argument('root', nargs='?', help='directory to write assets to, ASSETS_ROOT by default')
+    args = parser.parse_args(argv)
+
+    from app import app
+    root = args.root or app.config['ASSETS_ROOT']
+    manifest = build_assets(root, app.static_folder)
+    for name, file_name in manifest.items():
+        print(f'{name}: {os.path.join(root, file_name)}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark gunicorn worker boot time and memory, with and without preloading the app and its caches.
+
+Starts gunicorn with gunicorn.conf.py, once with PRELOAD=0 (each worker loads the app, and the catalog and
+its search index on first use) and once with PRELOAD=1 (the master loads them before forking). For each,
+reports the seconds until the server answers and until every worker has served a search, and per worker
+memory from /proc: RSS, PSS (shared pages split between the processes sharing them) and USS (pages only
+the worker has). Linux only.
+
+Run from the project root with
+    python -m benchmarks.boot --database-url postgresql:///movement_bench [--workers N]
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+PORT = 8765
+URL = f'http://127.0.0.1:{PORT}/exercises/search?q=a'
+START_TIMEOUT = 300
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=120) as response:
+            return response.status
+    except OSError:
+        return None
+
+def children(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as fp:
+        return [int(child) for child in fp.read().split()]
+
+def memory(pid):
+    """Return (RSS, PSS, USS) of process pid in MiB"""
+
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as fp:
+        for line in fp:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return values['Rss'], values['Pss'], values['Private_Clean'] + values['Private_Dirty']
+
+def run(database_url, workers, preload):
+    """Start gunicorn, returning (seconds to first response, seconds until all workers served, worker memory)"""
+
+    env = dict(os.environ, DATABASE_URL=database_url, WEB_CONCURRENCY=str(workers), PORT=str(PORT),
+               PRELOAD='1' if preload else '0')
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'], env=env,
+                              stderr=subprocess.DEVNULL)
+    try:
+        while get(URL) != 200:
+            if server.poll() is not None or time.perf_counter() - start > START_TIMEOUT:
+                raise RuntimeError('gunicorn did not start serving')
+            time.sleep(0.05)
+        first = time.perf_counter() - start
+
+        # Concurrent requests until every worker has served some, each loading whatever it lacks
+        threads = [threading.Thread(target=lambda: [get(URL) for _ in range(5)]) for _ in range(workers * 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ready = time.perf_counter() - start
+
+        usage = [memory(pid) for pid in children(server.pid)]
+        return first, ready, usage
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark worker boot time and memory')
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args(argv)
+
+    print(f'{args.workers} workers, memory per worker in MiB (mean)')
+    for preload in (False, True):
+        first, ready, usage = run(args.database_url, args.workers, preload)
+        rss, pss, uss = [sum(values) / len(values) for values in zip(*usage)]
+        print(f'{"preload" if preload else "no preload":10}: first response {first:6.2f}s, all workers {ready:6.2f}s, '
+              f'RSS {rss:6.1f}, PSS {pss:6.1f}, USS {uss:6.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Benchmark bytes on the wire and CPU per /exercises response, by format and compression.
+
+For a response of count exercises, encoded as JSON and as MessagePack, reports its size and the time to
+encode it, then the size and time to compress it with gzip and brotli at the levels used per request, and
+at those of shared bodies, which are compressed once per catalog version. No database is needed,
+exercises are built in memory as in benchmarks.serialize.
+
+Run from the project root with python -m benchmarks.compress [count] [repeat]
+"""
+
+import sys
+import timeit
+
+from app import app
+from benchmarks.serialize import build_catalog
+from formats import JSON, MSGPACK, COMPRESSION_LEVELS, compress, exercises_body
+
+def main(count=1000, repeat=50):
+    catalog, _ = build_catalog(count)
+    exercise_ids = list(catalog.ids)
+    fields = {'exercises_found': True}
+
+    print(f'{count} exercises, {repeat} repeats, sizes in KiB, times in ms per response')
+    with app.app_context():
+        for mimetype in (JSON, MSGPACK):
+            # MessagePack fragments are made on first use
+            body = exercises_body(catalog, exercise_ids, mimetype, fields)
+            seconds = timeit.timeit(lambda: exercises_body(catalog, exercise_ids, mimetype, fields),
+                                    number=repeat) / repeat
+            print(f'{mimetype:20} {"identity":12}: {len(body) / 1024:8.1f} KiB, encode {seconds * 1000:7.3f} ms')
+            for encoding in COMPRESSION_LEVELS:
+                for shared in (False, True):
+                    compressed = compress(body, encoding, shared)
+                    seconds = timeit.timeit(lambda: compress(body, encoding, shared), number=repeat) / repeat
+                    label = f'{encoding} {COMPRESSION_LEVELS[encoding][shared]}{" shared" if shared else ""}'
+                    print(f'{"":20} {label:12}: {len(compressed) / 1024:8.1f} KiB, compress {seconds * 1000:7.3f} ms, '
+                          f'{len(body) / len(compressed):5.1f}x smaller')
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
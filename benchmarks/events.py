@@ -0,0 +1,106 @@
+"""
+Benchmark break history ingestion per worker, in events per second.
+
+Posts batches of events to /events from concurrent in-process clients, and compares the write-behind
+writer (events queued in the request, inserted in batches by a background thread) against inserting
+and committing each request's events in the request itself. Uses a dedicated Postgres database, in
+which the schema is created if needed and a user and an exercise are added.
+
+Run from the project root with
+    python -m benchmarks.events --database-url postgresql:///movement_bench [--requests N] [--clients N]
+"""
+
+import argparse
+import threading
+import time
+
+from benchmarks.load import setup_app
+
+EVENTS_PER_REQUEST = 20
+
+# Seconds clients wait before retrying events refused with 503
+RETRY_DELAY = 0.05
+
+def post_events(app, user_id, exercise_id, requests, clients):
+    """
+    Post requests batches of events from clients threads, retrying refused batches like the timer does.
+
+    Returns elapsed seconds and the number of refused requests.
+    """
+
+    events = [{'kind': 'shown', 'exercise_id': exercise_id}] * (EVENTS_PER_REQUEST - 1) + [{'kind': 'work_completed'}]
+    per_client = requests // clients
+    refused = []
+
+    def run():
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+        for _ in range(per_client):
+            while client.post('/events', json={'events': events}).status_code == 503:
+                refused.append(1)
+                time.sleep(RETRY_DELAY)
+
+    threads = [threading.Thread(target=run) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, len(refused)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark break history ingestion')
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    app, db = setup_app(args.database_url)
+    from events import event_writer
+    from migrations import migrate
+    from models import User, Exercise, BreakEvent
+
+    with app.app_context():
+        migrate(db.engine)
+        user = User.query.first() or User(username='events', password_hash='x')
+        exercise = Exercise.query.first()
+        if exercise is None:
+            exercise = Exercise(name='event exercise', gif_url='', instructions=[])
+            db.session.add(exercise)
+        db.session.add(user)
+        db.session.commit()
+        user_id, exercise_id = user.id, exercise.id
+        db.session.execute(BreakEvent.__table__.delete())
+        db.session.commit()
+
+    # Write-behind: requests only queue events, the flush to the database is timed separately
+    elapsed, refused = post_events(app, user_id, exercise_id, args.requests, args.clients)
+    flush_start = time.perf_counter()
+    event_writer.close()
+    flush = time.perf_counter() - flush_start
+    stats = event_writer.stats()
+    events = args.requests // args.clients * args.clients * EVENTS_PER_REQUEST
+
+    # Synchronous: each request inserts and commits its events
+    def put_sync(rows):
+        db.session.execute(BreakEvent.__table__.insert(), rows)
+        db.session.commit()
+        return True
+
+    put = event_writer.put
+    event_writer.put = put_sync
+    try:
+        sync_elapsed, _ = post_events(app, user_id, exercise_id, args.requests, args.clients)
+    finally:
+        event_writer.put = put
+
+    print(f'{args.requests} requests of {EVENTS_PER_REQUEST} events from {args.clients} clients, '
+          f'batch size {app.config["EVENT_BATCH_SIZE"]}')
+    print(f'write-behind: {events / elapsed:8.0f} events/sec accepted, '
+          f'{stats["inserted"] / (elapsed + flush):8.0f} events/sec written '
+          f'({stats["batches"]} batches, {refused} requests refused and retried, {stats["failed"]} events failed)')
+    print(f'synchronous:  {events / sync_elapsed:8.0f} events/sec accepted and written')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+"""
+Load-testing benchmark for Movement Breaks.
+
+generate fills a dedicated Postgres database (all tables are dropped first) with a synthetic catalog and
+user base: exercises spread over ExerciseDB-sized equipment and target lists, users with skewed
+equipment, target and block distributions. run drives the Flask app with concurrent in-process clients
+and reports throughput, p50/p95/p99 latency and SQL statements per request for each endpoint. Results
+are saved as JSON, and compared against a previous result with --compare.
+
+Run from the project root, e.g.
+    python -m benchmarks.load generate --database-url postgresql:///movement_bench
+    python -m benchmarks.load run --database-url postgresql:///movement_bench --compare benchmarks/results/base.json
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+EQUIPMENT = 28
+TARGETS = 19
+PASSWORD = 'password'
+
+# Requests made by virtual users, with relative weights
+SCENARIOS = [
+    ('GET /exercises', 60),
+    ('GET /exercises?sample', 15),
+    ('GET /settings', 8),
+    ('POST /login', 7),
+    ('POST /users/<id>/block', 10),
+]
+
+# Regressions are reported when p95 latency grows or throughput drops by more than this fraction
+REGRESSION_THRESHOLD = 0.1
+
+def setup_app(database_url):
+    """Import app for database_url, returning app and db"""
+
+    os.environ['DATABASE_URL'] = database_url
+    from app import app
+    from models import db
+    app.config['WTF_CSRF_ENABLED'] = False
+    return app, db
+
+def skewed(count, rng):
+    """Return random index below count, biased towards low indexes"""
+
+    return int(count * rng.random() ** 2)
+
+def copy_rows(db, table, columns, rows, chunk_size=100000):
+    """Insert rows into table with COPY, in chunks"""
+
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        buf = io.StringIO()
+        count = 0
+        for row in rows:
+            buf.write('\t'.join(str(value) for value in row))
+            buf.write('\n')
+            count += 1
+            if count % chunk_size == 0:
+                buf.seek(0)
+                cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', buf)
+                buf = io.StringIO()
+        buf.seek(0)
+        cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', buf)
+        connection.commit()
+    finally:
+        connection.close()
+    return count
+
+def generate(args):
+    """Create synthetic catalog and users"""
+
+    os.environ.setdefault('DATABASE_STATEMENT_TIMEOUT', '0')
+    app, db = setup_app(args.database_url)
+    from loader import load_catalog
+    from passwords import hash_password
+
+    rng = random.Random(args.seed)
+    db.drop_all()
+    db.create_all()
+
+    start = time.perf_counter()
+    equipment = ['body weight'] + [f'equipment {idx}' for idx in range(1, EQUIPMENT)]
+    targets = [f'target {idx}' for idx in range(TARGETS)]
+    records = ({'id': f'{idx:05}',
+                'name': f'exercise {idx}',
+                'gifUrl': f'https://example.com/{idx:05}.gif',
+                'instructions': [f'Step {step} of exercise {idx}, keeping your core engaged throughout the movement.'
+                                 for step in range(1, rng.randint(3, 8))],
+                'equipment': equipment[skewed(EQUIPMENT, rng)],
+                'target': targets[rng.randrange(TARGETS)]}
+               for idx in range(args.exercises))
+    stats = load_catalog(records)
+    print(f"Loaded {stats['exercises']} exercises in {stats['seconds']:.1f}s")
+
+    # All users share one password hash, hashing a million passwords would take hours
+    password_hash = hash_password(PASSWORD)
+    users = copy_rows(db, 'users', ['id', 'username', 'password_hash', 'work_length', 'break_length'],
+                      ((idx, f'user{idx}', password_hash, 60, 5) for idx in range(1, args.users + 1)))
+    db.session.execute("SELECT setval('users_id_seq', :users)", {'users': users})
+    db.session.commit()
+
+    equipment_ids = [equip_id for (equip_id,) in db.session.execute('SELECT id FROM equipment ORDER BY id')]
+    target_ids = [target_id for (target_id,) in db.session.execute('SELECT id FROM targets ORDER BY id')]
+    exercise_ids = [exercise_id for (exercise_id,) in db.session.execute('SELECT id FROM exercises ORDER BY id')]
+
+    def preferences(ids, empty_share, most):
+        for user_id in range(1, users + 1):
+            if rng.random() >= empty_share:
+                for pref_id in {ids[skewed(len(ids), rng)] for _ in range(rng.randint(1, most))}:
+                    yield user_id, pref_id
+
+    def blocks():
+        for user_id in range(1, users + 1):
+            count = min(int(rng.expovariate(1 / args.mean_blocks)), 200)
+            for exercise_id in {exercise_ids[skewed(len(exercise_ids), rng)] for _ in range(count)}:
+                yield user_id, exercise_id
+
+    counts = {
+        'equipment_preferences': copy_rows(db, 'equipment_preferences', ['user_id', 'equipment_id'],
+                                           preferences(equipment_ids, 0.4, 4)),
+        'target_preferences': copy_rows(db, 'target_preferences', ['user_id', 'target_id'],
+                                        preferences(target_ids, 0.6, 3)),
+        'blocked_exercises': copy_rows(db, 'blocked_exercises', ['user_id', 'exercise_id'], blocks()),
+    }
+    db.session.execute('ANALYZE')
+    db.session.commit()
+
+    print(f'Created {users} users, ' + ', '.join(f'{count} {table}' for table, count in counts.items())
+          + f' in {time.perf_counter() - start:.1f}s')
+
+def percentile(ordered, q):
+    """Return q (0-1) percentile of sorted values"""
+
+    if not ordered:
+        return None
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+def run(args):
+    """Drive app with concurrent clients and save results"""
+
+    app, db = setup_app(args.database_url)
+    from sqlalchemy import event
+
+    with app.app_context():
+        users = db.session.execute('SELECT max(id) FROM users').scalar() or 0
+        exercise_ids = [exercise_id for (exercise_id,) in db.session.execute('SELECT id FROM exercises')]
+        db.session.remove()
+    if not users or not exercise_ids:
+        print('Database has no users or exercises, run generate first.')
+        sys.exit(1)
+
+    # SQL statements are counted per client thread
+    local = threading.local()
+
+    def before_cursor_execute(*args):
+        local.statements = getattr(local, 'statements', 0) + 1
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    names = [name for name, weight in SCENARIOS]
+    weights = [weight for name, weight in SCENARIOS]
+    samples = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.warmup + args.duration
+    measure_from = time.perf_counter() + args.warmup
+
+    def client(idx):
+        rng = random.Random(args.seed + idx)
+        client = app.test_client()
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                return
+
+            user_id = rng.randint(1, users)
+            name = rng.choices(names, weights)[0]
+            with client.session_transaction() as sess:
+                sess['user_id'] = user_id
+
+            local.statements = 0
+            start = time.perf_counter()
+            if name == 'GET /exercises':
+                response = client.get('/exercises')
+            elif name == 'GET /exercises?sample':
+                response = client.get(f'/exercises?sample=5&seed={rng.randrange(2 ** 31)}')
+            elif name == 'GET /settings':
+                response = client.get('/settings')
+            elif name == 'POST /login':
+                response = client.post('/login', data={'username': f'user{user_id}', 'password': PASSWORD})
+            else:
+                response = client.post(f'/users/{user_id}/block', json={'exercise_id': rng.choice(exercise_ids)})
+            elapsed = time.perf_counter() - start
+
+            if start >= measure_from:
+                with lock:
+                    samples[name].append((elapsed, local.statements))
+                    if response.status_code >= 400:
+                        errors[name] += 1
+
+    threads = [threading.Thread(target=client, args=(idx,)) for idx in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    endpoints = {}
+    for name in names:
+        latencies = sorted(elapsed for elapsed, statements in samples[name])
+        statements = [statements for elapsed, statements in samples[name]]
+        endpoints[name] = {
+            'requests': len(latencies),
+            'errors': errors[name],
+            'throughput': len(latencies) / args.duration,
+            'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else None,
+            'p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+            'p95_ms': percentile(latencies, 0.95) * 1000 if latencies else None,
+            'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+            'sql_per_request': sum(statements) / len(statements) if statements else None,
+        }
+
+    all_latencies = sorted(elapsed for name in names for elapsed, statements in samples[name])
+    result = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'clients': args.clients,
+            'duration': args.duration,
+            'users': users,
+            'exercises': len(exercise_ids),
+        },
+        'total': {
+            'requests': len(all_latencies),
+            'throughput': len(all_latencies) / args.duration,
+            'p50_ms': percentile(all_latencies, 0.5) * 1000 if all_latencies else None,
+            'p95_ms': percentile(all_latencies, 0.95) * 1000 if all_latencies else None,
+            'p99_ms': percentile(all_latencies, 0.99) * 1000 if all_latencies else None,
+        },
+        'endpoints': endpoints,
+    }
+
+    print_result(result)
+    output = args.output or os.path.join('benchmarks', 'results',
+                                         f"load-{result['meta']['timestamp'].replace(':', '')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as fp:
+        json.dump(result, fp, indent=2)
+    print(f'Saved results to {output}')
+
+    if args.compare:
+        with open(args.compare) as fp:
+            regressions = compare(json.load(fp), result)
+        if regressions:
+            sys.exit(1)
+
+def git_commit():
+    """Return current git commit, None outside a git checkout"""
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def format_ms(value):
+    return f'{value:8.2f}' if value is not None else '       -'
+
+def print_result(result):
+    """Print results table"""
+
+    print(f"{'endpoint':<26}{'reqs':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'sql/req':>9}{'errors':>8}")
+    for name, stats in result['endpoints'].items():
+        sql = f"{stats['sql_per_request']:9.2f}" if stats['sql_per_request'] is not None else '        -'
+        print(f"{name:<26}{stats['requests']:>8}{stats['throughput']:>9.1f} {format_ms(stats['p50_ms'])} "
+              f"{format_ms(stats['p95_ms'])} {format_ms(stats['p99_ms'])}{sql}{stats['errors']:>8}")
+    total = result['total']
+    print(f"{'total':<26}{total['requests']:>8}{total['throughput']:>9.1f} {format_ms(total['p50_ms'])} "
+          f"{format_ms(total['p95_ms'])} {format_ms(total['p99_ms'])}")
+
+def compare(baseline, result):
+    """Print changes from baseline result, returning list of regressed endpoints"""
+
+    print(f"\nCompared to {baseline['meta'].get('commit')} ({baseline['meta']['timestamp']}):")
+    regressions = []
+    for name, stats in result['endpoints'].items():
+        base = baseline['endpoints'].get(name)
+        if not base or not base['p95_ms'] or not stats['p95_ms'] or not base['throughput']:
+            continue
+        p95_change = stats['p95_ms'] / base['p95_ms'] - 1
+        throughput_change = stats['throughput'] / base['throughput'] - 1
+        regressed = p95_change > REGRESSION_THRESHOLD or throughput_change < -REGRESSION_THRESHOLD
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<26} p95 {p95_change:+7.1%}  throughput {throughput_change:+7.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load-testing benchmark for Movement Breaks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='create synthetic data, dropping all tables first')
+    generate_parser.add_argument('--database-url', required=True)
+    generate_parser.add_argument('--exercises', type=int, default=50000)
+    generate_parser.add_argument('--users', type=int, default=1000000)
+    generate_parser.add_argument('--mean-blocks', type=float, default=5)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.set_defaults(func=generate)
+
+    run_parser = subparsers.add_parser('run', help='drive app with concurrent clients')
+    run_parser.add_argument('--database-url', required=True)
+    run_parser.add_argument('--clients', type=int, default=8)
+    run_parser.add_argument('--duration', type=float, default=30, help='measured seconds')
+    run_parser.add_argument('--warmup', type=float, default=5, help='unmeasured seconds before measuring')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='results file, defaults to benchmarks/results/load-<timestamp>.json')
+    run_parser.add_argument('--compare', help='previous results file to compare against')
+    run_parser.set_defaults(func=run)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""
+Benchmark exercise recommendations for a 50,000 exercise catalog.
+
+Times recommend for an anonymous user and for a user with targets, blocked exercises and a full break
+history, with all exercises eligible (the worst case). No database is needed, exercises are built in memory.
+
+Run from the project root with python -m benchmarks.recommend [count] [repeat]
+"""
+
+import random
+import sys
+import timeit
+
+from benchmarks.serialize import build_catalog
+from models import UserContext, HISTORY_LIMIT
+from recommender import recommend, catalog_arrays
+
+def main(count=50000, repeat=1000):
+    catalog, _ = build_catalog(count)
+    mask = (1 << count) - 1
+    build = timeit.timeit(lambda: catalog_arrays(catalog), number=1)
+
+    rng = random.Random(1)
+    context = UserContext(None, [], [1, 2, 3], rng.sample(catalog.ids, 50),
+                          recent_ids=rng.sample(catalog.ids, HISTORY_LIMIT),
+                          skipped_ids=rng.sample(catalog.ids, HISTORY_LIMIT))
+    exclude = catalog.ids[:5]
+
+    anonymous = timeit.timeit(lambda: recommend(catalog, mask, 5, exclude=exclude), number=repeat) / repeat
+    history = timeit.timeit(lambda: recommend(catalog, mask, 5, context, exclude), number=repeat) / repeat
+
+    print(f'{count} exercises, {repeat} repeats, 5 exercises per recommendation')
+    print(f'catalog arrays (once per catalog version): {build * 1000:8.3f} ms')
+    print(f'anonymous:                                 {anonymous * 1000:8.3f} ms')
+    print(f'targets, blocks and history:               {history * 1000:8.3f} ms')
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
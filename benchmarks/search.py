@@ -0,0 +1,33 @@
+"""
+Benchmark exercise search on a 50,000 exercise catalog.
+
+Times building the search index (once per catalog version) and searching all exercises for queries
+matching few and many exercises. No database is needed, exercises are built in memory.
+
+Run from the project root with python -m benchmarks.search [count] [repeat]
+"""
+
+import sys
+import timeit
+
+from benchmarks.serialize import build_catalog
+from search import search, search_index
+
+QUERIES = ['exercise 1234', 'exercise 12', 'ex', 'back straight', 'squat']
+
+def main(count=50000, repeat=200):
+    catalog, _ = build_catalog(count)
+    mask = (1 << count) - 1
+    build = timeit.timeit(lambda: search_index(catalog), number=1)
+
+    print(f'{count} exercises, {repeat} repeats, 20 results per page')
+    print(f'index build (once per catalog version): {build * 1000:10.1f} ms')
+    for query in QUERIES:
+        elapsed = timeit.timeit(lambda: search(catalog, query, mask), number=repeat) / repeat
+        last_page = max(search(catalog, query, mask)[1] - 1, 0) // 20 * 20
+        last = timeit.timeit(lambda: search(catalog, query, mask, last_page), number=repeat) / repeat
+        print(f'{query!r:18} {search(catalog, query, mask)[1]:6} matches: first page {elapsed * 1000:7.3f} ms, '
+              f'last page {last * 1000:7.3f} ms')
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
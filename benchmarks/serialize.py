@@ -0,0 +1,58 @@
+"""
+Benchmark /exercises serialization cost per 1,000 exercises.
+
+Compares building the response with Exercise.serialize() and jsonify (before) against joining the
+catalog's pre-encoded fragments (after). No database is needed, exercises are built in memory.
+
+Run from the project root with python -m benchmarks.serialize [count] [repeat]
+"""
+
+import random
+import sys
+import timeit
+
+from app import app, exercises_response
+from catalog import Catalog, orjson
+from flask import jsonify
+from models import Equipment, Target, Exercise
+
+WORDS = ('your back hands feet knees hips shoulders arms legs core chest elbows wrists head spine floor bench '
+         'keep hold lift lower raise push pull bend straighten extend rotate squeeze breathe pause return repeat '
+         'slowly steadily fully straight flat tight relaxed upright forward backward up down towards away from '
+         'with and the a to of at in on for until while position starting top bottom side each').split()
+
+def build_catalog(count, seed=0):
+    """
+    Return (catalog, exercises) of count exercises with ExerciseDB-sized instructions, 4 to 8 sentences of
+    random words drawn with seed, so that they do not compress better than real ones
+    """
+
+    rng = random.Random(seed)
+    equipment = [Equipment(id=idx, name=f'equipment {idx}') for idx in range(1, 29)]
+    targets = [Target(id=idx, name=f'target {idx}') for idx in range(1, 20)]
+    exercises = [Exercise(id=idx, name=' '.join(rng.choices(WORDS, k=3)), gif_url=f'https://example.com/{idx:04}.gif',
+                          instructions=[' '.join(rng.choices(WORDS, k=rng.randint(8, 20))).capitalize() + '.'
+                                        for _ in range(rng.randint(4, 8))],
+                          equipment_id=idx % 28 + 1, target_id=idx % 19 + 1)
+                 for idx in range(1, count + 1)]
+    return Catalog(1, exercises, equipment, targets), exercises
+
+def main(count=1000, repeat=200):
+    catalog, exercises = build_catalog(count)
+    exercise_ids = catalog.ids
+
+    with app.test_request_context():
+        before = timeit.timeit(lambda: jsonify({'exercises_found': True,
+                                                'exercises': [exercise.serialize() for exercise in exercises]}),
+                               number=repeat) / repeat
+        after = timeit.timeit(lambda: exercises_response(catalog, exercise_ids, exercises_found=True),
+                              number=repeat) / repeat
+
+    scale = 1000 / count
+    print(f'{count} exercises, {repeat} repeats, encoder: {"orjson" if orjson else "json"}')
+    print(f'serialize + jsonify:  {before * scale * 1000:8.3f} ms per 1,000 exercises')
+    print(f'pre-encoded fragments: {after * scale * 1000:8.3f} ms per 1,000 exercises')
+    print(f'speedup:              {before / after:8.1f}x')
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,464 @@
+"""In-process exercise catalog cache for Movement Breaks"""
+
+import argparse
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+
+from models import db, CatalogVersion, Equipment, Target, Exercise
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BODYWEIGHT = 'body weight'
+
+# First bytes of catalog snapshot files, see Catalog.save
+SNAPSHOT_MAGIC = b'MBCATLG2'
+
+# Serialized exercises decoded through Catalog.exercises kept per catalog, least recently used dropped first
+DECODED_EXERCISES = 1000
+
+logger = logging.getLogger(__name__)
+
+MASK64 = (1 << 64) - 1
+
+def dumps(obj):
+    """Return obj encoded as compact JSON bytes, using orjson if installed"""
+
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf8')
+
+def loads(data):
+    """Return object decoded from JSON bytes or memoryview, using orjson if installed"""
+
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(bytes(data))
+
+def to_mask(positions):
+    """Return bitset with the given positions set"""
+
+    data = bytearray((max(positions) // 8 + 1) if positions else 0)
+    for pos in positions:
+        data[pos >> 3] |= 1 << (pos & 7)
+    return int.from_bytes(data, 'little')
+
+class Catalog:
+    """
+    Snapshot of Exercise, Equipment and Target rows at a given catalog version, held as columns.
+
+    Exercises are kept in id order, and an exercise's position is its index in every column: ids,
+    equipment_ids and target_ids (0 for none) are int64 arrays, and exercise pos is held only as its
+    serialized JSON, fragments[offsets[pos]:offsets[pos + 1] - 1], each followed by a comma so that
+    consecutive exercises are one slice of a JSON array, which responses join without re-encoding. Besides
+    the positions dict, no per-exercise Python objects are kept, so the columns can also be mapped from a
+    snapshot file (see save and open) that every worker on a host shares.
+    """
+
+    def __init__(self, version, exercises, equipment, targets):
+        exercises = sorted(exercises, key=lambda exercise: exercise.id)
+        fragments = [dumps(exercise.serialize()) for exercise in exercises]
+        offsets = array('Q', [0])
+        for fragment in fragments:
+            offsets.append(offsets[-1] + len(fragment) + 1)
+        self._set_columns(version,
+                          array('q', [exercise.id for exercise in exercises]),
+                          array('q', [exercise.equipment_id or 0 for exercise in exercises]),
+                          array('q', [exercise.target_id or 0 for exercise in exercises]),
+                          offsets, memoryview(b''.join(fragment + b',' for fragment in fragments)),
+                          [(equip.id, equip.name) for equip in equipment],
+                          [(target.id, target.name) for target in targets])
+
+    def _set_columns(self, version, ids, equipment_ids, target_ids, offsets, fragments, equipment, targets):
+        self.version = version
+        self.ids = ids
+        self.equipment_ids = equipment_ids
+        self.target_ids = target_ids
+        self.offsets = offsets
+        self.fragments = fragments
+        self.positions = dict(zip(ids, range(len(ids))))
+        # Serialized exercises by id, decoded on access
+        self.exercises = Exercises(self)
+
+        # (id, name) pairs, used for settings form choices
+        self.equipment = equipment
+        self.targets = targets
+
+        # Exercise positions indexed by (equipment_id, target_id) and by equipment_id alone, held as bitsets
+        # so that a user's eligible set is a few integer unions
+        pairs = {}
+        for pos, key in enumerate(zip(equipment_ids, target_ids)):
+            pairs.setdefault(key, []).append(pos)
+        self.pair_index = {(equip_id or None, target_id or None): to_mask(positions)
+                           for (equip_id, target_id), positions in pairs.items()}
+        self.equipment_index = {}
+        for (equip_id, target_id), mask in self.pair_index.items():
+            self.equipment_index[equip_id] = self.equipment_index.get(equip_id, 0) | mask
+
+        self.bodyweight_id = next((equip_id for equip_id, name in self.equipment if name == BODYWEIGHT), None)
+        self.bodyweight_ids = self.ids_from_mask(self.equipment_index.get(self.bodyweight_id, 0))
+
+    def fragment(self, exercise_id):
+        """Return serialized exercise encoded as JSON"""
+
+        pos = self.positions[exercise_id]
+        return self.fragments[self.offsets[pos]:self.offsets[pos + 1] - 1]
+
+    def preference_mask(self, equip_ids, target_ids):
+        """Return bitset of exercises matching any of equip_ids and any of target_ids (if given)"""
+
+        mask = 0
+        if target_ids:
+            for equip_id in equip_ids:
+                for target_id in target_ids:
+                    mask |= self.pair_index.get((equip_id, target_id), 0)
+        else:
+            for equip_id in equip_ids:
+                mask |= self.equipment_index.get(equip_id, 0)
+        return mask
+
+    def exercise_mask(self, exercise_ids):
+        """Return bitset of the given exercises, ignoring ids not in the catalog"""
+
+        return to_mask([self.positions[exercise_id] for exercise_id in exercise_ids if exercise_id in self.positions])
+
+    def eligible_mask(self, equip_ids, target_ids, blocked_ids):
+        """
+        Return bitset of exercises matching any of equip_ids, any of target_ids (if given),
+        and not in blocked_ids
+        """
+
+        return self.preference_mask(equip_ids, target_ids) & ~self.exercise_mask(blocked_ids)
+
+    def ids_from_mask(self, mask, offset=0, limit=None):
+        """Return exercise ids, in id order, for positions set in mask, skipping offset ids and up to limit ids"""
+
+        ids = []
+        data = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+        for byte_idx, byte in enumerate(data):
+            if offset:
+                # Skip whole bytes while they are within offset
+                count = byte.bit_count()
+                if count <= offset:
+                    offset -= count
+                    continue
+                while offset:
+                    byte &= byte - 1
+                    offset -= 1
+            while byte:
+                low = byte & -byte
+                ids.append(self.ids[byte_idx * 8 + low.bit_length() - 1])
+                byte ^= low
+            if limit is not None and len(ids) >= limit:
+                return ids[:limit]
+        return ids
+
+    def encode_exercises(self, exercise_ids, prefix=b'', suffix=b''):
+        """
+        Return JSON array of serialized exercises, joined from pre-encoded fragments.
+
+        Runs of exercises at consecutive positions, such as the whole catalog, are sliced from fragments at
+        once. prefix and suffix are added around the array within the same join, so that large responses
+        are only copied once.
+        """
+
+        if not exercise_ids:
+            return prefix + b'[]' + suffix
+        offsets, fragments = self.offsets, self.fragments
+        parts = [prefix + b'[']
+        start = end = -1
+        for pos in map(self.positions.__getitem__, exercise_ids):
+            if pos == end:
+                end += 1
+                continue
+            if start >= 0:
+                parts.append(fragments[offsets[start]:offsets[end]])
+            start, end = pos, pos + 1
+        # Without the comma after the last exercise
+        parts.append(fragments[offsets[start]:offsets[end] - 1])
+        parts.append(b']' + suffix)
+        return b''.join(parts)
+
+    @classmethod
+    def load(cls, version):
+        """
+        Return catalog at version, mapped from the CATALOG_SNAPSHOT file if it was written at that version,
+        loaded from the database otherwise
+        """
+
+        path = db.get_app().config.get('CATALOG_SNAPSHOT')
+        if path and os.path.exists(path):
+            try:
+                catalog = cls.open(path)
+            except (OSError, ValueError):
+                logger.exception('Could not open catalog snapshot %s', path)
+            else:
+                if catalog.version == version:
+                    return catalog
+        return cls.from_database(version)
+
+    @classmethod
+    def from_database(cls, version):
+        """Load catalog from database"""
+
+        exercises = Exercise.query.filter_by(retired=False).order_by(Exercise.id).all()
+        equipment = Equipment.query.order_by(Equipment.id).all()
+        targets = Target.query.order_by(Target.id).all()
+        return cls(version, exercises, equipment, targets)
+
+    def save(self, path):
+        """
+        Write catalog to snapshot file at path, replacing any previous snapshot atomically.
+
+        The file is a header (SNAPSHOT_MAGIC, then the length of a JSON object with the version, exercise
+        count, equipment and targets), then the columns, each starting at a multiple of 8 bytes. Columns are
+        in native byte order, snapshots are meant for the host that wrote them.
+        """
+
+        header = dumps({'version': self.version, 'count': len(self.ids), 'byteorder': sys.byteorder,
+                        'equipment': self.equipment, 'targets': self.targets})
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.catalog-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(SNAPSHOT_MAGIC + struct.pack('<Q', len(header)) + header)
+                for column in (self.ids, self.equipment_ids, self.target_ids, self.offsets, self.fragments):
+                    fp.write(b'\0' * (-fp.tell() % 8))
+                    fp.write(column)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    @classmethod
+    def open(cls, path):
+        """Return catalog mapped from snapshot file at path, see save, raising ValueError if it is not one"""
+
+        with open(path, 'rb') as fp:
+            data = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+        if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not a catalog snapshot')
+        pos = len(SNAPSHOT_MAGIC) + 8
+        (length,) = struct.unpack('<Q', data[len(SNAPSHOT_MAGIC):pos])
+        header = json.loads(bytes(data[pos:pos + length]))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was written on a host with another byte order')
+        pos += length
+
+        def column(fmt, size):
+            nonlocal pos
+            pos += -pos % 8
+            view = data[pos:pos + size * 8].cast(fmt)
+            pos += size * 8
+            return view
+
+        count = header['count']
+        ids, equipment_ids, target_ids = column('q', count), column('q', count), column('q', count)
+        offsets = column('Q', count + 1)
+        pos += -pos % 8
+        fragments = data[pos:pos + offsets[-1]]
+        if len(fragments) != offsets[-1]:
+            raise ValueError(f'{path} is truncated')
+
+        catalog = cls.__new__(cls)
+        catalog._set_columns(header['version'], ids, equipment_ids, target_ids, offsets, fragments,
+                             [tuple(pair) for pair in header['equipment']],
+                             [tuple(pair) for pair in header['targets']])
+        return catalog
+
+
+class Exercises(Mapping):
+    """
+    Serialized exercises of a catalog by id, decoded from their JSON fragments on access.
+
+    The last DECODED_EXERCISES exercises accessed are kept decoded, and the same dict is returned while
+    one is kept, so callers must not modify it. Code going through every exercise, such as the search
+    index, decodes fragments itself rather than filling the cache.
+    """
+
+    def __init__(self, catalog):
+        self._catalog = catalog
+        self._decoded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, exercise_id):
+        with self._lock:
+            exercise = self._decoded.get(exercise_id)
+            if exercise is not None:
+                self._decoded.move_to_end(exercise_id)
+                return exercise
+        exercise = loads(self._catalog.fragment(exercise_id))
+        with self._lock:
+            # Exercises decoded at once by several threads are equal, any one is kept
+            exercise = self._decoded.setdefault(exercise_id, exercise)
+            while len(self._decoded) > DECODED_EXERCISES:
+                self._decoded.popitem(last=False)
+        return exercise
+
+    def __contains__(self, exercise_id):
+        return exercise_id in self._catalog.positions
+
+    def __iter__(self):
+        return iter(self._catalog.ids)
+
+    def __len__(self):
+        return len(self._catalog.ids)
+
+
+class CatalogCache:
+    """
+    Per-worker cache of the exercise catalog.
+
+    The catalog version stored in the database is checked at most once every
+    CATALOG_CHECK_INTERVAL seconds, and the catalog is only reloaded when that version changes. Searches are
+    served from the newest catalog whose search index is built, see get_searchable.
+    """
+
+    def __init__(self):
+        self._catalog = None
+        self._searchable = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def get(self):
+        """Return current catalog, loading or reloading it if needed"""
+
+        catalog = self._catalog
+        interval = db.get_app().config.get('CATALOG_CHECK_INTERVAL', 5)
+        if catalog and time.monotonic() - self._checked_at < interval:
+            self.hits += 1
+            return catalog
+
+        with self._lock:
+            version = CatalogVersion.current()
+            self._checked_at = time.monotonic()
+            catalog = self._catalog
+
+            if catalog and catalog.version == version:
+                self.hits += 1
+                return catalog
+
+            if catalog:
+                self.reloads += 1
+            else:
+                self.misses += 1
+            self._catalog = Catalog.load(version)
+            return self._catalog
+
+    def get_searchable(self):
+        """
+        Return current catalog if its search index is built, otherwise start building it in the background
+        and return the newest catalog whose index is built, so that no request waits for a reloaded catalog's
+        index. The index is only built synchronously if there is no such catalog.
+        """
+        # search imports this module
+        from search import build_search_index, has_search_index, search_index
+
+        catalog = self.get()
+        searchable = self._searchable
+        if has_search_index(catalog) or searchable is None:
+            search_index(catalog)
+            self._searchable = catalog
+            return catalog
+
+        build_search_index(catalog)
+        return searchable
+
+    def clear(self):
+        """Drop cached catalog so that it is loaded again on next access"""
+
+        with self._lock:
+            self._catalog = None
+            self._searchable = None
+            self._checked_at = 0
+
+    def stats(self):
+        """Return cache counters"""
+
+        return {'version': self._catalog.version if self._catalog else None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads}
+
+
+catalog_cache = CatalogCache()
+
+def get_catalog():
+    """Return current exercise catalog"""
+
+    return catalog_cache.get()
+
+def get_searchable_catalog():
+    """Return newest exercise catalog whose search index is built, see CatalogCache.get_searchable"""
+
+    return catalog_cache.get_searchable()
+
+def update_snapshot(path=None):
+    """
+    Write the catalog at the current catalog version to snapshot file path (by default CATALOG_SNAPSHOT),
+    returning the path, None if there is none to write.
+
+    Run after changing the catalog (seed_db.py, loader.py and media.py do), so that workers map the
+    snapshot instead of each loading the new version from the database.
+    """
+
+    path = path or db.get_app().config.get('CATALOG_SNAPSHOT')
+    if path:
+        Catalog.from_database(CatalogVersion.current()).save(path)
+    return path
+
+def shuffle_key(seed, exercise_id):
+    """Return position of exercise in the random order determined by seed (splitmix64 of id and seed)"""
+
+    z = (exercise_id + seed * 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+def sample_page(exercise_ids, size, seed, cursor=None):
+    """
+    Return page of size exercise ids in the random order determined by seed, and cursor for the next page.
+
+    Each exercise's position only depends on its id and seed, so later pages are unaffected by exercises
+    being blocked in between requests. cursor is the position of the last exercise of the previous page,
+    next cursor is None once all exercises have been returned.
+    """
+
+    keyed = [(shuffle_key(seed, exercise_id), exercise_id) for exercise_id in exercise_ids]
+    if cursor is not None:
+        keyed = [item for item in keyed if item[0] > cursor]
+
+    page = heapq.nsmallest(size, keyed)
+    next_cursor = page[-1][0] if len(keyed) > size else None
+    return [exercise_id for key, exercise_id in page], next_cursor
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write catalog snapshot file')
+    parser.add_argument('path', nargs='?', help='snapshot file, CATALOG_SNAPSHOT by default')
+    args = parser.parse_args(argv)
+
+    from app import app
+    with app.app_context():
+        path = update_snapshot(args.path)
+    if path is None:
+        parser.error('set CATALOG_SNAPSHOT or give a path')
+    print(f'Wrote catalog snapshot {path}')
+
+if __name__ == '__main__':
+    main()
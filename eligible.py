@@ -0,0 +1,128 @@
+"""Per-user materialized eligible-exercise sets for Movement Breaks"""
+
+import threading
+from collections import OrderedDict
+
+from models import db
+
+class EligibleSet:
+    """
+    A user's eligible exercises as of a catalog version and preferences version.
+
+    mask is the bitset of exercises matching the user's equipment and target preferences minus
+    blocked exercises, blocked is the bitset of blocked exercises. Both are positions in the catalog.
+    """
+
+    __slots__ = ('catalog_version', 'preferences_version', 'mask', 'blocked')
+
+    def __init__(self, catalog_version, preferences_version, mask, blocked):
+        self.catalog_version = catalog_version
+        self.preferences_version = preferences_version
+        self.mask = mask
+        self.blocked = blocked
+
+
+class EligibleCache:
+    """
+    Size-bounded LRU cache of EligibleSet by user id.
+
+    Entries are checked against the catalog version and the user's preferences version, so entries
+    written by another worker's change_settings or block_exercise are never served stale.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry:
+                self._entries.move_to_end(user_id)
+            return entry
+
+    def _put(self, user_id, entry):
+        maxsize = db.get_app().config.get('ELIGIBLE_CACHE_SIZE', 10000)
+        with self._lock:
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+
+    def get(self, context, catalog):
+        """Return bitset of eligible exercises in catalog for user in UserContext, computing it on a miss"""
+
+        user = context.user
+        entry = self._get(user.id)
+        if (entry and entry.catalog_version == catalog.version
+                and entry.preferences_version == user.preferences_version):
+            self.hits += 1
+            return entry.mask
+
+        self.misses += 1
+        equip_ids = context.equipment_ids or [catalog.bodyweight_id]
+        blocked = catalog.exercise_mask(context.blocked_ids)
+        entry = EligibleSet(catalog.version, user.preferences_version,
+                            catalog.preference_mask(equip_ids, context.target_ids) & ~blocked, blocked)
+        self._put(user.id, entry)
+        return entry.mask
+
+    def update_preferences(self, user_id, catalog, equip_ids, target_ids, preferences_version):
+        """
+        Write through new equipment/target preferences, reusing the cached blocked exercises.
+
+        preferences_version is the version saved with the new preferences. As with block, the cached entry is
+        only updated if it is the version directly preceding it.
+        """
+
+        entry = self._get(user_id)
+        if (not entry or entry.catalog_version != catalog.version
+                or entry.preferences_version != preferences_version - 1):
+            self.discard(user_id)
+            return
+
+        equip_ids = equip_ids or [catalog.bodyweight_id]
+        self._put(user_id, EligibleSet(catalog.version, preferences_version,
+                                       catalog.preference_mask(equip_ids, target_ids) & ~entry.blocked,
+                                       entry.blocked))
+
+    def block(self, user_id, catalog, exercise_ids, preferences_version):
+        """
+        Write through newly blocked exercises.
+
+        The cached entry is only updated if it is the version directly preceding preferences_version,
+        otherwise another change was made elsewhere and the entry is dropped.
+        """
+
+        entry = self._get(user_id)
+        if (not entry or entry.catalog_version != catalog.version
+                or entry.preferences_version != preferences_version - 1):
+            self.discard(user_id)
+            return
+
+        blocked = entry.blocked | catalog.exercise_mask(exercise_ids)
+        self._put(user_id, EligibleSet(catalog.version, preferences_version, entry.mask & ~blocked, blocked))
+
+    def discard(self, user_id):
+        """Drop user's cached entry"""
+
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Drop all cached entries"""
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return cache counters"""
+
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+eligible_cache = EligibleCache()
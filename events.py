@@ -0,0 +1,161 @@
+"""
+Write-behind break history for Movement Breaks.
+
+Break history events (work and break cycles completed, exercises shown, skipped and blocked) are put on a
+bounded in-process buffer and inserted by a background thread, in batches of up to EVENT_BATCH_SIZE
+events or every EVENT_FLUSH_INTERVAL seconds, so recording them adds no commit to the request path.
+Once EVENT_QUEUE_SIZE events are waiting, further events are refused so that clients back off.
+Waiting events are flushed when the worker exits.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+# Events sent by the timer, blocks are recorded by the server when they are made
+CLIENT_KINDS = ('work_completed', 'break_completed', 'shown', 'skipped')
+EXERCISE_KINDS = ('shown', 'skipped', 'blocked')
+
+logger = logging.getLogger(__name__)
+
+def parse_events(events, exercise_ids):
+    """
+    Return (kind, exercise_id) pairs of events posted by the timer, raising ValueError if any is invalid.
+
+    Each event is a dict with kind, one of CLIENT_KINDS, and for exercise events the id of an exercise
+    in exercise_ids.
+    """
+
+    if not isinstance(events, list):
+        raise ValueError('events must be a list of events')
+    parsed = []
+    for event in events:
+        if not isinstance(event, dict) or event.get('kind') not in CLIENT_KINDS:
+            raise ValueError(f'kind must be one of {", ".join(CLIENT_KINDS)}')
+        exercise_id = event.get('exercise_id')
+        if event['kind'] in EXERCISE_KINDS:
+            # bool is a subclass of int, but true is not an exercise id
+            if type(exercise_id) is not int or exercise_id not in exercise_ids:
+                raise ValueError(f'{event["kind"]} events need the id of an exercise')
+        elif exercise_id is not None:
+            raise ValueError(f'{event["kind"]} events have no exercise')
+        parsed.append((event['kind'], exercise_id))
+    return parsed
+
+
+class EventWriter:
+    """Buffer of break_events rows, inserted in batches by a background thread started on first use"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._buffer = []
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._registered = False
+        self.enqueued = 0
+        self.inserted = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+
+    def _config(self):
+        from models import db
+        config = db.get_app().config
+        return (config.get('EVENT_QUEUE_SIZE', 10000), config.get('EVENT_BATCH_SIZE', 500),
+                config.get('EVENT_FLUSH_INTERVAL', 1.0))
+
+    def _start(self):
+        """Start flusher thread of this process, called with the lock held"""
+
+        from models import db
+        app = db.get_app()
+        with app.app_context():
+            engine = db.engine
+
+        # Threads are not inherited by forked workers, events buffered before the fork belong to the parent
+        if self._pid != os.getpid():
+            self._buffer = []
+        self._pid = os.getpid()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, args=(engine,) + self._config()[1:],
+                                        name='event-writer', daemon=True)
+        self._thread.start()
+        if not self._registered:
+            atexit.register(self.close)
+            self._registered = True
+
+    def put(self, rows):
+        """Buffer break_events rows for insertion, returning False if the buffer is full"""
+
+        max_size = self._config()[0]
+        with self._cond:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._start()
+            if self._stopping or len(self._buffer) + len(rows) > max_size:
+                self.dropped += len(rows)
+                return False
+            self._buffer.extend(rows)
+            self.enqueued += len(rows)
+            self._cond.notify()
+        return True
+
+    def _run(self, engine, batch_size, flush_interval):
+        from models import BreakEvent
+
+        insert = BreakEvent.__table__.insert()
+        while True:
+            with self._cond:
+                # Wait for a full batch, the flush interval to pass since the first buffered event, or shutdown
+                deadline = None
+                while len(self._buffer) < batch_size and not self._stopping:
+                    if self._buffer and deadline is None:
+                        deadline = time.monotonic() + flush_interval
+                    timeout = deadline - time.monotonic() if deadline else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                batch = self._buffer[:batch_size]
+                del self._buffer[:batch_size]
+                done = self._stopping and not self._buffer
+
+            if batch:
+                try:
+                    with engine.begin() as connection:
+                        connection.execute(insert, batch)
+                    self.inserted += len(batch)
+                    self.batches += 1
+                except Exception:
+                    logger.exception('Could not insert %d break events', len(batch))
+                    self.failed += len(batch)
+            if done:
+                return
+
+    def close(self, timeout=10):
+        """
+        Flush buffered events and stop the flusher thread, which restarts on the next put.
+
+        If the thread is still flushing after timeout seconds, it is left to finish, and events put
+        meanwhile are refused rather than handed to a second flusher.
+        """
+
+        with self._cond:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._stopping = True
+            self._cond.notify()
+        thread.join(timeout)
+        with self._cond:
+            if not thread.is_alive():
+                self._thread = None
+                self._stopping = False
+
+    def stats(self):
+        return {'enqueued': self.enqueued, 'inserted': self.inserted, 'dropped': self.dropped,
+                'failed': self.failed, 'batches': self.batches, 'pending': len(self._buffer)}
+
+
+event_writer = EventWriter()
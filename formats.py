@@ -0,0 +1,139 @@
+"""
+Wire formats of Movement Breaks responses.
+
+Exercise responses are JSON, or MessagePack for clients whose Accept header prefers it. Both are joined
+from per-exercise fragments encoded once per catalog: the catalog's JSON fragments, and MessagePack
+fragments made from them on the first MessagePack request.
+
+JSON and MessagePack responses of at least COMPRESS_MIN_SIZE bytes are compressed with brotli or gzip, as
+the client's Accept-Encoding allows (compress_response). Bodies that are the same for many users, such as
+every body weight exercise, are kept per catalog along with their compressed copies (shared_body), so
+that they are encoded and compressed once per catalog version, at higher compression levels than bodies
+compressed per request.
+"""
+
+import gzip
+import threading
+import weakref
+
+import brotli
+import msgpack
+
+from catalog import dumps, loads
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# Accepted names of MessagePack, responses use MSGPACK
+MSGPACK_TYPES = (MSGPACK, 'application/x-msgpack', 'application/vnd.msgpack')
+
+# Content-Encoding: (level per request, level for shared bodies), in order of preference. Per request
+# levels are the fastest not losing much size, shared levels stop short of brotli's 10 and 11, which take
+# seconds for a large body and would hold up the request first compressing it
+COMPRESSION_LEVELS = {'br': (1, 9), 'gzip': (4, 9)}
+
+def response_format(accept_mimetypes):
+    """Return mimetype of exercise responses for the request's Accept header, JSON unless MessagePack is preferred"""
+
+    return MSGPACK if accept_mimetypes.best_match((JSON,) + MSGPACK_TYPES, JSON) in MSGPACK_TYPES else JSON
+
+_msgpack_fragments = weakref.WeakKeyDictionary()
+_msgpack_fragments_lock = threading.Lock()
+
+def msgpack_fragments(catalog):
+    """Return list of serialized exercises of catalog encoded as MessagePack, by position, made on first use"""
+
+    fragments = _msgpack_fragments.get(catalog)
+    if fragments is None:
+        with _msgpack_fragments_lock:
+            fragments = _msgpack_fragments.get(catalog)
+            if fragments is None:
+                fragments = _msgpack_fragments[catalog] = [msgpack.packb(loads(catalog.fragment(exercise_id)))
+                                                           for exercise_id in catalog.ids]
+    return fragments
+
+def exercises_body(catalog, exercise_ids, mimetype, fields):
+    """Return body in mimetype of a map of fields, then exercises, joined from pre-encoded exercises"""
+
+    if mimetype == MSGPACK:
+        fragments, positions = msgpack_fragments(catalog), catalog.positions
+        packer = msgpack.Packer()
+        parts = [packer.pack_map_header(len(fields) + 1)]
+        for key, value in fields.items():
+            parts += [packer.pack(key), packer.pack(value)]
+        parts += [packer.pack('exercises'), packer.pack_array_header(len(exercise_ids))]
+        parts += [fragments[positions[exercise_id]] for exercise_id in exercise_ids]
+        return b''.join(parts)
+
+    prefix = b''.join([dumps(key) + b':' + dumps(value) + b',' for key, value in fields.items()])
+    return catalog.encode_exercises(exercise_ids, prefix=b'{' + prefix + b'"exercises":', suffix=b'}')
+
+def accepted_encoding(accept_encodings, encodings=tuple(COMPRESSION_LEVELS)):
+    """
+    Return the Content-Encoding of encodings the request's Accept-Encoding header gives the highest q-value,
+    the earliest in encodings among equals, None for identity if it accepts none of them (q=0 refuses one)
+    """
+
+    qualities = [(accept_encodings[encoding], -idx, encoding) for idx, encoding in enumerate(encodings)]
+    quality, _, encoding = max(qualities, default=(0, 0, None))
+    return encoding if quality > 0 else None
+
+def compress(data, encoding, shared=False):
+    """Return data compressed with encoding, at the higher level of shared bodies if shared"""
+
+    level = COMPRESSION_LEVELS[encoding][shared]
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, level, mtime=0)
+
+
+class SharedBody:
+    """Response body the same for many users, with its compressed copies made on first use"""
+
+    def __init__(self, data):
+        self.data = data
+        self.compressed = {}
+
+    def compress(self, encoding):
+        data = self.compressed.get(encoding)
+        if data is None:
+            data = self.compressed[encoding] = compress(self.data, encoding, shared=True)
+        return data
+
+
+_shared_bodies = weakref.WeakKeyDictionary()
+_shared_bodies_lock = threading.Lock()
+
+def shared_body(catalog, key, encode):
+    """Return SharedBody identified by key, with data returned by encode() on first use for catalog"""
+
+    with _shared_bodies_lock:
+        bodies = _shared_bodies.setdefault(catalog, {})
+    body = bodies.get(key)
+    if body is None:
+        # Bodies encoded at once by several threads are equal, any one is kept
+        body = bodies.setdefault(key, SharedBody(encode()))
+    return body
+
+def compress_response(response, accept_encodings, min_size):
+    """
+    Compress body of JSON or MessagePack response of at least min_size bytes (None to disable) as
+    accept_encodings, the request's Accept-Encoding header, allows, returning response.
+
+    The compressed copies of response.shared_body, if set, are used. ETags are left as they are: responses
+    that may be compressed should carry weak ETags, as the compressed body is not byte for byte the one they
+    were computed for, and their 304s the same ones.
+    """
+
+    if (min_size is None or response.mimetype not in (JSON, MSGPACK) or response.status_code != 200
+            or response.direct_passthrough or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+
+    encoding = accepted_encoding(accept_encodings)
+    if encoding is None or (response.content_length or 0) < min_size:
+        return response
+    shared = getattr(response, 'shared_body', None)
+    response.set_data(shared.compress(encoding) if shared else compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,44 @@
+"""
+Gunicorn settings for Movement Breaks, read by gunicorn from the working directory.
+
+The app is loaded once in the master process, which also loads the exercise catalog and the search and
+recommendation indexes built from it (app.warm_caches) before forking workers, so that workers start with
+them already loaded and share their memory copy-on-write. Workers still reload the catalog themselves when
+its version changes.
+
+Workers are threaded (gthread): a request waiting on the bcrypt process pool (see passwords.py), on the
+database or on a catalog reload only holds its own thread, where a sync worker would stop serving
+altogether until it returned. Keep DATABASE_POOL_SIZE plus DATABASE_MAX_OVERFLOW at least WEB_THREADS.
+
+WEB_CONCURRENCY sets the number of workers, WEB_THREADS the threads per worker, PORT the port, and PRELOAD=0
+loads the app in each worker instead.
+"""
+
+import gc
+import os
+
+wsgi_app = 'app:create_app()'
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+preload_app = os.environ.get('PRELOAD', '1') == '1'
+
+def when_ready(server):
+    """Load caches in the master, after the app is loaded and before workers are forked"""
+
+    if preload_app:
+        from app import warm_caches
+        try:
+            warm_caches(server.app.wsgi())
+        except Exception:
+            # Workers load what they need on first use instead
+            server.log.exception('Could not load caches before forking workers')
+        # Keep the collector from touching, and so copying, objects loaded before the fork
+        gc.freeze()
+
+def worker_exit(server, worker):
+    """Write break history events still waiting in the exiting worker"""
+
+    from events import event_writer
+    event_writer.close()
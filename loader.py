@@ -0,0 +1,285 @@
+"""
+Bulk exercise catalog loader for Movement Breaks.
+
+Loads ExerciseDB exercises from a local JSON array or newline-delimited JSON dump, so the catalog
+can be seeded without the RapidAPI endpoint. With --sync, an existing catalog is updated in place
+from the dump, leaving user data untouched.
+
+Run with python loader.py DUMP [--sync] [--batch-size N]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+from sqlalchemy import bindparam, case
+
+from models import db, Equipment, Target, Exercise, CatalogVersion
+from catalog import update_snapshot
+from migrations import migrate
+
+SEPARATORS = ' \t\r\n,'
+
+def iter_records(fp, chunk_size=1 << 16):
+    """Yield records from a JSON array or newline-delimited JSON file, reading it in chunks"""
+
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    in_array = None
+
+    while True:
+        while pos < len(buf) and buf[pos] in SEPARATORS:
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                return
+            buf = fp.read(chunk_size)
+            pos = 0
+            eof = not buf
+            continue
+
+        if in_array is None:
+            in_array = buf[pos] == '['
+            if in_array:
+                pos += 1
+                continue
+        if in_array and buf[pos] == ']':
+            return
+
+        try:
+            record, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # Record continues past the end of the buffer
+            if eof:
+                raise
+            more = fp.read(chunk_size)
+            eof = not more
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        yield record
+
+
+class NameMap:
+    """Map of Equipment or Target names to ids, inserting names that do not exist yet"""
+
+    def __init__(self, model):
+        self.model = model
+        self.ids = dict(db.session.query(model.name, model.id))
+        self.inserted = 0
+
+    def __getitem__(self, name):
+        if name not in self.ids:
+            self.ids[name] = db.session.execute(
+                self.model.__table__.insert().values(name=name).returning(self.model.id)).scalar()
+            self.inserted += 1
+        return self.ids[name]
+
+
+def content_hash(record):
+    """Return hash of the fields of an ExerciseDB record that are stored in the catalog"""
+
+    content = [record['name'], record['gifUrl'], record['instructions'], record['equipment'], record['target']]
+    return hashlib.sha256(json.dumps(content, separators=(',', ':')).encode('utf8')).hexdigest()
+
+def exercise_row(record, equipment, targets):
+    """Return exercises table row for an ExerciseDB record"""
+
+    return {'name': record['name'],
+            'gif_url': record['gifUrl'],
+            'instructions': record['instructions'],
+            'equipment_id': equipment[record['equipment']],
+            'target_id': targets[record['target']],
+            'source_id': record.get('id'),
+            'content_hash': content_hash(record),
+            'retired': False}
+
+def load_catalog(records, batch_size=1000):
+    """
+    Insert exercise records into an empty catalog in batches, and bump the catalog version.
+
+    Equipment and targets are resolved from in-memory name maps, creating any that are missing.
+    Returns dict with counts and rows per second.
+    """
+
+    if db.session.query(Exercise.id).first():
+        raise ValueError('Exercise catalog is not empty.')
+
+    start = time.perf_counter()
+    equipment = NameMap(Equipment)
+    targets = NameMap(Target)
+    insert = Exercise.__table__.insert()
+    rows = 0
+    batch = []
+
+    for record in records:
+        batch.append(exercise_row(record, equipment, targets))
+        if len(batch) >= batch_size:
+            db.session.execute(insert, batch)
+            rows += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(insert, batch)
+        rows += len(batch)
+
+    CatalogVersion.bump()
+    db.session.commit()
+
+    seconds = time.perf_counter() - start
+    return {'exercises': rows,
+            'equipment': equipment.inserted,
+            'targets': targets.inserted,
+            'seconds': seconds,
+            'rows_per_sec': rows / seconds if seconds else 0}
+
+def sync_catalog(records, batch_size=1000):
+    """
+    Apply differences between exercise records and the existing catalog.
+
+    Exercises are matched on ExerciseDB id, or on name for exercises loaded without one. New records are
+    inserted, records whose content hash changed are updated, and exercises missing from records are
+    retired. Changes are written in batches of batch_size, each in its own transaction, and the catalog
+    version is bumped if anything changed, in the transaction of the last batch. If the sync fails part way,
+    the version is still bumped for the batches already written. Returns dict with counts and rows per second.
+    """
+
+    start = time.perf_counter()
+    equipment = NameMap(Equipment)
+    targets = NameMap(Target)
+
+    by_source = {}
+    by_name = {}
+    for exercise_id, source_id, name, stored_hash, retired in db.session.query(
+            Exercise.id, Exercise.source_id, Exercise.name, Exercise.content_hash, Exercise.retired):
+        if source_id is None:
+            by_name[name] = (exercise_id, stored_hash, retired)
+        else:
+            by_source[source_id] = (exercise_id, stored_hash, retired)
+
+    insert = Exercise.__table__.insert()
+    update = (Exercise.__table__.update()
+              .where(Exercise.id == bindparam('_id'))
+              .values(name=bindparam('name'), gif_url=bindparam('gif_url'),
+                      instructions=bindparam('instructions'), equipment_id=bindparam('equipment_id'),
+                      target_id=bindparam('target_id'), source_id=bindparam('source_id'),
+                      content_hash=bindparam('content_hash'), retired=bindparam('retired'),
+                      # A cached GIF is only kept while the exercise points at the same URL
+                      gif_digest=case((Exercise.gif_url == bindparam('gif_url'), Exercise.gif_digest),
+                                      else_=None),
+                      gif_renditions=case((Exercise.gif_url == bindparam('gif_url'), Exercise.gif_renditions),
+                                          else_=False)))
+    stats = {'inserted': 0, 'updated': 0, 'retired': 0, 'unchanged': 0}
+    inserts = []
+    updates = []
+    seen = set()
+
+    def flush(commit=True):
+        if inserts:
+            db.session.execute(insert, inserts)
+            stats['inserted'] += len(inserts)
+        if updates:
+            db.session.execute(update, updates)
+            stats['updated'] += len(updates)
+        if commit:
+            db.session.commit()
+        inserts.clear()
+        updates.clear()
+
+    def changed():
+        return stats['inserted'] or stats['updated'] or stats['retired'] or equipment.inserted or targets.inserted
+
+    try:
+        for record in records:
+            source_id = record.get('id')
+            existing = by_source.get(source_id) if source_id is not None else None
+            if existing is None:
+                existing = by_name.get(record['name'])
+
+            if existing is None:
+                inserts.append(exercise_row(record, equipment, targets))
+            else:
+                exercise_id, stored_hash, retired = existing
+                seen.add(exercise_id)
+                if stored_hash != content_hash(record) or retired:
+                    updates.append(dict(exercise_row(record, equipment, targets), _id=exercise_id))
+                else:
+                    stats['unchanged'] += 1
+
+            if len(inserts) + len(updates) >= batch_size:
+                flush()
+        # Committed with the retired exercises, or with the version bump if there are none
+        flush(commit=False)
+
+        # Exercises no longer in the catalog are retired in batches, the last committed with the version bump
+        retire = [exercise_id for exercise_id, stored_hash, retired in [*by_source.values(), *by_name.values()]
+                  if exercise_id not in seen and not retired]
+        for idx in range(0, len(retire), batch_size):
+            batch = retire[idx:idx + batch_size]
+            Exercise.query.filter(Exercise.id.in_(batch)).update({Exercise.retired: True}, synchronize_session=False)
+            stats['retired'] += len(batch)
+            if idx + batch_size < len(retire):
+                db.session.commit()
+    except BaseException:
+        # Batches committed before the failure changed the catalog, workers must not keep serving the old one
+        db.session.rollback()
+        if changed():
+            CatalogVersion.bump()
+            db.session.commit()
+        raise
+
+    if changed():
+        CatalogVersion.bump()
+    db.session.commit()
+
+    seconds = time.perf_counter() - start
+    rows = stats['inserted'] + stats['updated'] + stats['retired'] + stats['unchanged']
+    return dict(stats,
+                equipment=equipment.inserted,
+                targets=targets.inserted,
+                seconds=seconds,
+                rows_per_sec=rows / seconds if seconds else 0)
+
+def report(stats):
+    """Print load or sync stats"""
+
+    if 'exercises' in stats:
+        print(f"Loaded {stats['exercises']} exercises, {stats['equipment']} equipment and {stats['targets']} targets "
+              f"in {stats['seconds']:.2f}s ({stats['rows_per_sec']:.0f} rows/sec)")
+    else:
+        print(f"Synced exercises: {stats['inserted']} inserted, {stats['updated']} updated, {stats['retired']} retired, "
+              f"{stats['unchanged']} unchanged, {stats['equipment']} new equipment, {stats['targets']} new targets "
+              f"in {stats['seconds']:.2f}s ({stats['rows_per_sec']:.0f} rows/sec)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load exercise catalog from a JSON or NDJSON dump')
+    parser.add_argument('dump', help='path to ExerciseDB JSON array or NDJSON dump')
+    parser.add_argument('--sync', action='store_true', help='update an existing catalog in place')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    # Bulk writes may run past the statement timeout used for requests
+    os.environ.setdefault('DATABASE_STATEMENT_TIMEOUT', '0')
+    from app import app
+    with app.app_context():
+        migrate(db.engine)
+        with open(args.dump, encoding='utf8') as fp:
+            if args.sync:
+                stats = sync_catalog(iter_records(fp), args.batch_size)
+            else:
+                try:
+                    stats = load_catalog(iter_records(fp), args.batch_size)
+                except ValueError as e:
+                    print(f'{e} Use --sync to update it.')
+                    sys.exit(1)
+        snapshot = update_snapshot()
+    report(stats)
+    if snapshot:
+        print(f'Wrote catalog snapshot {snapshot}')
+
+if __name__ == '__main__':
+    main()
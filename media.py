@@ -0,0 +1,249 @@
+"""
+Exercise GIF media for Movement Breaks.
+
+Exercise GIFs are fetched once from ExerciseDB into a content-addressed store on disk (MEDIA_ROOT), named
+by the SHA-256 of their content, and served from our own origin under MEDIA_URL with long-lived cache
+headers. Lighter renditions are made next to each GIF with Pillow: a static PNG poster frame and a
+reduced-size animation. Exercises record whether their renditions were made, and only point at renditions
+that exist; GIFs Pillow cannot read are served without them.
+
+Run with python media.py [--workers N] to fetch the GIFs of exercises that have none cached, and make the
+renditions of cached GIFs that lack them.
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from flask import abort, current_app, send_file
+from PIL import Image, ImageSequence
+
+MEDIA_URL = '/media/'
+
+# Rendition name: (file extension, mimetype)
+FORMATS = {None: ('gif', 'image/gif'), 'poster': ('png', 'image/png'), 'small': ('gif', 'image/gif')}
+
+RENDITIONS = ('poster', 'small')
+
+# Longest side in pixels of the poster and small renditions
+RENDITION_SIZE = 240
+
+# Files are named by their content, so they never change once served
+CACHE_SECONDS = 365 * 24 * 60 * 60
+
+FETCH_TIMEOUT = 10
+
+NAME_PATTERN = re.compile(r'^([0-9a-f]{64})(?:\.(poster|small))?\.(gif|png)$')
+
+def media_url(digest, rendition=None):
+    """Return URL of cached GIF with digest, or of its rendition"""
+
+    return MEDIA_URL + media_name(digest, rendition)
+
+def media_name(digest, rendition=None):
+    """Return file name of cached GIF with digest, or of its rendition"""
+
+    extension = FORMATS[rendition][0]
+    return f'{digest}.{rendition}.{extension}' if rendition else f'{digest}.{extension}'
+
+def make_renditions(data):
+    """Return {rendition: bytes} of poster and small renditions of GIF data"""
+
+    image = Image.open(io.BytesIO(data))
+    size = (RENDITION_SIZE, RENDITION_SIZE)
+
+    poster = image.convert('RGBA')
+    poster.thumbnail(size)
+    poster_data = io.BytesIO()
+    poster.save(poster_data, format='PNG', optimize=True)
+
+    frames = []
+    for frame in ImageSequence.Iterator(image):
+        frame = frame.convert('RGBA')
+        frame.thumbnail(size)
+        frames.append(frame)
+    small_data = io.BytesIO()
+    frames[0].save(small_data, format='GIF', save_all=True, append_images=frames[1:], optimize=True,
+                   loop=image.info.get('loop', 0), duration=image.info.get('duration', 100), disposal=2)
+
+    return {'poster': poster_data.getvalue(), 'small': small_data.getvalue()}
+
+
+def write_file(path, data):
+    """Write data to path atomically, so readers never see a partial file"""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        # mkstemp makes files only their owner can read, which a front-end server sending them could not
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class MediaStore:
+    """Content-addressed store of GIFs and their renditions under root, sharded by digest prefix"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest, rendition=None):
+        """Return path of GIF with digest, or of its rendition"""
+
+        return os.path.join(self.root, digest[:2], media_name(digest, rendition))
+
+    def exists(self, digest, rendition=None):
+        return os.path.exists(self.path(digest, rendition))
+
+    def has_renditions(self, digest):
+        return all(self.exists(digest, rendition) for rendition in RENDITIONS)
+
+    def put(self, data):
+        """Store GIF data and its renditions unless already stored, returning its digest"""
+
+        digest = hashlib.sha256(data).hexdigest()
+        if not self.exists(digest):
+            self._put_renditions(digest, data)
+            # Written last, so that a stored original means its renditions were attempted
+            write_file(self.path(digest), data)
+        return digest
+
+    def add_renditions(self, digest):
+        """Make the renditions stored GIF digest lacks, returning whether it has them all"""
+
+        if not self.has_renditions(digest):
+            with open(self.path(digest), 'rb') as fp:
+                self._put_renditions(digest, fp.read())
+        return self.has_renditions(digest)
+
+    def _put_renditions(self, digest, data):
+        try:
+            renditions = make_renditions(data)
+        except (OSError, ValueError):
+            # Pillow cannot read every GIF, those are served without renditions
+            return
+        for rendition, rendition_data in renditions.items():
+            write_file(self.path(digest, rendition), rendition_data)
+
+
+def media_store():
+    """Return media store of the current app"""
+
+    return MediaStore(current_app.config['MEDIA_ROOT'])
+
+def send_media(store, name, accel_redirect=None):
+    """
+    Return response serving media file name from store, 404 if it is not stored, including renditions that
+    could not be made.
+
+    With accel_redirect, the URL prefix of an internal nginx location serving the store, the file is
+    handed to nginx with X-Accel-Redirect instead of being read by the worker.
+    """
+
+    match = NAME_PATTERN.match(name)
+    if not match:
+        abort(404)
+    digest, rendition, extension = match.groups()
+    if extension != FORMATS[rendition][0]:
+        abort(404)
+
+    path = store.path(digest, rendition)
+    if not os.path.exists(path):
+        abort(404)
+
+    mimetype = FORMATS[rendition][1]
+    if accel_redirect:
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = (accel_redirect.rstrip('/') + '/' +
+                                                os.path.relpath(path, store.root).replace(os.sep, '/'))
+    else:
+        # Uses X-Sendfile when USE_X_SENDFILE is set
+        response = send_file(path, mimetype=mimetype, conditional=True, cache_timeout=CACHE_SECONDS)
+    response.headers['Cache-Control'] = f'public, max-age={CACHE_SECONDS}, immutable'
+    return response
+
+def http_fetcher(url):
+    """Return content at url"""
+
+    response = requests.get(url, timeout=FETCH_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+def cache_media(store, urls, fetcher=http_fetcher, workers=8):
+    """
+    Fetch urls into store with workers threads, using fetcher(url) to get the content of a URL.
+
+    Returns ({url: digest} of fetched URLs, {url: error} of URLs that could not be fetched).
+    """
+
+    def fetch(url):
+        try:
+            return url, store.put(fetcher(url)), None
+        except Exception as e:
+            return url, None, e
+
+    digests = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for url, digest, error in executor.map(fetch, set(urls)):
+            if error is None:
+                digests[url] = digest
+            else:
+                errors[url] = error
+    return digests, errors
+
+def cache_exercise_media(store, fetcher=http_fetcher, workers=8):
+    """
+    Fetch GIFs of current exercises that have none cached, and make the renditions of cached GIFs lacking
+    them, record their digests and whether they have renditions, and bump the catalog version.
+
+    Returns dict with counts of cached exercises and of URLs that could not be fetched.
+    """
+
+    from models import db, Exercise, CatalogVersion
+
+    pending = (db.session.query(Exercise.id, Exercise.gif_url)
+               .filter(Exercise.gif_digest.is_(None), ~Exercise.retired).all())
+    digests, errors = cache_media(store, [gif_url for _, gif_url in pending], fetcher, workers)
+
+    rows = [{'id': exercise_id, 'gif_digest': digests[gif_url], 'gif_renditions': store.has_renditions(digests[gif_url])}
+            for exercise_id, gif_url in pending if gif_url in digests]
+    # GIFs cached before their renditions could be made
+    rows += [{'id': exercise_id, 'gif_renditions': True}
+             for exercise_id, digest in db.session.query(Exercise.id, Exercise.gif_digest)
+                                                 .filter(Exercise.gif_digest.isnot(None), ~Exercise.gif_renditions,
+                                                         ~Exercise.retired)
+             if store.exists(digest) and store.add_renditions(digest)]
+    if rows:
+        db.session.bulk_update_mappings(Exercise, rows)
+        CatalogVersion.bump()
+    db.session.commit()
+    return {'exercises': len(rows), 'failed': len(errors), 'errors': errors}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fetch exercise GIFs into the local media store')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    from app import app
+    from catalog import update_snapshot
+    with app.app_context():
+        stats = cache_exercise_media(media_store(), workers=args.workers)
+        snapshot = update_snapshot() if stats['exercises'] else None
+    print(f"Cached GIFs of {stats['exercises']} exercises, {stats['failed']} could not be fetched")
+    if snapshot:
+        print(f'Wrote catalog snapshot {snapshot}')
+    for url, error in sorted(stats['errors'].items()):
+        print(f'  {url}: {error}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+In-process metrics for Movement Breaks.
+
+init_metrics records, per endpoint, request duration, SQL statement count and time (from SQLAlchemy engine
+events), template render time and response size. render_metrics formats them, along with cache and auth
+metrics, in the Prometheus text format for the /metrics endpoint. Requests slower than
+SLOW_REQUEST_THRESHOLD seconds are logged with the SQL they ran.
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+from flask import request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Latency buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.75, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# SQL statements kept per request for the slow request log
+MAX_CAPTURED_STATEMENTS = 50
+
+logger = logging.getLogger(__name__)
+
+class Histogram:
+    """Cumulative histogram of observed values, with fixed bucket upper bounds"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record value"""
+
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Return upper bound of the bucket containing quantile q (0-1), None if nothing was observed"""
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[idx] if idx < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def render(self, name, labels=''):
+        """Return lines of histogram in Prometheus text format, labels formatted as 'key="value",'"""
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        labels = labels.rstrip(',')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class EndpointMetrics:
+    """Metrics of requests to one endpoint"""
+
+    def __init__(self):
+        self.duration = Histogram()
+        self.sql_statements = Histogram(COUNT_BUCKETS)
+        self.sql_duration = Histogram()
+        self.render_duration = Histogram()
+        self.response_size = Histogram(SIZE_BUCKETS)
+
+
+class RequestState(threading.local):
+    """Measurements of the request being handled by the current thread"""
+
+    def __init__(self):
+        self.active = False
+
+    def start(self, capture):
+        self.active = True
+        self.start_time = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0
+        self.render_time = 0
+        self.statements = [] if capture else None
+
+
+endpoints = {}
+_endpoints_lock = threading.Lock()
+_state = RequestState()
+
+def endpoint_metrics(endpoint):
+    """Return metrics of endpoint, creating them on first use"""
+
+    metrics = endpoints.get(endpoint)
+    if metrics is None:
+        with _endpoints_lock:
+            metrics = endpoints.setdefault(endpoint, EndpointMetrics())
+    return metrics
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _state.active:
+        _state.sql_start = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _state.active:
+        elapsed = time.perf_counter() - _state.sql_start
+        _state.sql_count += 1
+        _state.sql_time += elapsed
+        if _state.statements is not None and len(_state.statements) < MAX_CAPTURED_STATEMENTS:
+            _state.statements.append(f'[{elapsed * 1000:.1f}ms] {statement}')
+
+def init_metrics(app):
+    """Register request, template and SQL instrumentation on app and on SQLAlchemy engines"""
+
+    @app.before_request
+    def start_request():
+        _state.start(capture=app.config.get('SLOW_REQUEST_THRESHOLD') is not None)
+
+    @app.after_request
+    def finish_request(response):
+        if not _state.active:
+            return response
+        _state.active = False
+
+        duration = time.perf_counter() - _state.start_time
+        metrics = endpoint_metrics(request.endpoint or 'none')
+        metrics.duration.observe(duration)
+        metrics.sql_statements.observe(_state.sql_count)
+        metrics.sql_duration.observe(_state.sql_time)
+        metrics.render_duration.observe(_state.render_time)
+        if not response.is_streamed:
+            metrics.response_size.observe(response.calculate_content_length() or 0)
+
+        threshold = app.config.get('SLOW_REQUEST_THRESHOLD')
+        if threshold is not None and duration >= threshold:
+            logger.warning('Slow request %s %s: %.3fs, %d SQL statements in %.3fs, render %.3fs\n%s',
+                           request.method, request.full_path, duration, _state.sql_count, _state.sql_time,
+                           _state.render_time, '\n'.join(_state.statements))
+        return response
+
+    def before_render(sender, template, context, **extra):
+        if _state.active:
+            _state.render_start = time.perf_counter()
+
+    def rendered(sender, template, context, **extra):
+        if _state.active:
+            _state.render_time += time.perf_counter() - _state.render_start
+
+    before_render_template.connect(before_render, app, weak=False)
+    template_rendered.connect(rendered, app, weak=False)
+
+    # Every engine, including those created later such as the read replica's, counts towards the current request
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+def render_metrics(gauges=()):
+    """
+    Return all metrics in Prometheus text format.
+
+    gauges is an iterable of (name, labels, value) for values tracked elsewhere, such as cache counters.
+    """
+
+    from passwords import auth_latency
+
+    lines = []
+    histograms = [
+        ('http_request_duration_seconds', 'duration', 'Request duration'),
+        ('http_request_sql_statements', 'sql_statements', 'SQL statements per request'),
+        ('http_request_sql_duration_seconds', 'sql_duration', 'Time spent in SQL per request'),
+        ('http_request_render_duration_seconds', 'render_duration', 'Template render time per request'),
+        ('http_response_size_bytes', 'response_size', 'Response body size'),
+    ]
+    for name, attr, description in histograms:
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} histogram')
+        for endpoint, metrics in sorted(endpoints.items()):
+            lines.extend(getattr(metrics, attr).render(name, f'endpoint="{endpoint}",'))
+
+    lines.append('# HELP auth_duration_seconds Password hashing and checking time')
+    lines.append('# TYPE auth_duration_seconds histogram')
+    for operation, histogram in auth_latency.items():
+        lines.extend(histogram.render('auth_duration_seconds', f'operation="{operation}",'))
+
+    for name, labels, value in gauges:
+        lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+    return '\n'.join(lines) + '\n'
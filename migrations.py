@@ -0,0 +1,171 @@
+"""
+Schema migrations for Movement Breaks.
+
+Each migration is a numbered list of SQL statements, applied once and in order, and recorded in the
+schema_migrations table, so the schema can evolve without drop_all. The baseline migration only creates
+what is missing, so databases created with db.create_all() before migrations existed are adopted as they
+are. models.py declares the same schema, keep the two in step when adding a migration.
+
+Run with python migrations.py, or python migrations.py --list to see which migrations are applied.
+"""
+
+import argparse
+import os
+
+from sqlalchemy import text
+
+# Key of the advisory lock that keeps concurrent deploys from migrating at the same time
+LOCK_KEY = 7345001
+
+class Migration:
+    """Numbered schema change, run in one transaction unless transactional is False"""
+
+    def __init__(self, version, name, statements, transactional=True):
+        self.version = version
+        self.name = name
+        self.statements = statements
+        self.transactional = transactional
+
+
+MIGRATIONS = [
+    Migration(1, 'baseline schema', [
+        """CREATE TABLE IF NOT EXISTS users (
+               id SERIAL PRIMARY KEY,
+               username VARCHAR(20) NOT NULL UNIQUE,
+               password_hash VARCHAR(60) NOT NULL,
+               work_length INTEGER,
+               break_length INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS equipment (
+               id SERIAL PRIMARY KEY,
+               name VARCHAR(30) NOT NULL UNIQUE)""",
+        """CREATE TABLE IF NOT EXISTS targets (
+               id SERIAL PRIMARY KEY,
+               name VARCHAR(30) NOT NULL UNIQUE)""",
+        """CREATE TABLE IF NOT EXISTS exercises (
+               id SERIAL PRIMARY KEY,
+               name VARCHAR NOT NULL,
+               gif_url VARCHAR NOT NULL,
+               instructions VARCHAR[] NOT NULL,
+               equipment_id INTEGER REFERENCES equipment (id),
+               target_id INTEGER REFERENCES targets (id))""",
+        """CREATE TABLE IF NOT EXISTS equipment_preferences (
+               user_id INTEGER REFERENCES users (id),
+               equipment_id INTEGER REFERENCES equipment (id),
+               PRIMARY KEY (user_id, equipment_id))""",
+        """CREATE TABLE IF NOT EXISTS target_preferences (
+               user_id INTEGER REFERENCES users (id),
+               target_id INTEGER REFERENCES targets (id),
+               PRIMARY KEY (user_id, target_id))""",
+        """CREATE TABLE IF NOT EXISTS blocked_exercises (
+               user_id INTEGER REFERENCES users (id),
+               exercise_id INTEGER REFERENCES exercises (id),
+               PRIMARY KEY (user_id, exercise_id))""",
+    ]),
+    Migration(2, 'catalog version', [
+        """CREATE TABLE IF NOT EXISTS catalog_version (
+               id SERIAL PRIMARY KEY,
+               version INTEGER NOT NULL)""",
+    ]),
+    Migration(3, 'user preferences version', [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS preferences_version INTEGER NOT NULL DEFAULT '0'",
+    ]),
+    Migration(4, 'exercise sync columns', [
+        "ALTER TABLE exercises ADD COLUMN IF NOT EXISTS source_id VARCHAR UNIQUE",
+        "ALTER TABLE exercises ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)",
+        "ALTER TABLE exercises ADD COLUMN IF NOT EXISTS retired BOOLEAN NOT NULL DEFAULT 'false'",
+    ]),
+    # Built concurrently, outside a transaction, so that large association tables stay writable meanwhile
+    Migration(5, 'association indexes', [
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_equipment_preferences_equipment_id
+               ON equipment_preferences (equipment_id)""",
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_target_preferences_target_id
+               ON target_preferences (target_id)""",
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_blocked_exercises_exercise_id
+               ON blocked_exercises (exercise_id)""",
+    ], transactional=False),
+    Migration(6, 'exercise gif digest', [
+        "ALTER TABLE exercises ADD COLUMN IF NOT EXISTS gif_digest VARCHAR(64)",
+    ]),
+    Migration(7, 'break history', [
+        """CREATE TABLE IF NOT EXISTS break_events (
+               id BIGSERIAL PRIMARY KEY,
+               user_id INTEGER NOT NULL REFERENCES users (id),
+               kind VARCHAR(20) NOT NULL,
+               exercise_id INTEGER REFERENCES exercises (id),
+               created_at TIMESTAMP NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS ix_break_events_user_id_created_at ON break_events (user_id, created_at)",
+    ]),
+    Migration(8, 'exercise gif renditions', [
+        "ALTER TABLE exercises ADD COLUMN IF NOT EXISTS gif_renditions BOOLEAN NOT NULL DEFAULT 'false'",
+    ]),
+]
+
+def applied_versions(connection):
+    """Return versions of migrations applied to the database, creating schema_migrations if needed"""
+
+    connection.execute(text("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                                   version INTEGER PRIMARY KEY,
+                                   name VARCHAR NOT NULL,
+                                   applied_at TIMESTAMP NOT NULL DEFAULT now())"""))
+    return {version for (version,) in connection.execute(text('SELECT version FROM schema_migrations'))}
+
+def migrate(engine, target=None):
+    """Apply pending migrations up to version target (all by default), returning the migrations applied"""
+
+    applied = []
+    with engine.connect() as connection:
+        # Transactions are managed here, as CREATE INDEX CONCURRENTLY cannot run inside one
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.execute(text('SET statement_timeout = 0'))
+        connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': LOCK_KEY})
+        try:
+            done = applied_versions(connection)
+            for migration in MIGRATIONS:
+                if migration.version in done or (target is not None and migration.version > target):
+                    continue
+                if migration.transactional:
+                    connection.execute(text('BEGIN'))
+                try:
+                    for statement in migration.statements:
+                        connection.execute(text(statement))
+                    connection.execute(text('INSERT INTO schema_migrations (version, name) VALUES (:version, :name)'),
+                                       {'version': migration.version, 'name': migration.name})
+                except Exception:
+                    if migration.transactional:
+                        connection.execute(text('ROLLBACK'))
+                    raise
+                if migration.transactional:
+                    connection.execute(text('COMMIT'))
+                applied.append(migration)
+        finally:
+            connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': LOCK_KEY})
+            connection.execute(text('RESET statement_timeout'))
+    return applied
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply database schema migrations')
+    parser.add_argument('--list', action='store_true', help='list migrations and whether they are applied')
+    parser.add_argument('--target', type=int, help='apply migrations up to this version only')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('DATABASE_STATEMENT_TIMEOUT', '0')
+    from app import app
+    from models import db
+    with app.app_context():
+        engine = db.engine
+
+    if args.list:
+        with engine.connect() as connection:
+            done = applied_versions(connection)
+        for migration in MIGRATIONS:
+            print(f"{migration.version:4} {'applied' if migration.version in done else 'pending':8} {migration.name}")
+        return
+
+    applied = migrate(engine, args.target)
+    for migration in applied:
+        print(f'Applied {migration.version}: {migration.name}')
+    if not applied:
+        print('Database is up to date.')
+
+if __name__ == '__main__':
+    main()
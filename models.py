@@ -1,11 +1,31 @@
 """Models for Movement Breaks"""
 
-from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
+from datetime import datetime, timedelta
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import func, literal, select, orm, update
+from sqlalchemy.dialects.postgresql import insert
+from passwords import hash_password, check_password, needs_rehash
+from media import media_url
 
-db = SQLAlchemy()
+REPLICA_BIND = 'replica'
 
-bcrypt = Bcrypt()
+class RoutingSession(SignallingSession):
+    """Session sending queries to the read replica bind while g.use_replica is set, see app.read_only"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._flushing and has_app_context() and g.get('use_replica')
+                and REPLICA_BIND in (self.app.config['SQLALCHEMY_BINDS'] or {})):
+            return db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 def connect_db(app):
     """Connect to database"""
@@ -13,6 +33,49 @@ def connect_db(app):
     db.app = app
     db.init_app(app)
 
+# Break history loaded for recommendations: events of this many days, and this many exercises at most
+HISTORY_DAYS = 30
+HISTORY_LIMIT = 200
+
+class UserContext:
+    """
+    User along with ids of their equipment, targets and blocked exercises, see User.load_context
+
+    When loaded with history, also ids of exercises recently shown (most recent first) and skipped.
+    """
+
+    __slots__ = ('user', 'equipment_ids', 'target_ids', 'blocked_ids', 'recent_ids', 'skipped_ids')
+
+    def __init__(self, user, equipment_ids, target_ids, blocked_ids, recent_ids=None, skipped_ids=None):
+        self.user = user
+        self.equipment_ids = equipment_ids
+        self.target_ids = target_ids
+        self.blocked_ids = blocked_ids
+        self.recent_ids = recent_ids
+        self.skipped_ids = skipped_ids
+
+def update_associations(model, column, user_id, ids, current=None):
+    """
+    Make user's rows in association model match ids, with one select, one bulk insert and one bulk delete at most.
+
+    The select is skipped if the current ids are given. Returns whether any rows were inserted or deleted.
+    """
+
+    if current is None:
+        current = [value for (value,) in db.session.query(column).filter(model.user_id == user_id)]
+    current = set(current)
+    ids = set(ids)
+    added = ids - current
+    removed = current - ids
+
+    if added:
+        db.session.execute(model.__table__.insert(), [{'user_id': user_id, column.key: value} for value in added])
+    if removed:
+        (db.session.query(model)
+         .filter(model.user_id == user_id, column.in_(removed))
+         .delete(synchronize_session=False))
+    return bool(added or removed)
+
 class User(db.Model):
     "User model"
 
@@ -27,6 +90,11 @@ class User(db.Model):
                               nullable=False)
     work_length = db.Column(db.Integer, default=60)
     break_length = db.Column(db.Integer, default=5)
+    # Incremented whenever equipment, target or blocked exercise preferences change
+    preferences_version = db.Column(db.Integer,
+                                    nullable=False,
+                                    default=0,
+                                    server_default='0')
     equipment = db.relationship('Equipment', secondary='equipment_preferences', cascade='all, delete')
     targets = db.relationship('Target', secondary='target_preferences', cascade='all, delete')
     blocked_exercises = db.relationship('Exercise', secondary='blocked_exercises', cascade='all, delete')
@@ -35,20 +103,88 @@ class User(db.Model):
     def register(cls, username, password):
         """Register new user with hashed password"""
 
-        password_hash = bcrypt.generate_password_hash(password).decode("utf8")
+        password_hash = hash_password(password)
         return cls(username=username, password_hash=password_hash)
     
     @classmethod
     def login(cls, username, password):
-        """Handle user authentication"""
+        """Handle user authentication, rehashing password if the configured bcrypt cost has changed"""
 
         user = User.query.filter_by(username=username).first()
 
-        if user and bcrypt.check_password_hash(user.password_hash, password):
+        if user and check_password(user.password_hash, password):
+            if needs_rehash(user.password_hash):
+                user.password_hash = hash_password(password)
+                db.session.commit()
             return user
         else:
             return False
 
+    @classmethod
+    def load_context(cls, user_id, history=False):
+        """
+        Return UserContext for user with user_id, None if there is no such user
+
+        With history, the user's recently shown and skipped exercises are loaded in the same query.
+        """
+
+        def ids(column, user_column):
+            return func.array(select(column).where(user_column == cls.id).order_by(column).scalar_subquery())
+
+        columns = [cls,
+                   ids(EquipmentPreferences.equipment_id, EquipmentPreferences.user_id),
+                   ids(TargetPreferences.target_id, TargetPreferences.user_id),
+                   ids(BlockedExercise.exercise_id, BlockedExercise.user_id)]
+        if history:
+            # created_at is stored in UTC
+            since = func.timezone('utc', func.now()) - timedelta(days=HISTORY_DAYS)
+            recent = (select(BreakEvent.exercise_id)
+                      .where(BreakEvent.user_id == cls.id, BreakEvent.kind == 'shown', BreakEvent.created_at > since)
+                      .group_by(BreakEvent.exercise_id)
+                      .order_by(func.max(BreakEvent.created_at).desc())
+                      .limit(HISTORY_LIMIT))
+            skipped = (select(BreakEvent.exercise_id)
+                       .where(BreakEvent.user_id == cls.id, BreakEvent.kind == 'skipped', BreakEvent.created_at > since)
+                       .order_by(BreakEvent.created_at.desc())
+                       .limit(HISTORY_LIMIT))
+            columns += [func.array(recent.scalar_subquery()), func.array(skipped.scalar_subquery())]
+
+        row = db.session.query(*columns).filter(cls.id == user_id).first()
+        return UserContext(*row) if row else None
+
+    def update_preferences(self, equipment_ids, target_ids, current=None):
+        """
+        Set user's equipment and target preferences, writing only the rows that changed.
+
+        current is an optional (equipment_ids, target_ids) pair of the user's preferences as already loaded.
+        Returns whether preferences changed, in which case the preferences version is bumped.
+        """
+
+        current_equipment, current_targets = current or (None, None)
+        changed = update_associations(EquipmentPreferences, EquipmentPreferences.equipment_id, self.id,
+                                      equipment_ids, current_equipment)
+        changed = update_associations(TargetPreferences, TargetPreferences.target_id, self.id,
+                                      target_ids, current_targets) or changed
+        if changed:
+            self.bump_preferences_version()
+            db.session.expire(self, ['equipment', 'targets'])
+        return changed
+
+    def bump_preferences_version(self):
+        """Mark user's exercise preferences as changed, invalidating cached exercise lists"""
+
+        self.preferences_version = User.preferences_version + 1
+
+    @classmethod
+    def increment_preferences_version(cls, user_id):
+        """Mark exercise preferences of user with user_id as changed, returning the new preferences version"""
+
+        return db.session.execute(
+            update(cls.__table__)
+            .where(cls.id == user_id)
+            .values(preferences_version=cls.preferences_version + 1)
+            .returning(cls.preferences_version)).scalar()
+
 class Exercise(db.Model):
     "Exercise model"
 
@@ -66,22 +202,46 @@ class Exercise(db.Model):
                              db.ForeignKey('equipment.id'))
     target_id = db.Column(db.Integer,
                           db.ForeignKey('targets.id'))
+    # ExerciseDB id and hash of the record the exercise was loaded from, used to sync catalog updates
+    source_id = db.Column(db.String(),
+                          unique=True)
+    content_hash = db.Column(db.String(64))
+    # Exercises removed from ExerciseDB are retired rather than deleted, keeping users' blocks intact
+    retired = db.Column(db.Boolean,
+                        nullable=False,
+                        default=False,
+                        server_default='false')
+    # SHA-256 of the GIF in the local media store, None until fetched (see media.py)
+    gif_digest = db.Column(db.String(64))
+    # Whether the poster and small renditions of the cached GIF were made
+    gif_renditions = db.Column(db.Boolean,
+                               nullable=False,
+                               default=False,
+                               server_default='false')
     equipment = db.relationship('Equipment', backref='exercises')
     target = db.relationship('Target', backref='exercises')
 
     def serialize(self):
        """Return serialized Exercise"""
-       return {
+       serialized = {
            'id': self.id,
            'name': self.name,
            'gifUrl': self.gif_url,
            'instructions': self.instructions
        }
+       if self.gif_digest:
+           serialized['gifUrl'] = media_url(self.gif_digest)
+           if self.gif_renditions:
+               serialized['posterUrl'] = media_url(self.gif_digest, 'poster')
+               serialized['smallGifUrl'] = media_url(self.gif_digest, 'small')
+       return serialized
     
 class BlockedExercise(db.Model):
     "Model for BlockedExercise linking many-to-many relationship between User and Exercise"
 
     __tablename__ = "blocked_exercises"
+    __table_args__ = (db.Index('ix_blocked_exercises_exercise_id', 'exercise_id'),)
+
     user_id = db.Column(db.Integer,
                         db.ForeignKey('users.id'), 
                         primary_key=True)
@@ -89,6 +249,41 @@ class BlockedExercise(db.Model):
                              db.ForeignKey('exercises.id'),
                              primary_key=True)
 
+    @classmethod
+    def block(cls, user_id, exercise_ids):
+        """
+        Block exercises for user in a single statement, ignoring exercises that are already blocked, retired or do
+        not exist.
+
+        Returns ids of newly blocked exercises.
+        """
+
+        statement = (insert(cls.__table__)
+                     .from_select(['user_id', 'exercise_id'],
+                                  select(literal(user_id), Exercise.id)
+                                  .where(Exercise.id.in_(exercise_ids), Exercise.retired.is_(False)))
+                     .on_conflict_do_nothing()
+                     .returning(cls.exercise_id))
+        return [exercise_id for (exercise_id,) in db.session.execute(statement)]
+
+    @classmethod
+    def unblock(cls, user_id, exercise_ids):
+        """Unblock exercises for user in a single statement, returning ids of exercises that were blocked"""
+
+        statement = (cls.__table__.delete()
+                     .where(cls.user_id == user_id, cls.exercise_id.in_(exercise_ids))
+                     .returning(cls.exercise_id))
+        return [exercise_id for (exercise_id,) in db.session.execute(statement)]
+
+    @classmethod
+    def page(cls, user_id, after=None, limit=100):
+        """Return up to limit of user's blocked exercise ids in id order, starting after exercise id after"""
+
+        query = db.session.query(cls.exercise_id).filter(cls.user_id == user_id)
+        if after is not None:
+            query = query.filter(cls.exercise_id > after)
+        return [exercise_id for (exercise_id,) in query.order_by(cls.exercise_id).limit(limit)]
+
 class Equipment(db.Model):
     "Equipment model"
 
@@ -115,6 +310,7 @@ class EquipmentPreferences(db.Model):
     "Model linking many-to-many relationship between User and Equipment"
 
     __tablename__ = "equipment_preferences" 
+    __table_args__ = (db.Index('ix_equipment_preferences_equipment_id', 'equipment_id'),)
 
     user_id = db.Column(db.Integer,
                         db.ForeignKey('users.id'), 
@@ -127,10 +323,61 @@ class TargetPreferences(db.Model):
     "Model linking many-to-many relationship between User and Target"
 
     __tablename__ = "target_preferences"
+    __table_args__ = (db.Index('ix_target_preferences_target_id', 'target_id'),)
 
     user_id = db.Column(db.Integer,
                         db.ForeignKey('users.id',),
                         primary_key=True)
     target_id = db.Column(db.Integer,
                        db.ForeignKey('targets.id'),
-                       primary_key=True)
\ No newline at end of file
+                       primary_key=True)
+
+class BreakEvent(db.Model):
+    "Event in a user's break history, inserted in batches by events.event_writer"
+
+    __tablename__ = "break_events"
+    __table_args__ = (db.Index('ix_break_events_user_id_created_at', 'user_id', 'created_at'),)
+
+    id = db.Column(db.BigInteger,
+                   primary_key=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.id'),
+                        nullable=False)
+    # One of work_completed, break_completed, shown, skipped and blocked
+    kind = db.Column(db.String(20),
+                     nullable=False)
+    exercise_id = db.Column(db.Integer,
+                            db.ForeignKey('exercises.id'))
+    created_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow)
+
+class CatalogVersion(db.Model):
+    "Single-row model tracking the version of the exercise catalog, bumped whenever it is reseeded"
+
+    __tablename__ = "catalog_version"
+
+    id = db.Column(db.Integer,
+                   primary_key=True)
+    version = db.Column(db.Integer,
+                        nullable=False,
+                        default=0)
+
+    @classmethod
+    def current(cls):
+        """Return current catalog version, 0 if the catalog has never been versioned"""
+
+        version = db.session.query(cls.version).filter(cls.id == 1).scalar()
+        return version or 0
+
+    @classmethod
+    def bump(cls):
+        """Increment catalog version so that cached copies of the catalog are reloaded"""
+
+        row = cls.query.get(1)
+        if row:
+            row.version += 1
+        else:
+            row = cls(id=1, version=1)
+            db.session.add(row)
+        return row
@@ -0,0 +1,83 @@
+"""
+Password hashing for Movement Breaks.
+
+bcrypt runs on a bounded process pool (BCRYPT_POOL_SIZE processes, 0 to run in the calling thread), so
+that a burst of logins uses at most that many cores per worker. The request thread waits for the result,
+which relies on threaded gunicorn workers (see gunicorn.conf.py) for the worker's other threads to keep
+serving meanwhile. Hashes use BCRYPT_LOG_ROUNDS rounds.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+from metrics import Histogram
+
+# Latency of auth operations, including time waiting for a pool process
+auth_latency = {'hash': Histogram(), 'check': Histogram()}
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def _config(key, default):
+    from models import db
+    return db.get_app().config.get(key, default)
+
+def _executor():
+    """Return process pool for this process, None if hashing runs in the calling thread"""
+
+    global _pool, _pool_pid
+
+    size = _config('BCRYPT_POOL_SIZE', 2)
+    if not size:
+        return None
+
+    # Pools are not inherited by forked workers, each process starts its own. Pool processes are started
+    # by a fork server rather than forked from the worker, whose other threads may hold locks (logging, the
+    # database pool, the event writer) that would stay held in the child
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=size, mp_context=multiprocessing.get_context('forkserver'))
+            _pool_pid = os.getpid()
+        return _pool
+
+def _hashpw(password, salt):
+    return bcrypt.hashpw(password, salt)
+
+def _checkpw(password, password_hash):
+    return bcrypt.checkpw(password, password_hash)
+
+def _run(operation, fn, *args):
+    start = time.perf_counter()
+    pool = _executor()
+    try:
+        return pool.submit(fn, *args).result() if pool else fn(*args)
+    finally:
+        auth_latency[operation].observe(time.perf_counter() - start)
+
+def hash_password(password):
+    """Return bcrypt hash of password with the configured number of rounds"""
+
+    if not password:
+        raise ValueError('Password must be non-empty.')
+
+    salt = bcrypt.gensalt(rounds=_config('BCRYPT_LOG_ROUNDS', 12))
+    return _run('hash', _hashpw, password.encode('utf8'), salt).decode('utf8')
+
+def check_password(password_hash, password):
+    """Return whether password matches bcrypt hash"""
+
+    if not password:
+        return False
+    return _run('check', _checkpw, password.encode('utf8'), password_hash.encode('utf8'))
+
+def needs_rehash(password_hash):
+    """Return whether hash was made with a different number of rounds than currently configured"""
+
+    # bcrypt hashes are formatted as $2b$<rounds>$<salt and hash>
+    return int(password_hash.split('$')[2]) != _config('BCRYPT_LOG_ROUNDS', 12)
@@ -0,0 +1,180 @@
+"""
+Exercise recommendations for Movement Breaks.
+
+recommend draws exercises from a user's eligible exercises by weighted sampling without replacement. Each
+exercise's weight is its target's weight, divided by the number of eligible exercises of that target so that
+targets with many exercises do not crowd out the rest (diversity across targets), times its own factor:
+- exercises outside the user's targets weigh less (which matters when falling back to body weight exercises)
+- targets weigh less for each of their exercises the user blocked
+- recently shown exercises are held back, recovering over RECENT_VIEWS later views
+- skipped exercises weigh less for each skip
+
+Weights are computed with NumPy over arrays built once per catalog version. Exercises are drawn one at a
+time in proportion to their weight, by first drawing a target by its remaining total weight and then an
+exercise within it, so each draw only looks at one target's exercises. For a 50,000 exercise catalog a
+recommendation takes a fraction of a millisecond.
+"""
+
+import threading
+import weakref
+
+import numpy as np
+
+# Weight of exercises outside the user's targets, relative to those within
+OFF_TARGET_WEIGHT = 0.2
+# Target weights are multiplied by this for each blocked exercise of the target
+BLOCK_TARGET_FACTOR = 0.85
+# Factor of the most recently shown exercise, rising linearly to 1 over this many views
+RECENT_FACTOR = 0.02
+RECENT_VIEWS = 50
+# Exercise factors are multiplied by this for each skip
+SKIP_FACTOR = 0.5
+
+class CatalogArrays:
+    """Catalog exercises as arrays over catalog positions, with positions grouped by target"""
+
+    def __init__(self, catalog):
+        self.size = len(catalog.ids)
+        self.ids = np.frombuffer(catalog.ids, dtype=np.int64)
+        self.positions = catalog.positions
+
+        # Groups are the targets with exercises, exercises without a target (target id 0) form a group of their own
+        targets, self.group = np.unique(np.frombuffer(catalog.target_ids, dtype=np.int64), return_inverse=True)
+        self.groups = {int(target_id) or None: group for group, target_id in enumerate(targets)}
+        self.group_count = len(targets)
+
+        # Positions sorted by group, group g's positions are order[starts[g]:starts[g + 1]]
+        self.order = np.argsort(self.group, kind='stable')
+        self.starts = np.searchsorted(self.group[self.order], np.arange(self.group_count + 1))
+
+
+_arrays = weakref.WeakKeyDictionary()
+_arrays_lock = threading.Lock()
+
+def catalog_arrays(catalog):
+    """Return CatalogArrays of catalog, building them on first use"""
+
+    arrays = _arrays.get(catalog)
+    if arrays is None:
+        with _arrays_lock:
+            arrays = _arrays.get(catalog)
+            if arrays is None:
+                arrays = _arrays[catalog] = CatalogArrays(catalog)
+    return arrays
+
+def mask_to_array(mask, size):
+    """Return boolean array of size with the positions set in bitset mask"""
+
+    data = np.frombuffer(mask.to_bytes((size + 7) // 8, 'little'), dtype=np.uint8)
+    return np.unpackbits(data, bitorder='little')[:size].view(np.bool_)
+
+def positions_of(arrays, exercise_ids):
+    """Return array of catalog positions of exercise_ids, ignoring ids not in the catalog"""
+
+    return np.array([arrays.positions[exercise_id] for exercise_id in exercise_ids if exercise_id in arrays.positions],
+                    dtype=np.intp)
+
+
+class Scores:
+    """
+    Weights of the exercises set in eligible (a boolean array over catalog positions) for user context
+    (UserContext loaded with history, or None)
+
+    An exercise's weight is group_weights[group] / counts[group] * factors[position], totals holds the
+    total weight of each group's eligible exercises.
+    """
+
+    def __init__(self, arrays, eligible, context=None):
+        self.arrays = arrays
+        self.eligible = eligible
+        self.counts = np.add.reduceat(eligible[arrays.order], arrays.starts[:-1]) if arrays.group_count else \
+            np.zeros(0, dtype=np.intp)
+        self.group_weights = np.ones(arrays.group_count)
+        self.factors = None
+        affected = ()
+
+        if context is not None:
+            if context.target_ids:
+                preferred = np.zeros(arrays.group_count, dtype=np.bool_)
+                preferred[[arrays.groups[target_id] for target_id in context.target_ids
+                           if target_id in arrays.groups]] = True
+                self.group_weights[~preferred] *= OFF_TARGET_WEIGHT
+            if context.blocked_ids:
+                blocked = np.bincount(arrays.group[positions_of(arrays, context.blocked_ids)],
+                                      minlength=arrays.group_count)
+                self.group_weights *= BLOCK_TARGET_FACTOR ** blocked
+
+            if context.recent_ids or context.skipped_ids:
+                self.factors = np.ones(arrays.size)
+                recent = positions_of(arrays, (context.recent_ids or [])[:RECENT_VIEWS])
+                self.factors[recent] = RECENT_FACTOR + (1 - RECENT_FACTOR) * np.arange(len(recent)) / RECENT_VIEWS
+                skipped = positions_of(arrays, context.skipped_ids or [])
+                np.multiply.at(self.factors, skipped, SKIP_FACTOR)
+                affected = np.unique(np.concatenate((recent, skipped)))
+
+        # Groups' eligible exercises sum to counts, less what factors below 1 take off
+        factor_sums = self.counts.astype(float)
+        if len(affected):
+            affected = affected[eligible[affected]]
+            factor_sums -= np.bincount(arrays.group[affected], weights=1 - self.factors[affected],
+                                       minlength=arrays.group_count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.totals = np.where(self.counts > 0, self.group_weights * factor_sums / self.counts, 0)
+
+    def weight(self, position):
+        """Return weight of exercise at position"""
+
+        group = self.arrays.group[position]
+        factor = self.factors[position] if self.factors is not None else 1
+        return self.group_weights[group] / self.counts[group] * factor
+
+    def draw(self, count, rng):
+        """Return positions of up to count exercises drawn in proportion to their weight, without replacement"""
+
+        arrays = self.arrays
+        eligible = self.eligible.copy()
+        totals = self.totals.copy()
+        drawn = []
+        while len(drawn) < count:
+            total = totals.sum()
+            if total <= 0:
+                break
+            group = min(np.searchsorted(np.cumsum(totals), rng.random() * total, side='right'), len(totals) - 1)
+
+            members = arrays.order[arrays.starts[group]:arrays.starts[group + 1]]
+            candidates = members[eligible[members]]
+            if not len(candidates):
+                # Only rounding error was left of the group's total
+                totals[group] = 0
+                continue
+            if self.factors is None:
+                position = candidates[rng.integers(len(candidates))]
+            else:
+                cumulative = np.cumsum(self.factors[candidates])
+                position = candidates[min(np.searchsorted(cumulative, rng.random() * cumulative[-1], side='right'),
+                                          len(candidates) - 1)]
+
+            drawn.append(position)
+            eligible[position] = False
+            totals[group] = max(totals[group] - self.weight(position), 0) if len(candidates) > 1 else 0
+        return drawn
+
+
+def recommend(catalog, mask, count, context=None, exclude=(), seed=None):
+    """
+    Return ids of up to count exercises drawn from bitset mask of eligible exercises, see Scores.
+
+    Exercises in exclude, such as those already shown during this break, are left out unless that leaves none.
+    """
+
+    arrays = catalog_arrays(catalog)
+    eligible = mask_to_array(mask, arrays.size)
+    if exclude:
+        excluded = positions_of(arrays, exclude)
+        kept = eligible[excluded]
+        eligible[excluded] = False
+        if not eligible.any():
+            eligible[excluded] = kept
+
+    drawn = Scores(arrays, eligible, context).draw(count, np.random.default_rng(seed))
+    return arrays.ids[drawn].tolist()
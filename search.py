@@ -0,0 +1,135 @@
+"""
+Exercise search for Movement Breaks.
+
+Each catalog version gets an in-process inverted index, built in a background thread after the catalog is
+reloaded, while searches keep using the previous catalog (see CatalogCache.get_searchable): the sorted list
+of words in exercise names and instructions, each with the bitsets of exercises (catalog positions, as in
+Catalog) having it in their name and anywhere. A query word matches every indexed word it is a prefix of, found by
+bisecting the sorted words, so matching never scans exercises and filtering by a user's equipment and
+blocked exercises is an intersection of bitsets.
+"""
+
+import re
+import threading
+import weakref
+from bisect import bisect_left
+
+from catalog import loads, to_mask
+
+WORD = re.compile(r'[a-z0-9]+')
+
+# Query words beyond this many are ignored
+MAX_QUERY_WORDS = 5
+
+def words(text):
+    """Return lowercase words of text"""
+
+    return WORD.findall(text.lower())
+
+class SearchIndex:
+    """Inverted index of a catalog's exercise names and instructions"""
+
+    def __init__(self, catalog):
+        in_name = {}
+        anywhere = {}
+        for pos, exercise_id in enumerate(catalog.ids):
+            exercise = loads(catalog.fragment(exercise_id))
+            name_words = set(words(exercise['name']))
+            for word in name_words:
+                in_name.setdefault(word, []).append(pos)
+            for word in name_words.union(words(' '.join(exercise['instructions']))):
+                anywhere.setdefault(word, []).append(pos)
+
+        self.words = sorted(anywhere)
+        self.name_masks = [to_mask(in_name.get(word, [])) for word in self.words]
+        self.masks = [to_mask(anywhere[word]) for word in self.words]
+
+    def match(self, prefix):
+        """Return (bitset of exercises with a word starting with prefix in their name, bitset of those with one anywhere)"""
+
+        start = bisect_left(self.words, prefix)
+        end = bisect_left(self.words, prefix + '\x7f', start)
+        name_mask = mask = 0
+        for idx in range(start, end):
+            name_mask |= self.name_masks[idx]
+            mask |= self.masks[idx]
+        return name_mask, mask
+
+    def tiers(self, query, mask):
+        """
+        Return bitsets of exercises in mask matching every word of query, from the best matches down
+
+        Exercises matching every query word in their name come first, then those matching some in their
+        name, then those matching in their instructions only.
+        """
+
+        query_words = words(query)[:MAX_QUERY_WORDS]
+        if not query_words:
+            return []
+
+        all_in_name = mask
+        any_in_name = 0
+        for word in query_words:
+            name_mask, word_mask = self.match(word)
+            mask &= word_mask
+            all_in_name &= name_mask
+            any_in_name |= name_mask
+        return [all_in_name & mask, any_in_name & mask & ~all_in_name, mask & ~any_in_name]
+
+
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+_building = weakref.WeakSet()
+_building_lock = threading.Lock()
+
+def has_search_index(catalog):
+    """Return whether catalog's search index is built"""
+
+    return catalog in _indexes
+
+def search_index(catalog):
+    """Return SearchIndex of catalog, building it if it is not built yet"""
+
+    index = _indexes.get(catalog)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(catalog)
+            if index is None:
+                index = _indexes[catalog] = SearchIndex(catalog)
+    return index
+
+def build_search_index(catalog):
+    """Start building catalog's search index in a background thread, unless it is built or being built"""
+
+    with _building_lock:
+        if catalog in _indexes or catalog in _building:
+            return
+        _building.add(catalog)
+    threading.Thread(target=_build, args=(catalog,), daemon=True).start()
+
+def _build(catalog):
+    try:
+        search_index(catalog)
+    finally:
+        with _building_lock:
+            _building.discard(catalog)
+
+def search(catalog, query, mask, offset=0, limit=20):
+    """
+    Return (page of ids of exercises in bitset mask matching query, total number of matches)
+
+    Results are ordered by SearchIndex.tiers, then by catalog order.
+    """
+
+    tiers = search_index(catalog).tiers(query, mask)
+    page = []
+    for tier in tiers:
+        count = tier.bit_count()
+        if offset >= count:
+            offset -= count
+            continue
+        page += catalog.ids_from_mask(tier, offset, limit - len(page))
+        offset = 0
+        if len(page) >= limit:
+            break
+    return page, sum(tier.bit_count() for tier in tiers)
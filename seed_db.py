@@ -1,10 +1,19 @@
-"""Seed database with equipment and exercise targets from API"""
+"""
+Seed or refresh database with equipment, exercise targets and exercises from API
+
+Existing exercises are updated in place (see loader.sync_catalog), so users and their preferences are kept.
+"""
 
-from app import app
 import os
+# Bulk writes may run past the statement timeout used for requests
+os.environ.setdefault('DATABASE_STATEMENT_TIMEOUT', '0')
+from app import app
 import requests
 import sys
-from models import db, Equipment, Target, Exercise
+from models import db, Equipment, Target, CatalogVersion
+from loader import NameMap, sync_catalog, report
+from catalog import update_snapshot
+from migrations import migrate
 
 base_url = 'https://exercisedb.p.rapidapi.com/exercises'
 headers = {
@@ -12,36 +21,31 @@ headers = {
     'x-rapidapi-key': os.environ.get('API_KEY')
 }
 
-db.drop_all()
-db.create_all()
-
-equipment = []
-targets = []
-exercises = []
+migrate(db.engine)
 
 try:
     equip_res = requests.get(f"{base_url}/equipmentList", headers=headers)
-    for equip in equip_res.json():
-        equipment.append(Equipment(name=equip))
-
     target_res = requests.get(f"{base_url}/targetList", headers=headers)
-    for target in target_res.json():
-        targets.append(Target(name=target))
-
     exercise_res = requests.get(f"{base_url}?limit=0", headers=headers).json()
+    equipment = equip_res.json()
+    targets = target_res.json()
 except:
     print("Could not get data from API.")
     sys.exit()
 
-db.session.add_all(equipment)
-db.session.add_all(targets)
+# Equipment and targets without exercises are still offered in settings
+equipment_names = NameMap(Equipment)
+for equip in equipment:
+    equipment_names[equip]
+target_names = NameMap(Target)
+for target in targets:
+    target_names[target]
+if equipment_names.inserted or target_names.inserted:
+    CatalogVersion.bump()
 db.session.commit()
 
-for exercise in exercise_res:
-    equipment = Equipment.query.filter_by(name=exercise['equipment']).one()
-    target = Target.query.filter_by(name=exercise['target']).one()
-    new_exercise = Exercise(name=exercise['name'], gif_url=exercise['gifUrl'], instructions=exercise['instructions'], equipment_id=equipment.id, target_id=target.id)
-    exercises.append(new_exercise)
+report(sync_catalog(exercise_res))
 
-db.session.add_all(exercises)
-db.session.commit()
\ No newline at end of file
+snapshot = update_snapshot()
+if snapshot:
+    print(f'Wrote catalog snapshot {snapshot}')
@@ -10,12 +10,57 @@ const $instructions = $('#exercise-instructions');
 const $alert = $('.alert');
 const $header = $('h1')
 
+// Number of exercises fetched per page during a break
+const SAMPLE_SIZE = 5;
+// The first page of a break is prefetched at a random moment in this many final seconds of the work phase
+const PREFETCH_WINDOW = 60;
+// Most exercise ids the server accepts in a recommendation's exclude list
+const MAX_EXCLUDE = 200;
+
 let secLeft;
 let interval;
 let exercises;
+// Exercises are paged through in a fixed random order for the lifetime of the page, continuing across breaks
+let seed = Math.floor(Math.random() * 2 ** 31);
+let nextCursor = null;
+// Responses and their ETags by request URL, revalidated with the server on every request
+const exerciseCache = new Map();
 let currExerciseId;
 let exerciseIdx = 0;
 let workPhase = true;
+// Seconds left in the work phase when the next break is prefetched, and the prefetched page
+let prefetchAt;
+let prefetched = null;
+// Token of the prefetched page shown, which continues paging after it until it expires
+let prefetchToken = null;
+// Ids of exercises shown during the current break, not recommended again before it ends
+let shownIds = [];
+// Break history events are sent in batches every EVENT_SEND_INTERVAL milliseconds, see logEvent
+const EVENT_SEND_INTERVAL = 15000;
+const MAX_PENDING_EVENTS = 500;
+let pendingEvents = [];
+
+/**
+ * Send request to url, returning {status, headers, data} with the JSON response body as data
+ * Throw an error with the response for statuses other than 2xx and those in allowedStatuses
+ */
+async function request(url, options = {}, allowedStatuses = []) {
+    const response = await fetch(url, options);
+    if (!response.ok && !allowedStatuses.includes(response.status)) {
+        const error = new Error(`Request failed with status ${response.status}`);
+        error.response = response;
+        throw error;
+    }
+    const text = await response.text();
+    return {status: response.status, headers: response.headers, data: text ? JSON.parse(text) : null};
+}
+
+/**
+ * Post data as JSON to url, see request
+ */
+function postJSON(url, data) {
+    return request(url, {method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify(data)});
+}
 
 /**
  * Start timer count down 
@@ -25,6 +70,11 @@ function startTimer() {
 
     // Set time in seconds based on whether it is a work phase or break phase
     secLeft = (workPhase ? workMins : breakMins) * 60;
+    if (workPhase) {
+        // Spread out prefetches, so that breaks starting at the same time do not all load at once
+        prefetchAt = Math.ceil(Math.random() * Math.min(PREFETCH_WINDOW, secLeft - 1));
+        prefetched = null;
+    }
 
     // Uncomment for quicker testing
     // secLeft = 5
@@ -37,10 +87,14 @@ function startTimer() {
 function countDown() {
     secLeft--;
     $timerDisplay.text(formatTime(secLeft));
+    if (workPhase && secLeft === prefetchAt) {
+        prefetchExercises();
+    }
     
     if (secLeft === 0) {
         clearInterval(interval);
         playSound();
+        logEvent(workPhase ? 'work_completed' : 'break_completed');
         workPhase = !workPhase;
         if (!workPhase) {
             startExerciseBreak();
@@ -85,23 +139,78 @@ async function startExerciseBreak() {
     startTimer();
     $header.text('Get up and take a break!')
     exerciseIdx = 0;
-    exercises = await fetchExercises();
-    if (exercises) {
+    shownIds = [];
+    if (prefetched && Date.now() < prefetched.expiresAt) {
+        exercises = useExercisePage(prefetched.data);
+        prefetchToken = {token: prefetched.data.token, expiresAt: prefetched.expiresAt};
+    } else {
+        exercises = await fetchExercises(nextCursor);
+    }
+    prefetched = null;
+    if (exercises && exercises.length) {
         showNextExercise();
     } 
 }
 
 /**
- * Return exercises fetched from database
+ * Fetch the first page of the next break ahead of time, and preload its images
+ * The page is used if the break starts before it expires
+ */
+async function prefetchExercises() {
+    try {
+        const params = {sample: SAMPLE_SIZE, seed: seed};
+        if (nextCursor) {
+            params.cursor = nextCursor;
+        }
+        const res = await request(`./exercises/prefetch?${new URLSearchParams(params)}`);
+        prefetched = {data: res.data, expiresAt: Date.now() + res.data.expires_in * 1000};
+        for (let exercise of res.data.exercises) {
+            new Image().src = exercise['posterUrl'] || exercise['gifUrl'];
+            if (exercise['smallGifUrl']) {
+                new Image().src = exercise['smallGifUrl'];
+            }
+        }
+    } catch (e) {
+        // The break fetches its exercises when it starts instead
+        console.error(e);
+    }
+}
+
+/**
+ * Return page of exercises fetched from database, continuing from cursor if given
+ * The page after a prefetched one is fetched with its token, or with seed and cursor once it expired
+ * Cached pages are reused if the server reports they have not changed
  * Show alerts if exercises were not found for current settings, or for error retrieving exercises
  */
-async function fetchExercises() {
+async function fetchExercises(cursor) {
     try {
-        res = await axios.get('./exercises');
-        if (!res.data.exercises_found) {
-            showAlert('warning', 'No exercises found for current equipment/target settings. Please try adjusting your selections. Displaying default bodyweight exercises.')
+        const params = {sample: SAMPLE_SIZE};
+        const token = prefetchToken && Date.now() < prefetchToken.expiresAt ? prefetchToken.token : null;
+        prefetchToken = null;
+        if (token) {
+            params.token = token;
+        } else {
+            params.seed = seed;
+            if (cursor) {
+                params.cursor = cursor;
+            }
+        }
+        const url = `./exercises?${new URLSearchParams(params)}`;
+        const cached = exerciseCache.get(url);
+
+        res = await request(url, {headers: cached ? {'If-None-Match': cached.etag} : {}}, token ? [304, 400] : [304]);
+        if (res.status === 400) {
+            // Token expired on the way, continue from the cursor it was given with
+            return fetchExercises(cursor);
         }
-        return _.shuffle(res.data.exercises);
+        let data = res.data;
+        if (res.status === 304) {
+            data = cached.data;
+        } else if (res.headers.get('ETag')) {
+            exerciseCache.set(url, {etag: res.headers.get('ETag'), data: data});
+        }
+
+        return useExercisePage(data);
     } catch (e) {
         showAlert('danger', 'Could not retrieve exercises.')
         console.error(e);
@@ -109,12 +218,56 @@ async function fetchExercises() {
 }
 
 /**
- * Display next exercise in exercises lsit
+ * Return exercises recommended for the rest of the break, leaving out those already shown during it
  */
-function showNextExercise() {
+async function recommendExercises() {
+    try {
+        const params = {count: SAMPLE_SIZE, exclude: shownIds.join(',')};
+        const res = await request(`./exercises/recommended?${new URLSearchParams(params)}`);
+        return res.data.exercises;
+    } catch (e) {
+        // Page through exercises in their random order instead
+        console.error(e);
+        return fetchExercises(nextCursor);
+    }
+}
+
+/**
+ * Return exercises of fetched page, continuing paging after it
+ * Show alert if exercises were not found for current settings
+ */
+function useExercisePage(data) {
+    if (!data.exercises_found) {
+        showAlert('warning', 'No exercises found for current equipment/target settings. Please try adjusting your selections. Displaying default bodyweight exercises.')
+    }
+    nextCursor = data.next_cursor;
+    prefetchToken = null;
+    return data.exercises.slice();
+}
+
+/**
+ * Display next exercise in exercises list
+ * Fetch recommended exercises once the current page has been shown, repeating the page if there are none
+ */
+async function showNextExercise() {
+    if (exerciseIdx >= exercises.length) {
+        const nextExercises = await recommendExercises();
+        if (nextExercises && nextExercises.length) {
+            exercises = nextExercises;
+            exerciseIdx = 0;
+        }
+    }
+    if (!exercises.length) {
+        return;
+    }
+
     exercise = exercises[exerciseIdx % exercises.length];
     currExerciseId = exercise['id']
-    $exerciseImg.attr('src', exercise['gifUrl']);
+    logEvent('shown', currExerciseId);
+    if (shownIds.length < MAX_EXCLUDE) {
+        shownIds.push(currExerciseId);
+    }
+    showExerciseImage(exercise);
     $exerciseImg.attr('alt', exercise['name']);
     $exerciseName.text(exercise['name']);
     $instructions.empty();
@@ -125,6 +278,68 @@ function showNextExercise() {
     exerciseIdx++;
 }
 
+/**
+ * Show exercise's poster frame right away, if it has one, and switch to its animation once loaded
+ */
+function showExerciseImage(exercise) {
+    const animationUrl = exercise['smallGifUrl'] || exercise['gifUrl'];
+    if (!exercise['posterUrl']) {
+        $exerciseImg.attr('src', animationUrl);
+        return;
+    }
+
+    $exerciseImg.attr('src', exercise['posterUrl']);
+    const animation = new Image();
+    animation.onload = () => {
+        if (currExerciseId === exercise['id']) {
+            $exerciseImg.attr('src', animationUrl);
+        }
+    };
+    animation.src = animationUrl;
+}
+
+/**
+ * Skip current exercise, showing the next one
+ */
+async function skipExercise() {
+    logEvent('skipped', currExerciseId);
+    await showNextExercise();
+}
+
+/**
+ * Add event to the logged in user's break history, sent with the next batch
+ */
+function logEvent(kind, exerciseId) {
+    if (!userId || pendingEvents.length >= MAX_PENDING_EVENTS) {
+        return;
+    }
+    pendingEvents.push(exerciseId ? {kind: kind, exercise_id: exerciseId} : {kind: kind});
+}
+
+/**
+ * Send pending break history events, with a beacon when the page is being closed
+ * Events refused because the server is busy are kept for the next batch
+ */
+async function sendEvents(closing) {
+    if (!pendingEvents.length) {
+        return;
+    }
+    const events = pendingEvents.splice(0, 100);
+    if (closing === true && navigator.sendBeacon) {
+        navigator.sendBeacon('./events', new Blob([JSON.stringify({events: events})], {type: 'application/json'}));
+        return;
+    }
+    try {
+        await postJSON('./events', {events: events});
+    } catch (e) {
+        if (e.response && e.response.status === 503) {
+            pendingEvents = events.concat(pendingEvents).slice(0, MAX_PENDING_EVENTS);
+        } else {
+            console.error(e);
+        }
+    }
+}
+
 /**
  * Display alert styled for given type with given message
  */
@@ -140,18 +355,13 @@ function showAlert(type, message) {
  */
 async function blockExercise() {
     try {
-        res = await axios.post(`./users/${userId}/block`, {exercise_id: currExerciseId});
+        res = await postJSON(`./users/${userId}/block`, {exercise_id: currExerciseId});
         if (res.status === 201) {
             exerciseIdx--;
             exercises.splice(exerciseIdx, 1);
 
-            // Fetch new exercises (will default to bodyweight exercises) if blocking leads to no exercises left
-            if (exercises.length === 0) {
-                exerciseIdx = 0;
-                exercises = await fetchExercises();
-            }
-
-            showNextExercise();
+            // Next page (or new exercises, defaulting to bodyweight exercises) is fetched if this was the last one
+            await showNextExercise();
         } else {
             showAlert('danger', 'Unauthorized to block exercise.')
         }
@@ -164,7 +374,9 @@ async function blockExercise() {
 $startButton.on('click', startTimer);
 $resetButton.on('click', resetTimer);
 $blockButton.on('click', blockExercise);
-$nextButton.on('click', showNextExercise);
+$nextButton.on('click', skipExercise);
+setInterval(sendEvents, EVENT_SEND_INTERVAL);
+window.addEventListener('pagehide', () => sendEvents(true));
 $( document ).ready(() => {
     if (!userId) {
         $blockButton.hide();
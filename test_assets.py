@@ -0,0 +1,119 @@
+"""Static asset bundle tests"""
+
+# Run with python -m unittest test_assets.py
+
+import gzip
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///movement_test"
+
+from app import app
+import brotli
+
+from assets import MANIFEST, asset_url, build_assets
+
+class AssetsTestCase(TestCase):
+    """Test building and serving asset bundles"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Build bundles once into a temporary assets root"""
+        cls.assets_root = tempfile.TemporaryDirectory()
+        cls.root = cls.assets_root.name
+        cls.manifest = build_assets(cls.root, app.static_folder)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.assets_root.cleanup()
+
+    def setUp(self):
+        self.default_root = app.config['ASSETS_ROOT']
+        app.config['ASSETS_ROOT'] = self.root
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['ASSETS_ROOT'] = self.default_root
+
+    def read(self, name):
+        with open(os.path.join(self.root, name), 'rb') as fp:
+            return fp.read()
+
+    def test_build(self):
+        """Are bundles written under content hashed names, with compressed copies and a manifest?"""
+        manifest = self.manifest
+
+        self.assertEqual(set(manifest), {'base.css', 'base.js', 'timer.js'})
+        self.assertRegex(manifest['timer.js'], r'^timer\.[0-9a-f]{16}\.js$')
+        self.assertEqual(json.loads(self.read(MANIFEST)), manifest)
+        self.assertEqual(build_assets(self.root, app.static_folder), manifest)
+
+        timer = self.read(manifest['timer.js'])
+        self.assertIn(b'jQuery', timer)
+        self.assertIn(b'showNextExercise', timer)
+        self.assertNotIn(b'sourceMappingURL', timer)
+        self.assertEqual(gzip.decompress(self.read(manifest['timer.js'] + '.gz')), timer)
+        self.assertEqual(brotli.decompress(self.read(manifest['timer.js'] + '.br')), timer)
+
+    def test_style_urls(self):
+        """Do styles refer to hashed copies of the fonts they use?"""
+        css = self.read(self.manifest['base.css']).decode()
+        self.assertNotIn('../fonts/', css)
+        self.assertRegex(css, r"url\('fontawesome-webfont\.[0-9a-f]{16}\.woff2\?v=4\.7\.0'\)")
+        self.assertTrue(any(name.endswith('.woff2') for name in os.listdir(self.root)))
+
+    def test_asset_url(self):
+        """Are bundle URLs resolved from the manifest, and bundles built on first use if there is none?"""
+        with app.app_context():
+            self.assertEqual(asset_url('timer.js'), '/assets/' + self.manifest['timer.js'])
+        page = self.client.get('/login').get_data(as_text=True)
+        self.assertIn(f'href="/assets/{self.manifest["base.css"]}"', page)
+        self.assertIn(f'src="/assets/{self.manifest["base.js"]}"', page)
+        self.assertNotIn('cdn', page)
+
+        with tempfile.TemporaryDirectory() as root:
+            app.config['ASSETS_ROOT'] = root
+            with app.app_context():
+                self.assertEqual(asset_url('timer.js'), '/assets/' + self.manifest['timer.js'])
+            self.assertTrue(os.path.exists(os.path.join(root, MANIFEST)))
+
+    def test_serve_encodings(self):
+        """Are assets served compressed as the client accepts, with immutable cache headers?"""
+        name = self.manifest['timer.js']
+        timer = self.read(name)
+
+        response = self.client.get(f'/assets/{name}')
+        self.assertEqual(response.get_data(), timer)
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+        self.assertIn(response.mimetype, ('text/javascript', 'application/javascript'))
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        response.close()
+
+        response = self.client.get(f'/assets/{name}', headers={'Accept-Encoding': 'gzip, br;q=0'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.get_data()), timer)
+        response.close()
+
+        response = self.client.get(f'/assets/{name}', headers={'Accept-Encoding': 'gzip, deflate, br'})
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(response.mimetype, self.client.get(f'/assets/{name}').mimetype)
+        self.assertEqual(brotli.decompress(response.get_data()), timer)
+        response.close()
+
+        # Fonts are sent compressed with brotli too, woff2 fonts as they are
+        css = self.read(self.manifest['base.css']).decode()
+        for name in os.listdir(self.root):
+            if name.startswith('fontawesome-webfont.') and name.endswith(('.ttf', '.woff2')):
+                self.assertIn(name, css)
+                response = self.client.get(f'/assets/{name}', headers={'Accept-Encoding': 'br'})
+                self.assertEqual(response.headers.get('Content-Encoding'), 'br' if name.endswith('.ttf') else None)
+                response.close()
+
+    def test_serve_not_found(self):
+        """Do unknown or malformed asset names return 404?"""
+        self.assertEqual(self.client.get(f'/assets/timer.{"0" * 16}.js').status_code, 404)
+        self.assertEqual(self.client.get(f'/assets/{MANIFEST}').status_code, 404)
+        self.assertEqual(self.client.get('/assets/..%2Fapp.py').status_code, 404)
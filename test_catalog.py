@@ -0,0 +1,190 @@
+"""Catalog cache tests"""
+
+# Run with python -m unittest test_catalog.py
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, Equipment, Target, Exercise, CatalogVersion
+
+os.environ['DATABASE_URL'] = "postgresql:///movement_test"
+
+from app import app
+from catalog import Catalog, catalog_cache, update_snapshot
+
+db.create_all()
+
+class CatalogCacheTestCase(TestCase):
+    """Test in-process catalog cache"""
+
+    def setUp(self):
+        """Clear data, add sample catalog"""
+        db.drop_all()
+        db.create_all()
+
+        app.config['CATALOG_CHECK_INTERVAL'] = 0
+
+        target = Target(name="abs")
+        bodyweight = Equipment(name="body weight")
+        db.session.add_all([target, bodyweight])
+        db.session.commit()
+
+        sit_up = Exercise(name="sit-up", gif_url="sit-up.url", instructions=["Do a sit-up"],
+                          target_id=target.id, equipment_id=bodyweight.id)
+        db.session.add(sit_up)
+        CatalogVersion.bump()
+        db.session.commit()
+
+        catalog_cache.clear()
+        catalog_cache.hits = catalog_cache.misses = catalog_cache.reloads = 0
+
+        self.bodyweight_id = bodyweight.id
+        self.target_id = target.id
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['CATALOG_CHECK_INTERVAL'] = 5
+
+    def test_catalog_load(self):
+        """Does catalog contain serialized exercises, equipment and targets?"""
+        catalog = catalog_cache.get()
+
+        self.assertEqual(catalog.version, 1)
+        self.assertEqual(catalog.bodyweight_id, self.bodyweight_id)
+        self.assertEqual([catalog.exercises[exercise_id]['name'] for exercise_id in catalog.bodyweight_ids], ['sit-up'])
+        self.assertEqual(catalog.targets, [(self.target_id, 'abs')])
+
+    def test_catalog_hit(self):
+        """Is catalog reused while version is unchanged?"""
+        first = catalog_cache.get()
+        second = catalog_cache.get()
+
+        self.assertIs(first, second)
+        self.assertEqual(catalog_cache.stats()['misses'], 1)
+        self.assertEqual(catalog_cache.stats()['hits'], 1)
+        self.assertEqual(catalog_cache.stats()['reloads'], 0)
+
+    def test_catalog_reload(self):
+        """Is catalog reloaded when version is bumped?"""
+        catalog_cache.get()
+
+        db.session.add(Exercise(name="crunch", gif_url="crunch.url", instructions=["Do a crunch"],
+                                target_id=self.target_id, equipment_id=self.bodyweight_id))
+        CatalogVersion.bump()
+        db.session.commit()
+
+        catalog = catalog_cache.get()
+
+        self.assertEqual(catalog.version, 2)
+        self.assertEqual(len(catalog.bodyweight_ids), 2)
+        self.assertEqual(catalog_cache.stats()['reloads'], 1)
+
+    def test_catalog_check_interval(self):
+        """Is the stored version not checked again within the check interval?"""
+        app.config['CATALOG_CHECK_INTERVAL'] = 60
+        catalog_cache.get()
+
+        CatalogVersion.bump()
+        db.session.commit()
+
+        self.assertEqual(catalog_cache.get().version, 1)
+
+    def test_eligible(self):
+        """Does the equipment/target index filter like the original SQL query?"""
+        dumbbell = Equipment(name="dumbbell")
+        biceps = Target(name="biceps")
+        db.session.add_all([dumbbell, biceps])
+        db.session.commit()
+
+        curl = Exercise(name="bicep curl", gif_url="curl.url", instructions=["Do a bicep curl"],
+                        target_id=biceps.id, equipment_id=dumbbell.id)
+        chin_up = Exercise(name="chin-up", gif_url="chin-up.url", instructions=["Do a chin-up"],
+                           target_id=biceps.id, equipment_id=self.bodyweight_id)
+        db.session.add_all([curl, chin_up])
+        db.session.commit()
+
+        catalog = catalog_cache.get()
+        def names(*args):
+            return [catalog.exercises[exercise_id]['name']
+                    for exercise_id in catalog.ids_from_mask(catalog.eligible_mask(*args))]
+
+        self.assertEqual(names([self.bodyweight_id], [], []), ['sit-up', 'chin-up'])
+        self.assertEqual(names([self.bodyweight_id, dumbbell.id], [biceps.id], []), ['bicep curl', 'chin-up'])
+        self.assertEqual(names([self.bodyweight_id, dumbbell.id], [biceps.id], [chin_up.id]), ['bicep curl'])
+        self.assertEqual(catalog.eligible_mask([dumbbell.id], [self.target_id], []), 0)
+
+    def test_encode_exercises(self):
+        """Do pre-encoded fragments join into the same JSON as the serialized exercises, in any order?"""
+        db.session.add_all([Exercise(name=name, gif_url=f"{name}.url", instructions=[f"Do a {name}"],
+                                     target_id=self.target_id, equipment_id=self.bodyweight_id)
+                            for name in ("crunch", "plank", "burpee")])
+        CatalogVersion.bump()
+        db.session.commit()
+        catalog = catalog_cache.get()
+
+        self.assertEqual(json.loads(catalog.encode_exercises(catalog.bodyweight_ids)),
+                         [catalog.exercises[exercise_id] for exercise_id in catalog.bodyweight_ids])
+        self.assertEqual(catalog.encode_exercises([]), b'[]')
+        for exercise_ids in (catalog.ids, catalog.ids[::-1], catalog.ids[::2], catalog.ids[1:3] * 2):
+            self.assertEqual(json.loads(catalog.encode_exercises(exercise_ids)),
+                             [catalog.exercises[exercise_id] for exercise_id in exercise_ids])
+        self.assertEqual(catalog.encode_exercises(catalog.bodyweight_ids[:1], prefix=b'{"e":', suffix=b'}'),
+                         b'{"e":[' + catalog.fragment(catalog.bodyweight_ids[0]) + b']}')
+
+    def test_exercises_decoded_once(self):
+        """Are recently accessed serialized exercises kept decoded?"""
+        catalog = catalog_cache.get()
+        exercise_id = catalog.bodyweight_ids[0]
+
+        self.assertIs(catalog.exercises[exercise_id], catalog.exercises[exercise_id])
+        self.assertEqual(catalog.exercises[exercise_id]['name'], 'sit-up')
+
+    def test_retired_excluded(self):
+        """Are retired exercises left out of the catalog?"""
+        Exercise.query.update({Exercise.retired: True})
+        CatalogVersion.bump()
+        db.session.commit()
+
+        self.assertEqual(catalog_cache.get().bodyweight_ids, [])
+
+    def test_snapshot(self):
+        """Does a catalog mapped from a snapshot file match the one it was written from?"""
+        db.session.add(Exercise(name="plank", gif_url="plank.url", instructions=["Hold a plank"]))
+        db.session.commit()
+        catalog = Catalog.from_database(1)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'catalog.snapshot')
+
+        catalog.save(path)
+        mapped = Catalog.open(path)
+
+        self.assertEqual(mapped.version, 1)
+        self.assertEqual(list(mapped.ids), list(catalog.ids))
+        self.assertEqual(mapped.equipment, catalog.equipment)
+        self.assertEqual(mapped.bodyweight_ids, catalog.bodyweight_ids)
+        self.assertEqual(mapped.encode_exercises(mapped.ids), catalog.encode_exercises(catalog.ids))
+        self.assertEqual(mapped.ids_from_mask(mapped.eligible_mask([None], [], [])), [catalog.ids[-1]])
+
+        with open(path, 'r+b') as fp:
+            fp.truncate(os.path.getsize(path) - 1)
+        with self.assertRaises(ValueError):
+            Catalog.open(path)
+
+    def test_snapshot_version(self):
+        """Is the snapshot used while the catalog version is the one it was written at?"""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        app.config['CATALOG_SNAPSHOT'] = os.path.join(directory.name, 'catalog.snapshot')
+        self.addCleanup(app.config.__setitem__, 'CATALOG_SNAPSHOT', None)
+
+        update_snapshot()
+        self.assertIsInstance(catalog_cache.get().ids, memoryview)
+
+        CatalogVersion.bump()
+        db.session.commit()
+        catalog = catalog_cache.get()
+        self.assertEqual(catalog.version, 2)
+        self.assertNotIsInstance(catalog.ids, memoryview)
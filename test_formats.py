@@ -0,0 +1,131 @@
+"""Response format and compression tests"""
+
+# Run with python -m unittest test_formats.py
+
+import gzip
+import json
+import os
+from unittest import TestCase
+
+import brotli
+import msgpack
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+from models import db, Equipment, Target, Exercise
+
+os.environ['DATABASE_URL'] = "postgresql:///movement_test"
+
+from app import app
+from catalog import catalog_cache
+from formats import accepted_encoding, shared_body
+
+db.create_all()
+
+class FormatsTestCase(TestCase):
+    """Test negotiated response compression and MessagePack responses"""
+
+    def setUp(self):
+        """Clear data, add body weight exercises with long enough instructions to be compressed"""
+        db.drop_all()
+        db.create_all()
+
+        app.config['CATALOG_CHECK_INTERVAL'] = 0
+        self.client = app.test_client()
+
+        target = Target(name="abs")
+        bodyweight = Equipment(name="body weight")
+        db.session.add_all([target, bodyweight])
+        db.session.commit()
+        instructions = ["Lie on your back with your knees bent", "Slowly curl up towards your knees"]
+        db.session.add_all([Exercise(name=f"sit-up {idx}", gif_url="sit-up.url", instructions=instructions,
+                                     target_id=target.id, equipment_id=bodyweight.id) for idx in range(20)])
+        db.session.commit()
+
+        catalog_cache.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['CATALOG_CHECK_INTERVAL'] = 5
+
+    def test_compression(self):
+        """Are JSON responses compressed as the client accepts, with the same weak ETag?"""
+        identity = self.client.get('/exercises')
+        self.assertIsNone(identity.headers.get('Content-Encoding'))
+        self.assertIn('Accept-Encoding', identity.headers['Vary'])
+        self.assertTrue(identity.headers['ETag'].startswith('W/'))
+
+        response = self.client.get('/exercises', headers={'Accept-Encoding': 'gzip, br;q=0'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.get_data()), identity.get_data())
+        self.assertEqual(response.headers['ETag'], identity.headers['ETag'])
+
+        response = self.client.get('/exercises', headers={'Accept-Encoding': 'gzip, deflate, br'})
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.get_data()), identity.get_data())
+
+    def test_accepted_encoding(self):
+        """Is the accepted encoding with the highest q-value chosen, brotli among equals, never one with q=0?"""
+        cases = {'gzip, deflate, br': 'br', 'br;q=0, gzip': 'gzip', 'br;q=0.5, gzip': 'gzip', 'gzip;q=0.5, br': 'br',
+                 '*': 'br', 'gzip;q=0, *': 'br', 'br;q=0, gzip;q=0': None, 'identity': None, '': None}
+        for header, encoding in cases.items():
+            self.assertEqual(accepted_encoding(parse_accept_header(header, Accept)), encoding, header)
+        self.assertIsNone(accepted_encoding(parse_accept_header('br', Accept), ['gzip']))
+
+        response = self.client.get('/exercises', headers={'Accept-Encoding': 'br;q=0, gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+    def test_compressed_not_modified(self):
+        """Do compressed responses and their 304s carry the same ETag, which revalidates them?"""
+        etag = self.client.get('/exercises', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+
+        response = self.client.get('/exercises', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        response = self.client.get('/exercises', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_small_not_compressed(self):
+        """Are responses below COMPRESS_MIN_SIZE, or all when it is None, sent uncompressed?"""
+        response = self.client.get('/exercises?sample=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+
+        app.config['COMPRESS_MIN_SIZE'] = None
+        try:
+            response = self.client.get('/exercises', headers={'Accept-Encoding': 'gzip'})
+        finally:
+            app.config['COMPRESS_MIN_SIZE'] = 1024
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+
+    def test_shared_body(self):
+        """Are shared bodies encoded and compressed once per catalog?"""
+        encoded = []
+        def encode():
+            encoded.append(1)
+            return b'{"exercises":[]}' * 100
+
+        catalog = catalog_cache.get()
+        body = shared_body(catalog, 'test', encode)
+        self.assertIs(shared_body(catalog, 'test', encode), body)
+        self.assertEqual(len(encoded), 1)
+        self.assertIs(body.compress('gzip'), body.compress('gzip'))
+        self.assertEqual(gzip.decompress(body.compress('gzip')), body.data)
+
+        first = self.client.get('/exercises', headers={'Accept-Encoding': 'gzip'}).get_data()
+        self.assertEqual(self.client.get('/exercises', headers={'Accept-Encoding': 'gzip'}).get_data(), first)
+
+    def test_msgpack(self):
+        """Do clients preferring MessagePack get the same exercises as MessagePack, with their own ETag?"""
+        json_response = self.client.get('/exercises', headers={'Accept': '*/*'})
+        self.assertEqual(json_response.mimetype, 'application/json')
+
+        response = self.client.get('/exercises', headers={'Accept': 'application/msgpack, application/json;q=0.5'})
+        self.assertEqual(response.mimetype, 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.get_data()), json.loads(json_response.get_data()))
+        self.assertNotEqual(response.headers['ETag'], json_response.headers['ETag'])
+        self.assertIn('Accept', response.headers['Vary'])
+
+        page = self.client.get('/exercises?sample=2&seed=1', headers={'Accept': 'application/x-msgpack'})
+        self.assertEqual(msgpack.unpackb(page.get_data()),
+                         json.loads(self.client.get('/exercises?sample=2&seed=1').get_data()))
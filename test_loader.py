@@ -0,0 +1,184 @@
+"""Catalog loader tests"""
+
+# Run with python -m unittest test_loader.py
+
+import io
+import json
+import os
+from unittest import TestCase
+
+from models import db, User, Equipment, Target, Exercise, BlockedExercise, CatalogVersion
+
+os.environ['DATABASE_URL'] = "postgresql:///movement_test"
+
+from app import app
+from loader import iter_records, load_catalog, sync_catalog
+
+db.create_all()
+
+RECORDS = [
+    {'name': 'sit-up', 'gifUrl': 'sit-up.url', 'instructions': ['Do a sit-up'],
+     'equipment': 'body weight', 'target': 'abs'},
+    {'name': 'bicep curl', 'gifUrl': 'curl.url', 'instructions': ['Do a bicep curl', 'Lower the weight'],
+     'equipment': 'dumbbell', 'target': 'biceps'},
+    {'name': 'chin-up', 'gifUrl': 'chin-up.url', 'instructions': ['Do a chin-up'],
+     'equipment': 'body weight', 'target': 'biceps'},
+]
+
+class IterRecordsTestCase(TestCase):
+    """Test streaming dump reader"""
+
+    def test_json_array(self):
+        """Are records read from a JSON array across chunk boundaries?"""
+        dump = io.StringIO(json.dumps(RECORDS, indent=2))
+        self.assertEqual(list(iter_records(dump, chunk_size=16)), RECORDS)
+
+    def test_ndjson(self):
+        """Are records read from newline-delimited JSON?"""
+        dump = io.StringIO('\n'.join(json.dumps(record) for record in RECORDS) + '\n')
+        self.assertEqual(list(iter_records(dump, chunk_size=16)), RECORDS)
+
+    def test_empty(self):
+        """Do empty dumps yield no records?"""
+        self.assertEqual(list(iter_records(io.StringIO('[]'))), [])
+        self.assertEqual(list(iter_records(io.StringIO(''))), [])
+
+    def test_truncated(self):
+        """Does a truncated dump raise an error?"""
+        dump = io.StringIO(json.dumps(RECORDS)[:-20])
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_records(dump, chunk_size=16))
+
+
+class LoadCatalogTestCase(TestCase):
+    """Test bulk catalog loading"""
+
+    def setUp(self):
+        """Clear data, add existing equipment"""
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(Equipment(name="body weight"))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_load_catalog(self):
+        """Are exercises loaded with equipment and targets resolved by name?"""
+        stats = load_catalog(iter(RECORDS), batch_size=2)
+
+        self.assertEqual(stats['exercises'], 3)
+        self.assertEqual(stats['equipment'], 1)
+        self.assertEqual(stats['targets'], 2)
+        self.assertEqual(Equipment.query.count(), 2)
+        self.assertEqual(CatalogVersion.current(), 1)
+
+        curl = Exercise.query.filter_by(name='bicep curl').one()
+        self.assertEqual(curl.equipment.name, 'dumbbell')
+        self.assertEqual(curl.target.name, 'biceps')
+        self.assertEqual(curl.instructions, ['Do a bicep curl', 'Lower the weight'])
+        self.assertEqual(len(Target.query.filter_by(name='biceps').one().exercises), 2)
+
+    def test_load_catalog_not_empty(self):
+        """Does loading into an existing catalog fail?"""
+        load_catalog(iter(RECORDS))
+
+        with self.assertRaises(ValueError):
+            load_catalog(iter(RECORDS))
+
+
+class SyncCatalogTestCase(TestCase):
+    """Test incremental catalog sync"""
+
+    def setUp(self):
+        """Clear data, load catalog and add user blocking an exercise"""
+        db.drop_all()
+        db.create_all()
+
+        self.records = [dict(record, id=f'{idx:04}') for idx, record in enumerate(RECORDS)]
+        load_catalog(iter(self.records))
+
+        user = User.register("test", "password")
+        db.session.add(user)
+        db.session.commit()
+
+        self.chinup_id = Exercise.query.filter_by(source_id='0002').one().id
+        db.session.add(BlockedExercise(user_id=user.id, exercise_id=self.chinup_id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_sync_unchanged(self):
+        """Does syncing an unchanged catalog leave the version alone?"""
+        stats = sync_catalog(iter(self.records))
+
+        self.assertEqual(stats['unchanged'], 3)
+        self.assertEqual(stats['inserted'] + stats['updated'] + stats['retired'], 0)
+        self.assertEqual(CatalogVersion.current(), 1)
+
+    def test_sync_changes(self):
+        """Are new, changed and removed exercises inserted, updated and retired, keeping user data?"""
+        records = [dict(self.records[0], instructions=['Do a slower sit-up']),
+                   self.records[1],
+                   {'id': '0003', 'name': 'plank', 'gifUrl': 'plank.url', 'instructions': ['Hold a plank'],
+                    'equipment': 'body weight', 'target': 'core'}]
+        stats = sync_catalog(iter(records), batch_size=1)
+
+        self.assertEqual((stats['inserted'], stats['updated'], stats['retired'], stats['unchanged']), (1, 1, 1, 1))
+        self.assertEqual(stats['targets'], 1)
+        self.assertEqual(CatalogVersion.current(), 2)
+
+        db.session.expire_all()
+        self.assertEqual(Exercise.query.filter_by(source_id='0000').one().instructions, ['Do a slower sit-up'])
+        self.assertTrue(Exercise.query.get(self.chinup_id).retired)
+        self.assertEqual(Exercise.query.filter_by(name='plank').one().target.name, 'core')
+        self.assertEqual(BlockedExercise.query.count(), 1)
+        self.assertEqual(User.query.count(), 1)
+
+    def test_sync_failure_bumps_version(self):
+        """Is the version bumped for batches written before a sync fails?"""
+        records = [{'id': '0003', 'name': 'plank', 'gifUrl': 'plank.url', 'instructions': ['Hold a plank'],
+                    'equipment': 'body weight', 'target': 'core'},
+                   {'id': '0004', 'name': 'broken'}]
+
+        with self.assertRaises(KeyError):
+            sync_catalog(iter(records), batch_size=1)
+
+        self.assertEqual(Exercise.query.filter_by(name='plank').count(), 1)
+        self.assertEqual(CatalogVersion.current(), 2)
+
+    def test_sync_restores_retired(self):
+        """Is a retired exercise restored when it reappears?"""
+        sync_catalog(iter(self.records[:2]))
+        stats = sync_catalog(iter(self.records))
+
+        self.assertEqual(stats['updated'], 1)
+        db.session.expire_all()
+        self.assertFalse(Exercise.query.get(self.chinup_id).retired)
+
+    def test_sync_legacy_rows(self):
+        """Are exercises loaded without ExerciseDB ids matched on name?"""
+        Exercise.query.update({Exercise.source_id: None, Exercise.content_hash: None})
+        db.session.commit()
+
+        stats = sync_catalog(iter(self.records))
+
+        self.assertEqual((stats['inserted'], stats['updated'], stats['retired']), (0, 3, 0))
+        db.session.expire_all()
+        self.assertEqual(Exercise.query.get(self.chinup_id).source_id, '0002')
+
+    def test_sync_keeps_cached_gif(self):
+        """Is a cached GIF kept when other fields change, and dropped when the GIF URL changes?"""
+        Exercise.query.update({Exercise.gif_digest: 'digest'})
+        db.session.commit()
+
+        records = [dict(self.records[0], instructions=['Do a slower sit-up']),
+                   dict(self.records[1], gifUrl='new-curl.url'),
+                   self.records[2]]
+        sync_catalog(iter(records))
+
+        db.session.expire_all()
+        self.assertEqual(Exercise.query.filter_by(source_id='0000').one().gif_digest, 'digest')
+        self.assertIsNone(Exercise.query.filter_by(source_id='0001').one().gif_digest)
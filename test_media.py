@@ -0,0 +1,181 @@
+"""Exercise media tests"""
+
+# Run with python -m unittest test_media.py
+
+import hashlib
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, Equipment, Target, Exercise, CatalogVersion
+
+os.environ['DATABASE_URL'] = "postgresql:///movement_test"
+
+from app import app
+from media import MediaStore, RENDITION_SIZE, cache_exercise_media, make_renditions, media_url
+from PIL import Image
+
+db.create_all()
+
+# Smallest valid GIF, a single transparent pixel
+PIXEL = (b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00'
+         b',\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;')
+
+def animated_gif(size=(480, 360), frames=3):
+    """Return GIF data of an animation of frames solid frames of size"""
+
+    images = [Image.new('RGB', size, (80 * idx, 40, 120)) for idx in range(frames)]
+    data = io.BytesIO()
+    images[0].save(data, format='GIF', save_all=True, append_images=images[1:], duration=100, loop=0)
+    return data.getvalue()
+
+class StubFetcher:
+    """Fetcher returning content from a dict of URLs instead of the network, recording requested URLs"""
+
+    def __init__(self, content):
+        self.content = content
+        self.requested = []
+
+    def __call__(self, url):
+        self.requested.append(url)
+        if url not in self.content:
+            raise IOError(f'{url} not found')
+        return self.content[url]
+
+
+class MediaTestCase(TestCase):
+    """Test media store, fetching and serving"""
+
+    def setUp(self):
+        """Clear data, add exercises and use a temporary media root"""
+        db.drop_all()
+        db.create_all()
+
+        equipment = Equipment(name='body weight')
+        target = Target(name='abs')
+        db.session.add_all([equipment, target])
+        db.session.flush()
+        sit_up = Exercise(name='sit-up', gif_url='http://example.com/sit-up.gif', instructions=['Do a sit-up'],
+                          equipment_id=equipment.id, target_id=target.id)
+        plank = Exercise(name='plank', gif_url='http://example.com/plank.gif', instructions=['Hold a plank'],
+                         equipment_id=equipment.id, target_id=target.id)
+        db.session.add_all([sit_up, plank])
+        db.session.commit()
+        self.sit_up_id = sit_up.id
+        self.plank_id = plank.id
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        app.config['MEDIA_ROOT'] = media_root.name
+        self.store = MediaStore(media_root.name)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['MEDIA_ACCEL_REDIRECT'] = None
+
+    def test_store_content_addressed(self):
+        """Are GIFs stored once under the digest of their content?"""
+        digest = self.store.put(PIXEL)
+
+        self.assertEqual(digest, hashlib.sha256(PIXEL).hexdigest())
+        self.assertEqual(self.store.put(PIXEL), digest)
+        with open(self.store.path(digest), 'rb') as fp:
+            self.assertEqual(fp.read(), PIXEL)
+
+    def test_cache_exercise_media(self):
+        """Are GIFs fetched for exercises without one, and the catalog version bumped?"""
+        fetcher = StubFetcher({'http://example.com/sit-up.gif': PIXEL})
+
+        stats = cache_exercise_media(self.store, fetcher)
+
+        self.assertEqual((stats['exercises'], stats['failed']), (1, 1))
+        self.assertEqual(CatalogVersion.current(), 1)
+        sit_up = Exercise.query.get(self.sit_up_id)
+        self.assertEqual(sit_up.gif_digest, hashlib.sha256(PIXEL).hexdigest())
+        self.assertIsNone(Exercise.query.get(self.plank_id).gif_digest)
+
+        # Only exercises still without a GIF are fetched again
+        fetcher.requested.clear()
+        cache_exercise_media(self.store, fetcher)
+        self.assertEqual(fetcher.requested, ['http://example.com/plank.gif'])
+
+    def test_serialize_local_urls(self):
+        """Do exercises with a cached GIF point at the local media URLs, and at renditions only if made?"""
+        cache_exercise_media(self.store, StubFetcher({'http://example.com/sit-up.gif': PIXEL,
+                                                      'http://example.com/plank.gif': b'GIF89a not a GIF'}))
+        digest = hashlib.sha256(PIXEL).hexdigest()
+
+        serialized = Exercise.query.get(self.sit_up_id).serialize()
+        self.assertEqual(serialized['gifUrl'], f'/media/{digest}.gif')
+        self.assertEqual(serialized['posterUrl'], media_url(digest, 'poster'))
+        self.assertEqual(serialized['smallGifUrl'], media_url(digest, 'small'))
+
+        serialized = Exercise.query.get(self.plank_id).serialize()
+        self.assertEqual(serialized['gifUrl'], media_url(hashlib.sha256(b'GIF89a not a GIF').hexdigest()))
+        self.assertNotIn('posterUrl', serialized)
+        self.assertNotIn('smallGifUrl', serialized)
+
+    def test_make_renditions(self):
+        """Are a PNG poster frame and a smaller animation made, no larger than RENDITION_SIZE?"""
+        renditions = make_renditions(animated_gif())
+
+        poster = Image.open(io.BytesIO(renditions['poster']))
+        self.assertEqual(poster.format, 'PNG')
+        self.assertEqual(poster.size, (RENDITION_SIZE, RENDITION_SIZE * 3 // 4))
+
+        small = Image.open(io.BytesIO(renditions['small']))
+        self.assertEqual(small.format, 'GIF')
+        self.assertEqual(small.size, (RENDITION_SIZE, RENDITION_SIZE * 3 // 4))
+        self.assertEqual(small.n_frames, 3)
+
+    def test_add_missing_renditions(self):
+        """Are renditions made for GIFs cached without them?"""
+        cache_exercise_media(self.store, StubFetcher({'http://example.com/sit-up.gif': PIXEL}))
+        digest = hashlib.sha256(PIXEL).hexdigest()
+        for rendition in ('poster', 'small'):
+            os.remove(self.store.path(digest, rendition))
+        Exercise.query.filter_by(id=self.sit_up_id).update({Exercise.gif_renditions: False})
+        db.session.commit()
+
+        cache_exercise_media(self.store, StubFetcher({}))
+
+        self.assertTrue(Exercise.query.get(self.sit_up_id).gif_renditions)
+        self.assertTrue(self.store.has_renditions(digest))
+
+    def test_serve_media(self):
+        """Is cached media and its renditions served with long-lived cache headers?"""
+        digest = self.store.put(PIXEL)
+
+        response = self.client.get(f'/media/{digest}.gif')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), PIXEL)
+        self.assertEqual(response.mimetype, 'image/gif')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response.close()
+
+        response = self.client.get(f'/media/{digest}.poster.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/png')
+        response.close()
+
+    def test_serve_media_not_found(self):
+        """Do unknown or malformed media names, and renditions that were not made, return 404?"""
+        self.assertEqual(self.client.get(f'/media/{"0" * 64}.gif').status_code, 404)
+        self.assertEqual(self.client.get('/media/..%2Fapp.py').status_code, 404)
+        self.assertEqual(self.client.get(f'/media/{"0" * 64}.poster.gif').status_code, 404)
+
+        digest = self.store.put(b'GIF89a not a GIF')
+        self.assertEqual(self.client.get(f'/media/{digest}.gif').status_code, 200)
+        self.assertEqual(self.client.get(f'/media/{digest}.poster.png').status_code, 404)
+
+    def test_accel_redirect(self):
+        """Is media handed to nginx with X-Accel-Redirect when configured?"""
+        digest = self.store.put(PIXEL)
+        app.config['MEDIA_ACCEL_REDIRECT'] = '/_media/'
+
+        response = self.client.get(f'/media/{digest}.gif')
+
+        self.assertEqual(response.headers['X-Accel-Redirect'], f'/_media/{digest[:2]}/{digest}.gif')
+        self.assertEqual(response.get_data(), b'')
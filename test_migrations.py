@@ -0,0 +1,137 @@
+"""Schema migration tests"""
+
+# Run with python -m unittest test_migrations.py
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import inspect, text
+
+from models import db, User, Equipment, Target, Exercise, BlockedExercise, EquipmentPreferences, TargetPreferences
+
+os.environ['DATABASE_URL'] = "postgresql:///movement_test"
+
+from app import app
+from migrations import MIGRATIONS, migrate
+
+def reset_database():
+    """Drop all tables, including the migration history"""
+
+    db.session.remove()
+    db.drop_all()
+    with db.engine.begin() as connection:
+        connection.execute(text('DROP TABLE IF EXISTS schema_migrations'))
+
+def schema():
+    """Return {table: (columns, indexes)} of the database"""
+
+    inspector = inspect(db.engine)
+    return {table: ({column['name'] for column in inspector.get_columns(table)},
+                    {index['name'] for index in inspector.get_indexes(table)})
+            for table in inspector.get_table_names() if table != 'schema_migrations'}
+
+class MigrateTestCase(TestCase):
+    """Test applying migrations"""
+
+    def setUp(self):
+        reset_database()
+
+    def tearDown(self):
+        db.session.rollback()
+        reset_database()
+        db.create_all()
+
+    def test_migrate_matches_models(self):
+        """Does migrating an empty database give the schema declared by the models?"""
+        applied = migrate(db.engine)
+        self.assertEqual([migration.version for migration in applied], [m.version for m in MIGRATIONS])
+        migrated = schema()
+
+        reset_database()
+        db.create_all()
+        self.assertEqual(migrated, schema())
+
+    def test_migrate_up_to_date(self):
+        """Does migrating again apply nothing?"""
+        migrate(db.engine)
+        self.assertEqual(migrate(db.engine), [])
+
+    def test_upgrade_keeps_data(self):
+        """Are later migrations applied to a database at the baseline, keeping its rows?"""
+        migrate(db.engine, target=1)
+        with db.engine.begin() as connection:
+            connection.execute(text("INSERT INTO users (username, password_hash) VALUES ('test', 'hash')"))
+
+        applied = migrate(db.engine)
+
+        self.assertEqual(applied[0].version, 2)
+        self.assertEqual(User.query.one().preferences_version, 0)
+        self.assertIn('ix_blocked_exercises_exercise_id', schema()['blocked_exercises'][1])
+
+    def test_adopt_existing_database(self):
+        """Is a database created before migrations adopted without changes?"""
+        db.create_all()
+        user = User(username='test', password_hash='hash')
+        db.session.add(user)
+        db.session.commit()
+
+        migrate(db.engine)
+
+        self.assertEqual(User.query.count(), 1)
+
+
+class IndexUsageTestCase(TestCase):
+    """Test that queries on the association columns use the migrated indexes"""
+
+    @classmethod
+    def setUpClass(cls):
+        reset_database()
+        migrate(db.engine)
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.rollback()
+        reset_database()
+        db.create_all()
+
+    def setUp(self):
+        body_weight = Equipment(name='body weight')
+        dumbbell = Equipment(name='dumbbell')
+        abs = Target(name='abs')
+        user = User(username='test', password_hash='hash')
+        db.session.add_all([body_weight, dumbbell, abs, user])
+        db.session.flush()
+        self.exercises = [Exercise(name=f'exercise {idx}', gif_url='', instructions=[],
+                                   equipment_id=(body_weight.id, dumbbell.id)[idx % 2], target_id=abs.id)
+                          for idx in range(10)]
+        db.session.add_all(self.exercises)
+        db.session.flush()
+        db.session.add(BlockedExercise(user_id=user.id, exercise_id=self.exercises[0].id))
+        db.session.flush()
+
+        self.body_weight_id = body_weight.id
+        self.abs_id = abs.id
+        self.user_id = user.id
+
+        # Tables this small would be scanned, make the planner use an index if one applies
+        db.session.execute(text('SET LOCAL enable_seqscan = off'))
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def plan(self, query):
+        """Return EXPLAIN output of query"""
+        sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        return '\n'.join(line for (line,) in db.session.execute(text(f'EXPLAIN {sql}')))
+
+    def test_association_second_column(self):
+        """Are association rows looked up by their second key column through an index?"""
+        self.assertIn('ix_blocked_exercises_exercise_id',
+                      self.plan(db.session.query(BlockedExercise.user_id)
+                                .filter(BlockedExercise.exercise_id == self.exercises[0].id)))
+        self.assertIn('ix_equipment_preferences_equipment_id',
+                      self.plan(db.session.query(EquipmentPreferences.user_id)
+                                .filter(EquipmentPreferences.equipment_id == self.body_weight_id)))
+        self.assertIn('ix_target_preferences_target_id',
+                      self.plan(db.session.query(TargetPreferences.user_id)
+                                .filter(TargetPreferences.target_id == self.abs_id)))
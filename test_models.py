@@ -7,6 +7,7 @@ from sqlalchemy.exc import IntegrityError
 from unittest import TestCase
 
 from models import db, User, Exercise, Equipment, Target, BlockedExercise
+from passwords import auth_latency
 
 os.environ['DATABASE_URL'] = "postgresql:///movement_test"
 
@@ -138,6 +139,31 @@ class UserModelTestCase(TestCase):
         self.assertFalse(invalid_username)
         self.assertFalse(invalid_password)
     
+    def test_login_rehash(self):
+        """Is password rehashed on login when the configured cost changes?"""
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        try:
+            login_user = User.login(self.user.username, "password")
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+        self.assertEqual(login_user, self.user)
+        self.assertTrue(login_user.password_hash.startswith('$2b$04$'))
+        self.assertEqual(User.login(self.user.username, "password"), self.user)
+        self.assertTrue(login_user.password_hash.startswith('$2b$12$'))
+
+    def test_hash_in_thread(self):
+        """Does hashing work without a process pool, and is its latency recorded?"""
+        app.config['BCRYPT_POOL_SIZE'] = 0
+        count = auth_latency['hash'].count
+        try:
+            user = User.register("test5", "password")
+        finally:
+            app.config['BCRYPT_POOL_SIZE'] = 2
+
+        self.assertTrue(user.password_hash.startswith('$2b$12$'))
+        self.assertEqual(auth_latency['hash'].count, count + 1)
+
     # Exercise preference tests
     def test_preferences(self):
         """Do user Equipment and Target preferences work?"""
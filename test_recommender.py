@@ -0,0 +1,102 @@
+"""Exercise recommender tests"""
+
+# Run with python -m unittest test_recommender.py
+
+import os
+from collections import Counter
+from unittest import TestCase
+
+from models import db, Equipment, Target, Exercise, User, UserContext, BreakEvent
+
+os.environ['DATABASE_URL'] = "postgresql:///movement_test"
+
+from app import app
+from catalog import catalog_cache
+from recommender import recommend
+
+db.create_all()
+
+DRAWS = 400
+
+class RecommenderTestCase(TestCase):
+    """Test weighted exercise recommendations"""
+
+    def setUp(self):
+        """Clear data, add one abs exercise and ten biceps exercises"""
+        db.drop_all()
+        db.create_all()
+
+        app.config['CATALOG_CHECK_INTERVAL'] = 0
+
+        abs_target = Target(name="abs")
+        biceps = Target(name="biceps")
+        bodyweight = Equipment(name="body weight")
+        db.session.add_all([abs_target, biceps, bodyweight])
+        db.session.commit()
+
+        sit_up = Exercise(name="sit-up", gif_url="sit-up.url", instructions=["Do a sit-up"],
+                          target_id=abs_target.id, equipment_id=bodyweight.id)
+        curls = [Exercise(name=f"curl {i}", gif_url="curl.url", instructions=["Do a curl"],
+                          target_id=biceps.id, equipment_id=bodyweight.id) for i in range(10)]
+        db.session.add_all([sit_up] + curls)
+        db.session.commit()
+
+        catalog_cache.clear()
+        self.catalog = catalog_cache.get()
+        self.mask = self.catalog.equipment_index[bodyweight.id]
+        self.sit_up_id = sit_up.id
+        self.curl_ids = [curl.id for curl in curls]
+        self.abs_id = abs_target.id
+        self.biceps_id = biceps.id
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['CATALOG_CHECK_INTERVAL'] = 5
+
+    def draw_counts(self, context=None):
+        """Return Counter of exercise ids drawn one at a time DRAWS times"""
+        return Counter(recommend(self.catalog, self.mask, 1, context, seed=seed)[0] for seed in range(DRAWS))
+
+    def test_without_replacement(self):
+        """Are eligible exercises drawn at most once, with exclusions left out unless none remain?"""
+        self.assertEqual(sorted(recommend(self.catalog, self.mask, 20, seed=1)), sorted([self.sit_up_id] + self.curl_ids))
+        self.assertEqual(sorted(recommend(self.catalog, self.mask, 20, exclude=self.curl_ids, seed=1)),
+                         [self.sit_up_id])
+        self.assertEqual(len(recommend(self.catalog, self.mask, 5, exclude=[self.sit_up_id] + self.curl_ids)), 5)
+        self.assertEqual(recommend(self.catalog, 0, 5), [])
+
+    def test_target_diversity(self):
+        """Are targets drawn evenly, however many exercises they have?"""
+        drawn = self.draw_counts()
+        self.assertTrue(DRAWS * 0.35 < drawn[self.sit_up_id] < DRAWS * 0.65, drawn)
+
+    def test_context(self):
+        """Are target preferences, blocked and recently shown or skipped exercises weighed in?"""
+        context = UserContext(None, [], [self.abs_id], [])
+        self.assertGreater(self.draw_counts(context)[self.sit_up_id], DRAWS * 0.75)
+
+        context = UserContext(None, [], [], self.curl_ids[:5])
+        self.assertGreater(self.draw_counts(context)[self.sit_up_id], DRAWS * 0.6)
+
+        context = UserContext(None, [], [], [], recent_ids=[self.sit_up_id], skipped_ids=[])
+        self.assertLess(self.draw_counts(context)[self.sit_up_id], DRAWS * 0.1)
+
+        context = UserContext(None, [], [], [], recent_ids=[], skipped_ids=[self.sit_up_id] * 3)
+        self.assertLess(self.draw_counts(context)[self.sit_up_id], DRAWS * 0.25)
+
+    def test_load_context_history(self):
+        """Are recently shown and skipped exercises loaded with the user context?"""
+        user = User.register(username="test", password="password")
+        db.session.add(user)
+        db.session.commit()
+        db.session.add_all([BreakEvent(user_id=user.id, kind='shown', exercise_id=self.curl_ids[0]),
+                            BreakEvent(user_id=user.id, kind='skipped', exercise_id=self.curl_ids[0]),
+                            BreakEvent(user_id=user.id, kind='work_completed')])
+        db.session.commit()
+        db.session.add(BreakEvent(user_id=user.id, kind='shown', exercise_id=self.sit_up_id))
+        db.session.commit()
+
+        context = User.load_context(user.id, history=True)
+        self.assertEqual(context.recent_ids, [self.sit_up_id, self.curl_ids[0]])
+        self.assertEqual(context.skipped_ids, [self.curl_ids[0]])
+        self.assertIsNone(User.load_context(user.id).recent_ids)
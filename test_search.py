@@ -0,0 +1,93 @@
+"""Exercise search tests"""
+
+# Run with python -m unittest test_search.py
+
+import os
+from unittest import TestCase
+
+from models import db, CatalogVersion, Equipment, Target, Exercise
+
+os.environ['DATABASE_URL'] = "postgresql:///movement_test"
+
+from app import app
+from catalog import catalog_cache
+from search import _indexes, search, search_index
+
+db.create_all()
+
+class SearchTestCase(TestCase):
+    """Test in-process exercise search"""
+
+    def setUp(self):
+        """Clear data, add sample catalog"""
+        db.drop_all()
+        db.create_all()
+
+        app.config['CATALOG_CHECK_INTERVAL'] = 0
+
+        target = Target(name="abs")
+        bodyweight = Equipment(name="body weight")
+        dumbbell = Equipment(name="dumbbell")
+        db.session.add_all([target, bodyweight, dumbbell])
+        db.session.commit()
+
+        exercises = [
+            Exercise(name="sit-up", gif_url="sit-up.url", instructions=["Lie on your back", "Sit up"],
+                     target_id=target.id, equipment_id=bodyweight.id),
+            Exercise(name="crunch", gif_url="crunch.url", instructions=["Lie on your back", "Crunch up to sit"],
+                     target_id=target.id, equipment_id=bodyweight.id),
+            Exercise(name="dumbbell sit-up", gif_url="db-sit-up.url", instructions=["Hold a dumbbell", "Sit up"],
+                     target_id=target.id, equipment_id=dumbbell.id),
+        ]
+        db.session.add_all(exercises)
+        db.session.commit()
+
+        catalog_cache.clear()
+        self.catalog = catalog_cache.get()
+        self.mask = (1 << len(exercises)) - 1
+        self.sit_up_id, self.crunch_id, self.dumbbell_sit_up_id = [exercise.id for exercise in exercises]
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['CATALOG_CHECK_INTERVAL'] = 5
+
+    def test_index_built_in_background(self):
+        """Is a reloaded catalog searched only once its search index is built, the previous one until then?"""
+        self.assertIs(catalog_cache.get_searchable(), self.catalog)
+        self.assertIn(self.catalog, _indexes)
+
+        db.session.add(Exercise(name="plank", gif_url="plank.url", instructions=["Hold still"],
+                                target_id=self.catalog.targets[0][0], equipment_id=self.catalog.equipment[0][0]))
+        CatalogVersion.bump()
+        db.session.commit()
+        catalog = catalog_cache.get()
+        self.assertIsNot(catalog, self.catalog)
+        self.assertIs(catalog_cache.get_searchable(), self.catalog)
+
+        # Waits for the background build
+        search_index(catalog)
+        self.assertIs(catalog_cache.get_searchable(), catalog)
+
+    def test_search_prefix(self):
+        """Do query words match words they are a prefix of, in names and instructions?"""
+        self.assertEqual(search(self.catalog, 'SIT', self.mask),
+                         ([self.sit_up_id, self.dumbbell_sit_up_id, self.crunch_id], 3))
+        self.assertEqual(search(self.catalog, 'crun', self.mask), ([self.crunch_id], 1))
+        self.assertEqual(search(self.catalog, 'sit hol', self.mask), ([self.dumbbell_sit_up_id], 1))
+        self.assertEqual(search(self.catalog, 'squat', self.mask), ([], 0))
+        self.assertEqual(search(self.catalog, '  ', self.mask), ([], 0))
+
+    def test_search_ranking(self):
+        """Do exercises matching every word in their name come before those matching in instructions?"""
+        self.assertEqual(search(self.catalog, 'sit up', self.mask)[0],
+                         [self.sit_up_id, self.dumbbell_sit_up_id, self.crunch_id])
+        self.assertEqual(search(self.catalog, 'sit lie', self.mask)[0], [self.sit_up_id, self.crunch_id])
+
+    def test_search_mask_and_paging(self):
+        """Are only exercises in the mask returned, paged by offset and limit?"""
+        bodyweight = self.catalog.equipment_index[self.catalog.bodyweight_id]
+        self.assertEqual(search(self.catalog, 'sit', bodyweight), ([self.sit_up_id, self.crunch_id], 2))
+
+        self.assertEqual(search(self.catalog, 'sit', self.mask, offset=1, limit=1), ([self.dumbbell_sit_up_id], 3))
+        self.assertEqual(search(self.catalog, 'sit', self.mask, offset=2, limit=5), ([self.crunch_id], 3))
+        self.assertEqual(search(self.catalog, 'sit', self.mask, offset=3), ([], 3))
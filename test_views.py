@@ -3,8 +3,14 @@
 # Run with FLASK_ENV=production python -m unittest test_views.py
 
 import os 
+import threading
+from contextlib import contextmanager
 from unittest import TestCase
-from models import db, User, Equipment, Target, Exercise
+from sqlalchemy import event
+from models import db, User, Equipment, Target, Exercise, BreakEvent
+from catalog import catalog_cache
+from eligible import eligible_cache
+from events import EventWriter, event_writer
 
 os.environ['DATABASE_URL'] = "postgresql:///movement_test"
 
@@ -14,6 +20,21 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+@contextmanager
+def count_statements(engine=None):
+    """Collect SQL statements executed on engine (the primary by default) within block"""
+
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = engine or db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
 class ViewsTestCase(TestCase):
     """Test views for Movement Breaks app"""
 
@@ -40,6 +61,9 @@ class ViewsTestCase(TestCase):
         db.session.add_all([bicep_curl, sit_up, chin_up])
         db.session.commit()
 
+        catalog_cache.clear()
+        eligible_cache.clear()
+
         user = User.register(username="test", password="password")
         user.targets.append(target_biceps)
         user.equipment = [equip_bodyweight, equip_dumbbell]
@@ -48,12 +72,15 @@ class ViewsTestCase(TestCase):
 
         self.abs_id = target_abs.id
         self.bodyweight_id = equip_bodyweight.id
+        self.dumbbell_id = equip_dumbbell.id
         self.chinup_id = chin_up.id
         self.user_id = user.id
         self.user = user
 
     def tearDown(self):
         db.session.rollback()
+        # Write queued break history before the next test drops the tables
+        event_writer.close()
 
     def test_homepage_logged_in(self):
         """Does homepage show up correctly if not logged in?"""
@@ -197,6 +224,174 @@ class ViewsTestCase(TestCase):
             self.assertNotIn('sit-up', data)
             self.assertIn('bicep curl', data)
 
+    def test_get_exercises_sample(self):
+        """Does sampling return pages of exercises until all have been returned?"""
+
+        with self.client as c:
+            response = c.get('/exercises?sample=1&seed=42')
+            data = response.json
+
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['exercises_found'])
+            self.assertEqual(data['seed'], 42)
+            self.assertEqual(len(data['exercises']), 1)
+            self.assertIsNotNone(data['next_cursor'])
+
+            next_response = c.get(f'/exercises?sample=1&seed=42&cursor={data["next_cursor"]}')
+            next_data = next_response.json
+
+            self.assertEqual(len(next_data['exercises']), 1)
+            self.assertIsNone(next_data['next_cursor'])
+            self.assertEqual({data['exercises'][0]['name'], next_data['exercises'][0]['name']},
+                             {'chin-up', 'sit-up'})
+
+    def test_prefetch_exercises(self):
+        """Does prefetch return a page with a token that continues paging after it?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            response = c.get('/exercises/prefetch?sample=1&seed=42')
+            data = response.json
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Cache-Control'], 'private, no-store')
+            self.assertEqual(data['exercises'], c.get('/exercises?sample=1&seed=42').json['exercises'])
+            self.assertEqual(data['expires_in'], app.config['PREFETCH_TOKEN_MAX_AGE'])
+
+            next_data = c.get(f'/exercises?sample=1&token={data["token"]}').json
+            expected = c.get(f'/exercises?sample=1&seed=42&cursor={data["next_cursor"]}').json
+            self.assertEqual(next_data['exercises'], expected['exercises'])
+            self.assertEqual(next_data['seed'], 42)
+
+    def test_prefetch_token_invalid(self):
+        """Are tokens of other users, tampered or expired tokens rejected?"""
+
+        with self.client as c:
+            token = c.get('/exercises/prefetch?sample=1').json['token']
+
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+            self.assertEqual(c.get(f'/exercises?sample=1&token={token}').status_code, 400)
+            self.assertEqual(c.get(f'/exercises?sample=1&token={token[:-2]}').status_code, 400)
+
+            token = c.get('/exercises/prefetch?sample=1').json['token']
+            app.config['PREFETCH_TOKEN_MAX_AGE'] = -1
+            self.addCleanup(app.config.__setitem__, 'PREFETCH_TOKEN_MAX_AGE', 300)
+            self.assertEqual(c.get(f'/exercises?sample=1&token={token}').status_code, 400)
+
+    def test_recommend_exercises(self):
+        """Are recommendations drawn from the user's eligible exercises, leaving out excluded ones?"""
+
+        with self.client as c:
+            response = c.get('/exercises/recommended?count=5')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Cache-Control'], 'private, no-store')
+            self.assertEqual(sorted(exercise['name'] for exercise in response.json['exercises']), ['chin-up', 'sit-up'])
+
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+            data = c.get('/exercises/recommended?count=5').json
+            self.assertTrue(data['exercises_found'])
+            self.assertEqual(sorted(exercise['name'] for exercise in data['exercises']), ['bicep curl', 'chin-up'])
+
+            data = c.get(f'/exercises/recommended?count=5&exclude={self.chinup_id}').json
+            self.assertEqual([exercise['name'] for exercise in data['exercises']], ['bicep curl'])
+
+            self.assertEqual(c.get('/exercises/recommended?exclude=1,x').status_code, 400)
+
+    def test_search_exercises(self):
+        """Does search only return exercises with the user's equipment, whatever their target?"""
+
+        with self.client as c:
+            data = c.get('/exercises/search?q=up').json
+            self.assertEqual([exercise['name'] for exercise in data['exercises']], ['sit-up', 'chin-up'])
+            self.assertEqual(data['total'], 2)
+            self.assertIsNone(data['next_offset'])
+
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+            data = c.get('/exercises/search?q=do&limit=2').json
+            self.assertEqual(data['total'], 3)
+            self.assertEqual(data['next_offset'], 2)
+
+            c.post(f'/users/{self.user_id}/blocks', json={'exercise_ids': [self.chinup_id]})
+            data = c.get('/exercises/search?q=do a c').json
+            self.assertEqual([exercise['name'] for exercise in data['exercises']], ['bicep curl'])
+
+            self.assertEqual(c.get('/exercises/search?q=').status_code, 400)
+
+    def test_get_exercises_sample_not_found(self):
+        """Does sampling keep body weight fallback when no exercises match preferences?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            c.post('/settings', data={'work_length': 60, 'break_length': 5, 'targets': [self.abs_id],
+                                      'equipment': [self.dumbbell_id]})
+            response = c.get('/exercises?sample=5')
+            data = response.json
+
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(data['exercises_found'])
+            self.assertEqual(sorted(exercise['name'] for exercise in data['exercises']), ['chin-up', 'sit-up'])
+            self.assertIsNone(data['next_cursor'])
+
+    def test_get_exercises_etag(self):
+        """Is exercise list revalidated with ETag until user preferences change?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            response = c.get('/exercises')
+            etag = response.headers['ETag']
+
+            not_modified = c.get('/exercises', headers={'If-None-Match': etag})
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.get_data(), b'')
+
+            c.post(f'/users/{self.user_id}/block', json={'exercise_id': self.chinup_id})
+            modified = c.get('/exercises', headers={'If-None-Match': etag})
+
+            self.assertEqual(modified.status_code, 200)
+            self.assertNotEqual(modified.headers['ETag'], etag)
+            self.assertNotIn('chin-up', modified.get_data(as_text=True))
+
+    def test_eligible_write_through(self):
+        """Are blocks and settings changes applied to the cached eligible set without recomputing it?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            c.get('/exercises')
+            misses = eligible_cache.misses
+
+            c.post(f'/users/{self.user_id}/block', json={'exercise_id': self.chinup_id})
+            blocked = c.get('/exercises').get_data(as_text=True)
+
+            c.post('/settings', data={'work_length': 60, 'break_length': 5, 'targets': [self.abs_id],
+                                      'equipment': [self.bodyweight_id]})
+            changed = c.get('/exercises').get_data(as_text=True)
+
+            self.assertEqual(eligible_cache.misses, misses)
+            self.assertNotIn('chin-up', blocked)
+            self.assertIn('bicep curl', blocked)
+            self.assertIn('sit-up', changed)
+            self.assertNotIn('bicep curl', changed)
+
+    def test_get_exercises_random_sample_no_etag(self):
+        """Is a sample without seed returned without ETag?"""
+
+        with self.client as c:
+            response = c.get('/exercises?sample=1')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('ETag', response.headers)
+
     def test_update_settings(self):
         """Does updating settings work?"""
 
@@ -214,6 +409,50 @@ class ViewsTestCase(TestCase):
             self.assertIn('45', data)
             self.assertIn('10', data)
 
+    def test_update_settings_preferences(self):
+        """Are equipment and target preferences replaced, bumping the preferences version?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            response = c.post('/settings', data={
+                'work_length': 60,
+                'break_length': 5,
+                'equipment': [self.dumbbell_id],
+                'targets': [self.abs_id]
+            })
+            user = User.query.get(self.user_id)
+            context = User.load_context(self.user_id)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual((context.equipment_ids, context.target_ids), ([self.dumbbell_id], [self.abs_id]))
+            self.assertEqual([equip.name for equip in user.equipment], ['dumbbell'])
+            self.assertEqual(user.preferences_version, 1)
+
+            c.post('/settings', data={
+                'work_length': 30,
+                'break_length': 5,
+                'equipment': [self.dumbbell_id],
+                'targets': [self.abs_id]
+            })
+            db.session.expire_all()
+            self.assertEqual(User.query.get(self.user_id).preferences_version, 1)
+
+    def test_settings_form(self):
+        """Does settings form show current preferences?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            response = c.get('/settings')
+            data = response.get_data(as_text=True)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(f'<option selected value="{self.bodyweight_id}">body weight</option>', data)
+            self.assertIn(f'<option value="{self.abs_id}">abs</option>', data)
+
     def test_settings_form_logged_out(self):
         """Does settings form redirect to home page if logged out?"""
 
@@ -251,3 +490,284 @@ class ViewsTestCase(TestCase):
 
     
     
+
+    def test_block_exercise_retry(self):
+        """Does blocking an already blocked exercise succeed?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            c.post(f'/users/{self.user_id}/block', json={'exercise_id': self.chinup_id})
+            response = c.post(f'/users/{self.user_id}/block', json={'exercise_id': self.chinup_id})
+
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(User.query.get(self.user_id).blocked_exercises), 1)
+
+    def test_bulk_block_unblock(self):
+        """Do bulk block and unblock only report exercises whose status changed?"""
+
+        exercise_ids = [exercise.id for exercise in Exercise.query.order_by(Exercise.id)]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            c.post(f'/users/{self.user_id}/block', json={'exercise_id': self.chinup_id})
+            response = c.post(f'/users/{self.user_id}/blocks', json={'exercise_ids': exercise_ids + [0]})
+
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(sorted(response.json['exercise_ids']),
+                             [exercise_id for exercise_id in exercise_ids if exercise_id != self.chinup_id])
+
+            response = c.delete(f'/users/{self.user_id}/blocks', json={'exercise_ids': [self.chinup_id, 0]})
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['exercise_ids'], [self.chinup_id])
+            self.assertIn('chin-up', c.get('/exercises').get_data(as_text=True))
+
+    def test_bulk_block_invalid(self):
+        """Does bulk blocking fail for invalid exercise ids?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            response = c.post(f'/users/{self.user_id}/blocks', json={'exercise_ids': 'all'})
+            self.assertEqual(response.status_code, 400)
+
+            response = c.post(f'/users/{self.user_id}/blocks', json={'exercise_ids': [True]})
+            self.assertEqual(response.status_code, 400)
+
+            response = c.delete(f'/users/{self.user_id}/blocks', json={'exercise_ids': list(range(1, 102))})
+            self.assertEqual(response.status_code, 400)
+
+    def test_bulk_block_retired(self):
+        """Are retired exercises left unblocked?"""
+
+        Exercise.query.filter_by(id=self.chinup_id).update({Exercise.retired: True})
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            response = c.post(f'/users/{self.user_id}/blocks', json={'exercise_ids': [self.chinup_id]})
+
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.json['exercise_ids'], [])
+
+    def test_list_blocked_exercises(self):
+        """Are blocked exercises listed in pages?"""
+
+        exercise_ids = [exercise.id for exercise in Exercise.query.order_by(Exercise.id)]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            c.post(f'/users/{self.user_id}/blocks', json={'exercise_ids': exercise_ids})
+            first = c.get(f'/users/{self.user_id}/blocks?limit=2').json
+            second = c.get(f'/users/{self.user_id}/blocks?limit=2&after={first["next_after"]}').json
+
+            self.assertEqual([exercise['id'] for exercise in first['exercises']], exercise_ids[:2])
+            self.assertEqual(first['exercises'][0]['name'], 'bicep curl')
+            self.assertEqual([exercise['id'] for exercise in second['exercises']], exercise_ids[2:])
+            self.assertIsNone(second['next_after'])
+
+    def test_blocks_logged_out(self):
+        """Do block list and bulk block fail when logged out?"""
+
+        with self.client as c:
+            self.assertEqual(c.get(f'/users/{self.user_id}/blocks').status_code, 401)
+            self.assertEqual(c.post(f'/users/{self.user_id}/blocks', json={'exercise_ids': []}).status_code, 401)
+
+    def test_statement_counts(self):
+        """Do views load the logged in user and their preferences in a single statement?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            # Load catalog before counting, and keep it from checking the catalog version
+            app.config['CATALOG_CHECK_INTERVAL'] = 60
+            self.addCleanup(app.config.__setitem__, 'CATALOG_CHECK_INTERVAL', 5)
+            c.get('/exercises')
+            db.session.remove()
+
+            for url in ['/', '/exercises', '/exercises?sample=2&seed=1', '/exercises/prefetch?sample=2',
+                        '/exercises/recommended?count=2',
+                        '/exercises/search?q=up', '/settings']:
+                with count_statements() as statements:
+                    response = c.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(statements), 1, f'{url}: {statements}')
+
+            with count_statements() as statements:
+                c.post('/settings', data={'work_length': 60, 'break_length': 5,
+                                          'equipment': [self.dumbbell_id], 'targets': [self.abs_id]})
+
+            # Load user, delete equipment, insert and delete targets, update user's preferences version
+            self.assertEqual(len(statements), 5, statements)
+
+    def test_metrics(self):
+        """Are request, SQL and cache metrics exported in Prometheus format?"""
+
+        app.config['METRICS_TOKEN'] = 'secret'
+        self.addCleanup(app.config.__setitem__, 'METRICS_TOKEN', None)
+
+        with self.client as c:
+            c.get('/exercises')
+            response = c.get('/metrics', headers={'Authorization': 'Bearer secret'})
+            text = response.get_data(as_text=True)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('text/plain', response.content_type)
+            self.assertIn('http_request_duration_seconds_count{endpoint="views.get_exercises"}', text)
+            self.assertIn('http_request_sql_statements_bucket{endpoint="views.get_exercises",le="+Inf"}', text)
+            self.assertIn('catalog_cache_misses_total', text)
+            self.assertIn('eligible_cache_size', text)
+
+    def test_metrics_restricted(self):
+        """Is /metrics disabled without METRICS_TOKEN, and refused without the token?"""
+
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+        app.config['METRICS_TOKEN'] = 'secret'
+        self.addCleanup(app.config.__setitem__, 'METRICS_TOKEN', None)
+
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+
+    def test_slow_request_log(self):
+        """Are slow requests logged with their SQL?"""
+
+        app.config['SLOW_REQUEST_THRESHOLD'] = 0
+        self.addCleanup(app.config.__setitem__, 'SLOW_REQUEST_THRESHOLD', None)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            with self.assertLogs('metrics', level='WARNING') as logs:
+                c.get('/exercises')
+
+            self.assertIn('Slow request GET /exercises', logs.output[0])
+            self.assertIn('SELECT', logs.output[0])
+
+    def test_replica_routing(self):
+        """Are read-only views served by the replica, while writes and the user's reads after them use the primary?"""
+
+        app.config['SQLALCHEMY_BINDS'] = {'replica': app.config['SQLALCHEMY_DATABASE_URI']}
+        self.addCleanup(app.config.__setitem__, 'SQLALCHEMY_BINDS', None)
+        replica = db.get_engine(app, 'replica')
+        self.addCleanup(replica.dispose)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            with count_statements(replica) as statements:
+                self.assertEqual(c.get('/exercises').status_code, 200)
+                self.assertEqual(c.get('/settings').status_code, 200)
+            self.assertTrue(statements)
+
+            with count_statements(replica) as statements:
+                c.post('/settings', data={'work_length': 45, 'break_length': 10})
+                c.post(f'/users/{self.user_id}/block', json={'exercise_id': self.chinup_id})
+                self.assertEqual(c.get('/').status_code, 200)
+            self.assertEqual(statements, [])
+
+    def test_replica_after_events(self):
+        """Do break history beacons leave the user's reads on the replica?"""
+
+        app.config['SQLALCHEMY_BINDS'] = {'replica': app.config['SQLALCHEMY_DATABASE_URI']}
+        self.addCleanup(app.config.__setitem__, 'SQLALCHEMY_BINDS', None)
+        replica = db.get_engine(app, 'replica')
+        self.addCleanup(replica.dispose)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            response = c.post('/events', json={'events': [{'kind': 'shown', 'exercise_id': self.chinup_id}]})
+            self.assertEqual(response.status_code, 202)
+            with c.session_transaction() as sess:
+                self.assertNotIn('primary_until', sess)
+            with count_statements(replica) as statements:
+                self.assertEqual(c.get('/exercises').status_code, 200)
+            self.assertTrue(statements)
+
+    def test_record_events(self):
+        """Are break history events queued, and written in the background along with blocks?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            response = c.post('/events', json={'events': [{'kind': 'work_completed'},
+                                                          {'kind': 'shown', 'exercise_id': self.chinup_id},
+                                                          {'kind': 'skipped', 'exercise_id': self.chinup_id}]})
+            self.assertEqual(response.status_code, 202)
+            c.post(f'/users/{self.user_id}/block', json={'exercise_id': self.chinup_id})
+
+        event_writer.close()
+        events = BreakEvent.query.order_by(BreakEvent.id).all()
+        self.assertEqual([(event.kind, event.exercise_id) for event in events],
+                         [('work_completed', None), ('shown', self.chinup_id), ('skipped', self.chinup_id),
+                          ('blocked', self.chinup_id)])
+        self.assertTrue(all(event.user_id == self.user_id for event in events))
+
+    def test_record_events_invalid(self):
+        """Are events of anonymous users, unknown kinds and unknown exercises rejected?"""
+
+        with self.client as c:
+            self.assertEqual(c.post('/events', json={'events': [{'kind': 'work_completed'}]}).status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+            self.assertEqual(c.post('/events', json={'events': [{'kind': 'blocked', 'exercise_id': self.chinup_id}]})
+                             .status_code, 400)
+            self.assertEqual(c.post('/events', json={'events': [{'kind': 'shown', 'exercise_id': 0}]}).status_code, 400)
+            self.assertEqual(c.post('/events', json={'events': {'kind': 'shown'}}).status_code, 400)
+            self.assertEqual(c.post('/events', json={'events': [{'kind': 'shown', 'exercise_id': True}]})
+                             .status_code, 400)
+
+            response = c.post('/events', json={'events': [{'kind': 'unknown'}] * 101})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('At most', response.json['message'])
+
+    def test_event_writer_close_timeout(self):
+        """Is a flusher still running after close times out kept, so that no second one starts?"""
+
+        writer = EventWriter()
+        release = threading.Event()
+        thread = threading.Thread(target=release.wait)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        writer._thread, writer._pid = thread, os.getpid()
+
+        writer.close(timeout=0.01)
+        self.assertIs(writer._thread, thread)
+        with app.app_context():
+            self.assertFalse(writer.put([{'kind': 'work_completed'}]))
+
+        release.set()
+        thread.join()
+        writer.close()
+        self.assertIsNone(writer._thread)
+
+    def test_record_events_backpressure(self):
+        """Are events refused with 503 while too many are waiting to be written?"""
+
+        app.config['EVENT_QUEUE_SIZE'] = 1
+        self.addCleanup(app.config.__setitem__, 'EVENT_QUEUE_SIZE', 10000)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = self.user_id
+
+            response = c.post('/events', json={'events': [{'kind': 'work_completed'}, {'kind': 'break_completed'}]})
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Retry-After', response.headers)